@@ -1,6 +1,13 @@
 import os
+import asyncio
 import logging
-import requests
+import random
+import time
+from collections import OrderedDict
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from typing import Any, Dict, Optional, Tuple
+
+import httpx # Installed with python-telegram-bot
 from telegram import Update
 from telegram.ext import Application, CommandHandler, ContextTypes
 
@@ -9,6 +16,7 @@ logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+logging.getLogger("httpx").setLevel(logging.WARNING) # Otherwise every API request is logged
 
 # Configuration from environment variables
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
@@ -21,6 +29,114 @@ if not API_URL:
     logger.error("API_URL environment variable not set.")
     exit(1)
 
+# Website API client
+API_TIMEOUT_SEC = float(os.environ.get("API_TIMEOUT_SEC", "10"))
+API_CONCURRENCY = int(os.environ.get("API_CONCURRENCY", "20")) # Requests in flight, and pooled connections
+API_MAX_RETRIES = int(os.environ.get("API_MAX_RETRIES", "3"))
+API_RETRY_BASE_SEC = 0.5 # Backoff doubles per attempt, with full jitter
+RETRY_STATUSES = {429, 502, 503, 504}
+SESSION_TTL_SEC = int(os.environ.get("SESSION_TTL_SEC", "3600"))
+SESSION_CACHE_SIZE = 10000 # Users whose site session cookies are kept
+# Updates handled at once; /start from one user no longer waits on another's API call.
+BOT_CONCURRENT_UPDATES = int(os.environ.get("BOT_CONCURRENT_UPDATES", "64"))
+
+
+class SiteClient:
+    """Pooled async client for the website API.
+
+    Keeps one keep-alive connection pool for all handlers, bounds the number
+    of requests in flight, retries transient failures with jittered backoff
+    and remembers each user's session cookies, so a repeated /start reuses
+    the site session instead of logging in again.
+    """
+
+    def __init__(self, base_url: str) -> None:
+        self._base_url = base_url
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore = asyncio.Semaphore(API_CONCURRENCY)
+        # telegram_id -> (cookies, expires_at), least recently used first
+        self._sessions: "OrderedDict[int, Tuple[Dict[str, str], float]]" = OrderedDict()
+
+    async def start(self, application: Application) -> None:
+        self._client = httpx.AsyncClient(
+            base_url=self._base_url,
+            timeout=httpx.Timeout(API_TIMEOUT_SEC),
+            limits=httpx.Limits(max_connections=API_CONCURRENCY, max_keepalive_connections=API_CONCURRENCY),
+            # The client is shared by every user, so it must never keep cookies
+            # itself; each user's session is sent explicitly from the cache.
+            cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+        )
+
+    async def close(self, application: Application) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _session(self, telegram_id: int) -> Optional[Dict[str, str]]:
+        entry = self._sessions.get(telegram_id)
+        if entry is None:
+            return None
+        if entry[1] < time.monotonic():
+            del self._sessions[telegram_id]
+            return None
+        self._sessions.move_to_end(telegram_id)
+        return entry[0]
+
+    def _store_session(self, telegram_id: int, response: httpx.Response) -> None:
+        if not response.cookies:
+            return
+        cookies = dict(self._session(telegram_id) or {})
+        cookies.update(response.cookies.items())
+        self._sessions[telegram_id] = (cookies, time.monotonic() + SESSION_TTL_SEC)
+        self._sessions.move_to_end(telegram_id)
+        while len(self._sessions) > SESSION_CACHE_SIZE:
+            self._sessions.popitem(last=False)
+
+    def forget(self, telegram_id: int) -> None:
+        self._sessions.pop(telegram_id, None)
+
+    async def request(self, method: str, path: str, telegram_id: int, **kwargs: Any) -> httpx.Response:
+        """Sends a request with the user's session cookies, retrying timeouts,
+        connection errors and 429/5xx gateway responses."""
+        cookies = self._session(telegram_id)
+        headers = {"Cookie": "; ".join(f"{k}={v}" for k, v in cookies.items())} if cookies else None
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    response = await self._client.request(method, path, headers=headers, **kwargs)
+                if response.status_code not in RETRY_STATUSES or attempt >= API_MAX_RETRIES:
+                    break
+            except httpx.TransportError:
+                if attempt >= API_MAX_RETRIES:
+                    raise
+            attempt += 1
+            # Full jitter keeps a burst of failed requests from retrying in lockstep.
+            await asyncio.sleep(random.uniform(0, API_RETRY_BASE_SEC * 2 ** attempt))
+        self._store_session(telegram_id, response)
+        return response
+
+    async def login(self, user: Any) -> Dict[str, Any]:
+        if self._session(user.id) is not None:
+            response = await self.request("GET", "/api/user_data", user.id)
+            if response.status_code == 200:
+                return response.json()
+            self.forget(user.id) # Expired or revoked on the site; log in again
+        payload = {
+            "id": user.id,
+            "first_name": user.first_name,
+            # Add other Telegram user data if needed for your /api/login endpoint
+            # For simplicity, we're only sending ID and first_name as requested.
+            # Note: A real Telegram WebApp login sends more data for hash validation.
+            # This bot-initiated login is simplified.
+        }
+        response = await self.request("POST", "/api/login", user.id, json=payload)
+        response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
+        return response.json()
+
+
+site = SiteClient(API_URL)
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Sends a welcome message and attempts to log in the user via the website API."""
     if not update.effective_user or not update.message:
@@ -32,20 +148,8 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     
     logger.info(f"User {user_telegram_id} ({user_first_name}) started the bot.")
 
-    login_api_url = f"{API_URL}/api/login"
-    payload = {
-        "id": user_telegram_id,
-        "first_name": user_first_name,
-        # Add other Telegram user data if needed for your /api/login endpoint
-        # For simplicity, we're only sending ID and first_name as requested.
-        # Note: A real Telegram WebApp login sends more data for hash validation.
-        # This bot-initiated login is simplified.
-    }
-
     try:
-        response = requests.post(login_api_url, json=payload)
-        response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
-        data = response.json()
+        data = await site.login(update.effective_user)
 
         if data.get("success"):
             message = "✅ تم تسجيل دخولك بنجاح عبر الموقع!"
@@ -53,7 +157,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         else:
             message = f"❌ فشل تسجيل الدخول، حاول لاحقًا. (الخطأ: {data.get('message', 'غير معروف')})"
             logger.warning(f"User {user_telegram_id} failed to log in via API: {data.get('message')}")
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         message = "❌ فشل تسجيل الدخول، حاول لاحقًا. (خطأ في الاتصال بالخادم)"
         logger.error(f"Error connecting to API for user {user_telegram_id}: {e}")
     except Exception as e:
@@ -69,7 +173,14 @@ def main() -> None:
         logger.error("TELEGRAM_BOT_TOKEN is None, exiting.")
         exit(1)
     
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(BOT_CONCURRENT_UPDATES)
+        .post_init(site.start)
+        .post_shutdown(site.close)
+        .build()
+    )
 
     # Add handlers
     application.add_handler(CommandHandler("start", start_command))
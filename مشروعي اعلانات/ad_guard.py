@@ -0,0 +1,140 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from flask import Request
+
+# --- Configuration ---
+# An ad must be open this long before it can be credited (the dashboard's timer uses the same value).
+AD_MIN_WATCH_SEC = float(os.environ.get("AD_MIN_WATCH_SEC", "5"))
+AD_TICKET_TTL_SEC = float(os.environ.get("AD_TICKET_TTL_SEC", "300"))
+# Ad credits per minute (and burst) allowed per user and per client IP.
+VIEW_AD_USER_RATE_PER_MIN = float(os.environ.get("VIEW_AD_USER_RATE_PER_MIN", "10"))
+VIEW_AD_USER_BURST = int(os.environ.get("VIEW_AD_USER_BURST", "3"))
+VIEW_AD_IP_RATE_PER_MIN = float(os.environ.get("VIEW_AD_IP_RATE_PER_MIN", "120")) # Many users can share a NAT
+VIEW_AD_IP_BURST = int(os.environ.get("VIEW_AD_IP_BURST", "30"))
+RATE_LIMIT_MAX_KEYS = 100000 # Buckets kept per limiter; the least recently seen are dropped
+# Proxies in front of the app that append to X-Forwarded-For (1 on Vercel or behind nginx).
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", "0"))
+
+MICROS = 1_000_000
+
+
+class TokenBucketLimiter:
+    """Per-key token buckets in an LRU; every check is O(1).
+
+    A dropped bucket comes back full, so eviction can only ever let a key
+    through early, and only once ``max_keys`` other keys were seen since.
+    """
+
+    def __init__(self, rate_per_sec: float, burst: int, max_keys: int = RATE_LIMIT_MAX_KEYS) -> None:
+        self._rate = rate_per_sec
+        self._burst = float(burst)
+        self._max_keys = max_keys
+        self._buckets: "OrderedDict[object, List[float]]" = OrderedDict() # key -> [tokens, updated_at]
+        self._lock = threading.Lock()
+
+    def check(self, key: object) -> float:
+        """Takes a token for ``key``; returns 0.0 if allowed, else the seconds until one is available."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self._burst, now]
+                if len(self._buckets) > self._max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self._burst, bucket[0] + (now - bucket[1]) * self._rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / self._rate
+
+
+def client_ip(request: Request) -> str:
+    # The address appended by the outermost trusted proxy; anything to its
+    # left in X-Forwarded-For is client-supplied and could be forged.
+    route = request.access_route
+    if TRUSTED_PROXIES and len(route) >= TRUSTED_PROXIES:
+        return route[-TRUSTED_PROXIES]
+    return request.remote_addr or ""
+
+
+class AdTicketError(ValueError):
+    def __init__(self, message: str, status_code: int = 400) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class AdTickets:
+    """Signed ad-view tickets: issued when an ad is opened, redeemed to credit it.
+
+    A ticket is only accepted ``min_watch`` seconds after it was issued, and
+    each one must have been issued at least ``min_watch`` after the last one
+    the user redeemed, so neither replaying a ticket nor opening several ads
+    at once earns more than one credit per watch time. Checked entirely in
+    memory, before the credit touches the database. The redeemed-ticket state
+    is per process: with several workers a ticket can be replayed at most
+    once per worker.
+    """
+
+    def __init__(self, secret: bytes, min_watch: float = AD_MIN_WATCH_SEC, ttl: float = AD_TICKET_TTL_SEC,
+                 max_users: int = RATE_LIMIT_MAX_KEYS) -> None:
+        self._secret = hashlib.sha256(b"ad-ticket\0" + secret).digest()
+        self.min_watch = min_watch
+        self._min_watch_us = int(min_watch * MICROS)
+        self._ttl_us = int(ttl * MICROS)
+        self._max_users = max_users
+        self._redeemed: "OrderedDict[int, int]" = OrderedDict() # user_id -> issued_at (us) of the last credit
+        self._lock = threading.Lock()
+
+    def _sign(self, payload: str) -> str:
+        digest = hmac.new(self._secret, payload.encode("ascii"), hashlib.sha256).digest()[:16]
+        return base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")
+
+    def issue(self, user_id: int) -> str:
+        payload = f"{user_id}.{time.time_ns() // 1000}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def verify(self, user_id: int, ticket: Optional[str]) -> int:
+        """Checks the signature and age of ``ticket`` and returns when it was issued (us).
+
+        Raises AdTicketError; whether the ticket was already credited is left to redeem().
+        """
+        try:
+            ticket_user, issued_at, signature = (ticket or "").split(".")
+            if not (issued_at.isascii() and issued_at.isdigit()): # int() also takes e.g. Arabic-Indic digits
+                raise ValueError(issued_at)
+            issued_us = int(issued_at)
+        except ValueError:
+            raise AdTicketError("Open an ad before claiming it")
+        # The user is checked first, so only ASCII is signed; the signature is
+        # compared as bytes, as compare_digest() raises TypeError on non-ASCII str.
+        if ticket_user != str(user_id) or not hmac.compare_digest(
+                signature.encode("utf-8", "surrogatepass"), self._sign(f"{ticket_user}.{issued_at}").encode("ascii")):
+            raise AdTicketError("Invalid ad ticket", 403)
+        age_us = time.time_ns() // 1000 - issued_us
+        if age_us < self._min_watch_us:
+            raise AdTicketError(f"Watch the ad for at least {self.min_watch:g} seconds")
+        if age_us > self._ttl_us:
+            raise AdTicketError("Ad ticket expired, please open the ad again")
+        return issued_us
+
+    def redeem(self, user_id: int, ticket: Optional[str]) -> None:
+        """Raises AdTicketError unless ``ticket`` may be credited to ``user_id`` now."""
+        issued_us = self.verify(user_id, ticket)
+        with self._lock:
+            last = self._redeemed.get(user_id)
+            if last is not None and issued_us < last + max(self._min_watch_us, 1):
+                raise AdTicketError("This ad was already credited", 409)
+            self._redeemed[user_id] = issued_us
+            self._redeemed.move_to_end(user_id)
+            if len(self._redeemed) > self._max_users:
+                self._redeemed.popitem(last=False)
@@ -0,0 +1,286 @@
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import ledger
+import referrals
+from storage import SQLiteStorage
+
+# --- Reward Configuration (nanotons) ---
+AD_VIEW_REWARD_NANO = ledger.to_nano(0.0001)
+MILESTONE_ADS = 50 # Bonus is paid every time ads_viewed reaches a multiple of this
+MILESTONE_BONUS_NANO = ledger.to_nano(0.50) # $0.50 TON
+# Referral commissions are a share of AD_VIEW_REWARD_NANO per level (see referrals.py).
+
+
+class _PendingUser:
+    __slots__ = ("base", "ads_viewed", "view_nano", "commission_nano")
+
+    def __init__(self) -> None:
+        # Row as last read from user_balances; None when we only hold deltas for
+        # this user (e.g. a referrer who has not viewed an ad in this window).
+        self.base: Optional[Dict[str, Any]] = None
+        self.ads_viewed: int = 0
+        self.view_nano: int = 0
+        self.commission_nano: int = 0
+
+    @property
+    def earnings_nano(self) -> int:
+        return self.view_nano + self.commission_nano
+
+    def merge(self, other: "_PendingUser") -> None:
+        self.ads_viewed += other.ads_viewed
+        self.view_nano += other.view_nano
+        self.commission_nano += other.commission_nano
+        if self.base is None:
+            self.base = other.base
+
+
+class AdViewAccumulator:
+    """Collects ad-view credits in memory and writes them to SQLite in batches.
+
+    Every view only touches an in-process dict; a background thread flushes all
+    pending per-user deltas (ads_viewed counts and one ledger entry per kind of
+    credit, commissions for every referral level included) as a single transaction per shard every
+    ``flush_interval`` seconds, or sooner once ``max_pending`` users are waiting. A ``flush_interval`` of 0
+    disables batching and writes through on every view, which is what a
+    serverless deployment that can be frozen between requests should use.
+
+    Milestone bonuses are decided by the flush, from the ads_viewed the
+    database returns, so views split across workers are each counted once.
+    They show up in a user's view once flushed; ``on_bonus`` is told who got one.
+    """
+
+    def __init__(self, storage: SQLiteStorage, referral_engine: referrals.ReferralEngine,
+                 flush_interval: float = 1.0, max_pending: int = 500,
+                 on_flush: Optional[Callable[[sqlite3.Connection, List[int]], None]] = None,
+                 on_bonus: Optional[Callable[[List[int]], None]] = None) -> None:
+        self._storage = storage
+        self._referrals = referral_engine
+        self._on_flush = on_flush # Told which users a committed flush credited on a shard (referrers included)
+        self._on_bonus = on_bonus
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        # Guards the dicts below and is never held across a query, except for
+        # the COMMIT of a flush: a commit and the removal of its deltas from
+        # _in_flight happen together, so base + deltas never counts a credit twice.
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock() # One flush at a time
+        self._pending: Dict[int, _PendingUser] = {}
+        # (referrer_id, referee_id) -> [level, amount_nano] for referral_earnings
+        self._pending_commissions: Dict[Tuple[int, int], List[int]] = {}
+        self._in_flight: Dict[int, _PendingUser] = {} # Deltas being written by the current flush
+        self._commits = 0 # Flush commits so far; a row read while this changed is read again
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+    # --- Public API ---
+    def record(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Credits one ad view and returns the user's up-to-date view, or None if the user does not exist."""
+        result = self._with_base(user_id, self._credit)
+        if result is None:
+            return None
+        view, pending_count = result
+
+        if self._flush_interval <= 0:
+            self.flush()
+            return self.get_user(user_id) # Includes a milestone bonus the flush just paid
+        self._ensure_started()
+        if pending_count >= self._max_pending:
+            self._wakeup.set()
+        return view
+
+    def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Returns the user row with any not-yet-flushed credits applied."""
+        result = self._with_base(user_id, None)
+        return result[0] if result is not None else None
+
+    def invalidate(self, user_id: int) -> None:
+        """Drops the cached base row after another path wrote to the user; pending deltas are kept."""
+        with self._lock:
+            for entries in (self._pending, self._in_flight):
+                entry = entries.get(user_id)
+                if entry is not None:
+                    entry.base = None
+
+    def flush(self) -> int:
+        """Writes all pending deltas, one transaction per shard, and returns how many users were updated."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, commissions = self._pending, self._pending_commissions
+                self._pending, self._pending_commissions = {}, {}
+                self._in_flight = batch
+
+            # A commission is written to its referrer's shard, and every referrer has an entry in the batch.
+            shard_of = self._storage.shard_of
+            users_by_shard: Dict[int, Dict[int, _PendingUser]] = {}
+            for user_id, entry in batch.items():
+                users_by_shard.setdefault(shard_of(user_id), {})[user_id] = entry
+            commissions_by_shard: Dict[int, Dict[Tuple[int, int], List[int]]] = {}
+            for key, commission in commissions.items():
+                commissions_by_shard.setdefault(shard_of(key[0]), {})[key] = commission
+
+            flushed: Dict[int, List[int]] = {}
+            bonus_ids: List[int] = []
+            for shard, users in users_by_shard.items():
+                shard_commissions = commissions_by_shard.get(shard, {})
+                conn = self._storage.connect(shard)
+                try:
+                    bonus_ids.extend(self._write(conn, users, shard_commissions))
+                    with self._lock:
+                        conn.commit()
+                        self._committed(users)
+                    flushed[shard] = list(users)
+                except sqlite3.Error as e:
+                    # The shard's deltas go back to pending, so the next flush retries them.
+                    conn.rollback()
+                    print(f"Error flushing ad views: {e}")
+                    with self._lock:
+                        self._restore(users, shard_commissions)
+                finally:
+                    conn.close()
+
+        if self._on_flush is not None:
+            for shard, user_ids in flushed.items():
+                try:
+                    self._on_flush(self._storage.connect(shard), user_ids)
+                except sqlite3.Error as e:
+                    print(f"Error reporting flushed ad views: {e}")
+        if bonus_ids and self._on_bonus is not None:
+            self._on_bonus(bonus_ids)
+        ledger.compact_if_due(self._storage.fan_out)
+        return sum(len(user_ids) for user_ids in flushed.values())
+
+    def stop(self) -> None:
+        """Stops the background flusher and writes whatever is still pending."""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.flush()
+
+    # --- Internals ---
+    def _with_base(self, user_id: int, apply: Optional[Callable[[int, _PendingUser], None]]
+                   ) -> Optional[Tuple[Dict[str, Any], int]]:
+        # Calls apply(user_id, entry) (if given) under the lock and returns
+        # (view, pending user count). A missing base row is read without the
+        # lock; if a flush committed meanwhile the row may or may not hold its
+        # deltas, so it is read again.
+        row: Optional[Dict[str, Any]] = None
+        commits = -1
+        while True:
+            with self._lock:
+                entry = self._pending.get(user_id)
+                in_flight = self._in_flight.get(user_id)
+                base = entry.base if entry is not None else None
+                if base is None and in_flight is not None:
+                    base = in_flight.base # Read before this flush, so it holds none of its deltas
+                if base is None and row is not None and commits == self._commits:
+                    base = row
+                if base is not None:
+                    if entry is None and apply is not None:
+                        entry = self._pending[user_id] = _PendingUser()
+                    if entry is not None:
+                        entry.base = base
+                        if apply is not None:
+                            apply(user_id, entry)
+                    return self._view(base, entry, in_flight), len(self._pending)
+                commits = self._commits
+            row = self._load(user_id)
+            if row is None:
+                return None
+
+    def _credit(self, user_id: int, entry: _PendingUser) -> None:
+        entry.ads_viewed += 1
+        entry.view_nano += AD_VIEW_REWARD_NANO
+        # The referrer chain is cached, so this costs no query per level.
+        for referrer_id, level, amount_nano in self._referrals.commissions_for(
+                user_id, entry.base['referrer_id'], AD_VIEW_REWARD_NANO):
+            # A missing referrer's ledger entry is skipped by ledger.credit_many().
+            self._pending.setdefault(referrer_id, _PendingUser()).commission_nano += amount_nano
+            commission = self._pending_commissions.setdefault((referrer_id, user_id), [level, 0])
+            commission[1] += amount_nano
+
+    def _committed(self, users: Dict[int, _PendingUser]) -> None:
+        # Under the lock, together with the COMMIT that wrote ``users``' deltas.
+        self._commits += 1
+        for user_id in users:
+            self._in_flight.pop(user_id, None)
+            entry = self._pending.get(user_id)
+            if entry is not None:
+                entry.base = None # Read before the commit; the next view reads the new row
+
+    def _restore(self, users: Dict[int, _PendingUser], commissions: Dict[Tuple[int, int], List[int]]) -> None:
+        for user_id, entry in users.items():
+            self._in_flight.pop(user_id, None)
+            pending = self._pending.get(user_id)
+            if pending is None:
+                self._pending[user_id] = entry
+            else:
+                pending.merge(entry)
+        for key, (level, amount_nano) in commissions.items():
+            self._pending_commissions.setdefault(key, [level, 0])[1] += amount_nano
+
+    def _write(self, conn: sqlite3.Connection, users: Dict[int, _PendingUser],
+               commissions: Dict[Tuple[int, int], List[int]]) -> List[int]:
+        # Writes one shard's deltas without committing; returns the users paid a milestone bonus.
+        credits: List[Tuple[int, int, str]] = []
+        bonus_ids: List[int] = []
+        for user_id, entry in users.items():
+            if entry.ads_viewed:
+                row = conn.execute(
+                    "UPDATE users SET ads_viewed = COALESCE(ads_viewed, 0) + ? WHERE id = ? RETURNING ads_viewed",
+                    (entry.ads_viewed, user_id)
+                ).fetchone()
+                if row is not None:
+                    # One bonus per multiple of MILESTONE_ADS crossed by this update.
+                    milestones = row[0] // MILESTONE_ADS - (row[0] - entry.ads_viewed) // MILESTONE_ADS
+                    if milestones:
+                        credits.append((user_id, milestones * MILESTONE_BONUS_NANO, 'milestone_bonus'))
+                        bonus_ids.append(user_id)
+            for amount_nano, kind in ((entry.view_nano, 'ad_view'), (entry.commission_nano, 'referral_commission')):
+                if amount_nano:
+                    credits.append((user_id, amount_nano, kind))
+        # Credits are ledger inserts; users is only touched for ads_viewed.
+        ledger.credit_many(conn, credits)
+        referrals.record_commissions(conn, [
+            (referrer_id, referee_id, level, amount_nano)
+            for (referrer_id, referee_id), (level, amount_nano) in commissions.items()
+        ])
+        return bonus_ids
+
+    def _load(self, user_id: int) -> Optional[Dict[str, Any]]:
+        conn = self._storage.for_user(user_id)
+        try:
+            row = conn.execute("SELECT * FROM user_balances WHERE id = ?", (user_id,)).fetchone()
+        finally:
+            conn.close()
+        return dict(row) if row is not None else None
+
+    @staticmethod
+    def _view(base: Dict[str, Any], *deltas: Optional[_PendingUser]) -> Dict[str, Any]:
+        view = dict(base)
+        for delta in deltas:
+            if delta is not None:
+                view['ads_viewed'] += delta.ads_viewed
+                view['balance_nano'] += delta.earnings_nano
+        view['earnings'] = ledger.to_ton(view['balance_nano'])
+        return view
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None or self._stopped:
+            return
+        with self._lock:
+            if self._thread is None:
+                # Started lazily so gunicorn workers each get their own flusher after fork.
+                self._thread = threading.Thread(target=self._run, name="ad-view-flusher", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopped:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            self.flush()
@@ -0,0 +1,229 @@
+import base64
+import json
+import sqlite3
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import ledger
+import search_index
+import storage
+from storage import SQLiteStorage
+
+# --- Configuration ---
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Sortable user columns and the indexed expression behind each of them. Balances
+# sort by their last compacted snapshot (idx_balance_snapshots_balance), which
+# can trail the exact `earnings` shown in each row by up to one compaction.
+USER_SORT_KEYS = {
+    'id': 'u.id',
+    'created_at': 'u.created_at',
+    'earnings': 's.balance_nano',
+    'ads_viewed': 'u.ads_viewed',
+}
+USER_SORT_COLUMNS = tuple(USER_SORT_KEYS)
+
+ADMIN_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_users_ads_viewed ON users (ads_viewed, id)",
+    "CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users (username COLLATE NOCASE, id)",
+    "CREATE INDEX IF NOT EXISTS idx_withdrawals_status ON withdrawals (status, id)",
+    "CREATE INDEX IF NOT EXISTS idx_withdrawals_user ON withdrawals (user_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_withdrawals_wallet ON withdrawals (ton_wallet_address)",
+)
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+# --- Cursors ---
+def encode_cursor(values: List[Any]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[List[Any]]:
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError):
+        raise InvalidQuery("Invalid cursor")
+    if not isinstance(values, list) or len(values) != 2:
+        raise InvalidQuery("Invalid cursor")
+    return values
+
+
+def parse_page_size(value: Optional[str]) -> int:
+    if not value:
+        return DEFAULT_PAGE_SIZE
+    try:
+        limit = int(value)
+    except ValueError:
+        raise InvalidQuery("Invalid limit")
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def _prefix_range(column: str, prefix: str) -> Tuple[str, List[str]]:
+    # [prefix, prefix-with-last-char-bumped) is an index range scan, unlike LIKE '%term%'.
+    # U+10FFFF has no successor: those trailing characters are dropped, and a
+    # prefix made only of them has no upper bound.
+    stem = prefix.rstrip('\U0010ffff')
+    if not stem:
+        return f"{column} >= ?", [prefix]
+    following = ord(stem[-1]) + 1
+    if 0xD800 <= following <= 0xDFFF: # Surrogates cannot be stored; skip to the next character
+        following = 0xE000
+    return f"{column} >= ? AND {column} < ?", [prefix, stem[:-1] + chr(following)]
+
+
+_ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+
+
+def _nocase(value: Any) -> Any:
+    # Python's side of COLLATE NOCASE, which only folds ASCII letters.
+    return value.translate(_ASCII_LOWER) if isinstance(value, str) else value
+
+
+def _merge(results: List[List[sqlite3.Row]], sort: str, descending: bool = False,
+           fold: Callable[[Any], Any] = lambda value: value) -> List[sqlite3.Row]:
+    # Every shard ran the same keyset query, so the first limit + 1 rows of the
+    # merge are exactly the page a single database would have returned.
+    return storage.merge_sorted(results, key=lambda row: (storage.sort_value(fold(row[sort])), row['id']),
+                                reverse=descending)
+
+
+def _page(rows: List[sqlite3.Row], limit: int, sort: str,
+          item: Callable[[Any], Dict[str, Any]] = dict) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    # One extra row is fetched to know whether another page exists.
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor([rows[-1][sort], rows[-1]['id']]) if has_more else None
+    items = [item(row) for row in rows]
+    for item in items:
+        item.pop('sort_key', None)
+    return items, next_cursor
+
+
+# --- Users ---
+def _user(row: Any) -> Dict[str, Any]:
+    # A user_balances row as listed; the view only has the balance in nanotons.
+    user = dict(row)
+    user['earnings'] = ledger.to_ton(user['balance_nano'])
+    return user
+
+
+def list_users(store: SQLiteStorage, search: str = '', sort: str = 'id', order: str = 'desc',
+               cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    if sort not in USER_SORT_COLUMNS:
+        raise InvalidQuery("Invalid sort column")
+    if order not in ('asc', 'desc'):
+        raise InvalidQuery("Invalid sort order")
+    after = decode_cursor(cursor)
+    search = search.strip()
+
+    # Exact-match fast paths hit the UNIQUE indexes and return at most one row.
+    if search.isdigit():
+        results = store.fan_out(lambda conn: conn.execute(
+            "SELECT * FROM user_balances WHERE telegram_id = ?", (int(search),)
+        ).fetchall())
+        return [_user(row) for rows in results for row in rows], None
+    if search[:3].upper() == 'REF':
+        results = store.fan_out(lambda conn: conn.execute(
+            "SELECT * FROM user_balances WHERE referral_code = ?", ('REF' + search[3:],)
+        ).fetchall())
+        return [_user(row) for rows in results for row in rows], None
+
+    if search and search_index.fts_available(store.connect()):
+        # Ranked full-text matches over names, username and telegram_id; the
+        # best `limit` matches are the answer, so there is no next page. With
+        # several shards each ranks against its own term statistics.
+        results = store.fan_out(lambda conn: search_index.search_users(conn, search, limit))
+        return _page(_merge(results, 'sort_key')[:limit], limit, 'sort_key', _user)[0], None
+    if search:
+        # Without FTS5, fall back to a username prefix search that walks
+        # idx_users_username_nocase in username order.
+        where, params = _prefix_range("username COLLATE NOCASE", search.lstrip('@') or search)
+        if after is not None:
+            where += " AND (username COLLATE NOCASE, id) > (?, ?)"
+            params.extend(after)
+        results = store.fan_out(lambda conn: conn.execute(
+            f"SELECT * FROM user_balances WHERE {where} ORDER BY username COLLATE NOCASE, id LIMIT ?",
+            params + [limit + 1]
+        ).fetchall())
+        return _page(_merge(results, 'username', fold=_nocase), limit, 'username', _user)
+
+    key = USER_SORT_KEYS[sort]
+    # The tie-breaker must come from the same table as the key for the index to cover the ORDER BY.
+    tie_breaker = 's.user_id' if key.startswith('s.') else 'u.id'
+    comparison = '<' if order == 'desc' else '>'
+    params = []
+    where = ""
+    if after is not None:
+        where = f"WHERE ({key}, {tie_breaker}) {comparison} (?, ?)" if sort != 'id' else f"WHERE u.id {comparison} ?"
+        params.extend(after if sort != 'id' else after[1:])
+    order_by = f"{key} {order}, {tie_breaker} {order}" if sort != 'id' else f"u.id {order}"
+    results = store.fan_out(lambda conn: conn.execute(
+        f"""
+        SELECT u.*, {key} AS sort_key
+        FROM balance_snapshots s
+        JOIN user_balances u ON u.id = s.user_id
+        {where}
+        ORDER BY {order_by}
+        LIMIT ?
+        """,
+        params + [limit + 1]
+    ).fetchall())
+    return _page(_merge(results, 'sort_key', descending=order == 'desc'), limit, 'sort_key', _user)
+
+
+# --- Withdrawals ---
+WITHDRAWAL_COLUMNS = "w.*, u.username, u.first_name"
+
+
+def list_withdrawals(store: SQLiteStorage, search: str = '', status: Optional[str] = None,
+                     cursor: Optional[str] = None, limit: int = DEFAULT_PAGE_SIZE) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    after = decode_cursor(cursor)
+    search = search.strip()
+    conditions: List[str] = []
+    params: List[Any] = []
+
+    if status:
+        conditions.append("w.status = ?")
+        params.append(status)
+    if search.isdigit():
+        # Numeric search is an exact Telegram ID lookup through the UNIQUE index.
+        conditions.append("w.user_id = (SELECT id FROM users WHERE telegram_id = ?)")
+        params.append(int(search))
+    elif search and search_index.fts_available(store.connect()):
+        condition = search_index.withdrawal_search_condition(search)
+        if condition is None:
+            return [], None
+        conditions.append(condition[0])
+        params.extend(condition[1])
+    elif search[:2] in ('UQ', 'EQ'):
+        condition, bounds = _prefix_range("w.ton_wallet_address", search)
+        conditions.append(condition)
+        params.extend(bounds)
+    elif search:
+        condition, bounds = _prefix_range("username COLLATE NOCASE", search.lstrip('@') or search)
+        conditions.append(f"w.user_id IN (SELECT id FROM users WHERE {condition})")
+        params.extend(bounds)
+    if after is not None:
+        conditions.append("w.id < ?")
+        params.append(after[1])
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    # A withdrawal is stored with its user, so the join never crosses shards.
+    results = store.fan_out(lambda conn: conn.execute(
+        f"""
+        SELECT {WITHDRAWAL_COLUMNS}
+        FROM withdrawals w
+        JOIN users u ON w.user_id = u.id
+        {where}
+        ORDER BY w.id DESC
+        LIMIT ?
+        """,
+        params + [limit + 1]
+    ).fetchall())
+    return _page(_merge(results, 'id', descending=True), limit, 'id')
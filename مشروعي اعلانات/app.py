@@ -1,16 +1,39 @@
 import os
-import sqlite3
-import hashlib
 import hmac
-import time
-import requests
-from flask import Flask, request, jsonify, render_template, session, url_for, redirect
+import math
+import sqlite3
+from flask import Flask, Response, request, jsonify, render_template, session, url_for, redirect, make_response
 from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, TYPE_CHECKING
 from functools import wraps # Import wraps for decorator
-import asyncio # Import asyncio for running async functions in a sync context
-from telegram import Bot, Update
-from telegram.ext import Application, CommandHandler, ContextTypes
+import atexit
+import threading
+from ad_views import AdViewAccumulator
+import ad_guard
+from db import release_connection, close_all_connections, use_connection_class
+from outbox import TelegramOutbox, OUTBOX_SCHEMA, OUTBOX_INDEX
+import admin_queries
+import assets
+import dbtools
+import events
+import idempotency
+import instrumentation
+import search_index
+import ledger
+import login_auth
+import payouts
+import referrals
+import sessions
+import stats
+import storage
+from repository import Repository
+from user_cache import UserViewCache
+from bot_runtime import BotRuntime
+
+if TYPE_CHECKING:
+    # python-telegram-bot is imported by the webhook on first use, not at cold start
+    from telegram import Update
+    from telegram.ext import ContextTypes
 
 # --- Configuration ---
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "YOUR_TELEGRAM_BOT_TOKEN_HERE")
@@ -18,17 +41,32 @@ TELEGRAM_ADMIN_CHAT_ID = os.environ.get("TELEGRAM_ADMIN_CHAT_ID", "YOUR_TELEGRAM
 TELEGRAM_ADMIN_ID = int(os.environ.get("TELEGRAM_ADMIN_ID", "YOUR_ADMIN_TELEGRAM_ID_HERE")) # Admin's Telegram ID
 TELEGRAM_BOT_USERNAME = "SMARTLAB3Sbot" # This can remain hardcoded or also be an env var
 
-DATABASE = 'smartcoinlabs.db'
-
 # --- Database Functions ---
-def get_db_connection() -> sqlite3.Connection:
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Connections come from a per-thread pool (see db.py); DATABASE_PATH overrides the file.
+# STORAGE_BACKEND=sharded spreads users over DATABASE_SHARDS files (see storage.py).
+store = storage.create_storage()
+repository = Repository(store)
+atexit.register(close_all_connections)
+if instrumentation.METRICS_ENABLED:
+    use_connection_class(instrumentation.InstrumentedConnection) # Times every SQL statement
+
+_db_initialized = False
+_db_ready_pid = 0 # Process that ran ensure_db(); a forked worker runs it again to start its own sender
+_db_init_lock = threading.Lock()
 
 def init_db() -> None:
-    conn = get_db_connection()
+    # Idempotent; the write lock keeps workers that start together from
+    # running the migrations at the same time. Every shard gets the full schema.
+    global _db_initialized
+    for shard in range(store.shard_count):
+        _init_shard(shard)
+    _db_initialized = True
+
+def _init_shard(shard: int) -> None:
+    conn = store.connect(shard)
     cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    storage.init_shard(cursor, shard, store.shard_count)
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY,
@@ -39,7 +77,7 @@ def init_db() -> None:
             photo_url TEXT,
             auth_date INTEGER,
             hash TEXT,
-            earnings REAL DEFAULT 0.0,
+            earnings REAL DEFAULT 0.0, -- Legacy: balances live in earnings_ledger (see ledger.py)
             ads_viewed INTEGER DEFAULT 0,
             referral_code TEXT UNIQUE,
             referrer_id INTEGER,
@@ -51,72 +89,193 @@ def init_db() -> None:
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
             amount REAL NOT NULL,
+            amount_nano INTEGER,
             ton_wallet_address TEXT NOT NULL,
             status TEXT DEFAULT 'pending',
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (user_id) REFERENCES users (id)
         )
     ''')
+    ledger.migrate(cursor)
+    cursor.execute(OUTBOX_SCHEMA)
+    cursor.execute(OUTBOX_INDEX)
+    cursor.execute(idempotency.IDEMPOTENCY_SCHEMA)
+    cursor.execute(idempotency.IDEMPOTENCY_INDEX)
+    cursor.execute(sessions.SESSION_SCHEMA)
+    cursor.execute(sessions.SESSION_INDEX)
+    cursor.execute(events.EVENTS_SCHEMA)
+    cursor.execute(events.EVENTS_INDEX)
+    cursor.execute(events.LISTENERS_SCHEMA)
+    for statement in admin_queries.ADMIN_INDEXES:
+        cursor.execute(statement)
+    for statement in referrals.REFERRAL_SCHEMA:
+        cursor.execute(statement)
+    stats.init_stats(cursor)
+    search_index.init_search_index(cursor)
     conn.commit()
     conn.close()
 
+def ensure_db() -> None:
+    # Runs init_db() once, on the first request that needs the database, and
+    # starts this process's Telegram sender, which also picks up messages left
+    # pending by a previous or crashed worker.
+    global _db_ready_pid
+    if _db_ready_pid == os.getpid():
+        return
+    with _db_init_lock:
+        if _db_ready_pid != os.getpid():
+            if not _db_initialized:
+                init_db()
+            telegram_outbox.start()
+            _db_ready_pid = os.getpid()
+
+# Per-level commission rates come from REFERRAL_COMMISSION_RATES (e.g. "0.10,0.05").
+referral_engine = referrals.ReferralEngine(store.for_user)
+
+# Top earners and referrers, held in memory; platform totals are kept by triggers (see stats.py).
+leaderboards = stats.Leaderboards(store.fan_out)
+DASHBOARD_LEADERBOARD_SIZE = 10
+
+def milestone_bonuses_paid(user_ids: list) -> None:
+    # Called by the ad-view flusher (outside any request) once the bonuses are committed.
+    for user_id in user_ids:
+        user_cache.invalidate(user_id)
+        if event_hub.has_subscribers(f"user:{user_id}"):
+            user = ad_views.get_user(user_id)
+            if user:
+                event_hub.publish(f"user:{user_id}", "balance",
+                                  {"earnings": user['earnings'], "adsViewed": user['ads_viewed']})
+
+# Ad views are credited in memory and written to SQLite in batches.
+# Set AD_VIEW_FLUSH_INTERVAL=0 to write through on every view (e.g. on serverless hosts).
+ad_views = AdViewAccumulator(
+    store,
+    referral_engine,
+    flush_interval=float(os.environ.get("AD_VIEW_FLUSH_INTERVAL", "1.0")),
+    max_pending=int(os.environ.get("AD_VIEW_MAX_PENDING", "500")),
+    on_flush=leaderboards.users_changed,
+    on_bonus=milestone_bonuses_paid
+)
+atexit.register(ad_views.stop) # Pending credits must survive a restart
+
+# Retried mutations (Idempotency-Key header) and redelivered Telegram updates (update_id)
+# replay the first response instead of running again; see idempotency.py.
+idempotency_keys = idempotency.IdempotencyKeys(store.for_user, store.fan_out)
+TELEGRAM_UPDATES_OWNER = 0 # No user has id 0
+
+# Live updates: balance changes go to topic user:<id>, withdrawal changes to "admins".
+# Workers exchange them through the events table (EVENTS_BACKEND=shared, see events.py),
+# and only for topics a stream on some worker is listening to.
+ADMIN_EVENTS_TOPIC = "admins"
+
+def event_shard(topic: str) -> int:
+    # A user's events are stored with the user; the admin topic lives on the first shard.
+    if topic.startswith("user:"):
+        return store.shard_of(int(topic[len("user:"):]))
+    return 0
+
+if events.EVENTS_BACKEND == "shared":
+    event_hub = events.EventHub(store.connect, store.shard_count, event_shard, on_first_use=ensure_db)
+elif events.EVENTS_BACKEND == "local":
+    event_hub = events.EventHub()
+else:
+    raise ValueError(f"Unknown EVENTS_BACKEND {events.EVENTS_BACKEND!r}; expected 'shared' or 'local'")
+atexit.register(event_hub.stop)
+
+# Serialized user views (and their ETags) for /api/user_data; write paths replace or drop entries.
+user_cache = UserViewCache(
+    max_size=int(os.environ.get("USER_CACHE_SIZE", "10000")),
+    ttl=float(os.environ.get("USER_CACHE_TTL", "30"))
+)
+
 app = Flask(__name__)
-app.secret_key = os.urandom(24) # Replace with a strong, unique secret key in production
+# Shared by every worker and instance, so a session (or ad ticket) from one is valid on all.
+app.secret_key = sessions.secret_key(app.debug)
+if sessions.SESSION_BACKEND == "server":
+    app.session_interface = sessions.ServerSessionInterface(
+        sessions.SQLiteSessionStore(store.connect, store.shard_count, store.fan_out, on_first_use=ensure_db)
+    )
+elif sessions.SESSION_BACKEND != "cookie":
+    raise ValueError(f"Unknown SESSION_BACKEND {sessions.SESSION_BACKEND!r}; expected 'server' or 'cookie'")
+app.teardown_appcontext(release_connection) # Return pooled connections without open transactions
+
+# The schema is created on the first request that can touch the database, so
+# cold starts that only serve pages (and importing the app) never open it.
+DB_FREE_ENDPOINTS = {'static', 'hashed_static', 'index', 'test_route', 'about', 'whitepaper', 'privacy_policy',
+                     'dashboard', 'admin_panel', 'start_ad', 'admin_events'}
+
+@app.before_request
+def initialize_database() -> None:
+    if _db_ready_pid != os.getpid() and request.endpoint not in DB_FREE_ENDPOINTS:
+        ensure_db()
+
+# Verified logins are remembered for a few minutes so WebApp reloads skip the HMAC and the write.
+login_verifier = login_auth.LoginVerifier(TELEGRAM_BOT_TOKEN)
 
-# Initialize the database when the app starts
-# with app.app_context():
-#     init_db() # Commented out for Vercel debugging
+# Ad credits are throttled per user and per IP and need a ticket from /api/ad/start;
+# both checks run in memory, so rejected credits never reach SQLite.
+view_ad_user_limiter = ad_guard.TokenBucketLimiter(ad_guard.VIEW_AD_USER_RATE_PER_MIN / 60, ad_guard.VIEW_AD_USER_BURST)
+view_ad_ip_limiter = ad_guard.TokenBucketLimiter(ad_guard.VIEW_AD_IP_RATE_PER_MIN / 60, ad_guard.VIEW_AD_IP_BURST)
+ad_tickets = ad_guard.AdTickets(app.secret_key)
 
 # --- Telegram Bot Functions ---
-async def send_telegram_message(chat_id: str, message: str) -> Optional[Dict[str, Any]]:
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    payload = {
-        'chat_id': chat_id,
-        'text': message,
-        'parse_mode': 'HTML'
-    }
-    try:
-        # Using requests.post is synchronous, for a fully async app, aiohttp would be preferred.
-        # However, for simplicity and to avoid adding new dependencies, we'll keep requests for now.
-        # In an async context, this will block the event loop.
-        response = await asyncio.to_thread(requests.post, url, json=payload)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Error sending Telegram message: {e}")
-        return None
+# Messages are written to the telegram_outbox table and sent by a background
+# worker over one keep-alive session, so requests never wait on Telegram.
+telegram_outbox = TelegramOutbox(store.connect, TELEGRAM_BOT_TOKEN, shard_count=store.shard_count)
+atexit.register(telegram_outbox.stop)
 
 # --- Helper Functions ---
 def generate_referral_code(telegram_id: int) -> str:
     # Simple referral code generation based on telegram_id
     return f"REF{telegram_id}"
 
+def publish_balance(payload: Dict[str, Any]) -> None:
+    # Pushed to the user's open dashboards so they never refetch /api/user_data.
+    event_hub.publish(f"user:{payload['id']}", "balance",
+                      {"earnings": payload['earnings'], "adsViewed": payload['adsViewed']})
+
+def event_stream_response(topics: list, initial: tuple = ()) -> Response:
+    subscription = event_hub.subscribe(topics, request.headers.get('Last-Event-ID'))
+    response = Response(event_hub.stream(subscription, initial), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Stop nginx from buffering the stream
+    return response
+
+# --- Static Pages and Assets ---
+# Public pages only depend on TELEGRAM_BOT_USERNAME, so they are rendered once
+# (or pre-built by build_static.py) and served with an ETag; CSS/JS get
+# fingerprinted URLs that can be cached forever.
+asset_pipeline = assets.AssetPipeline(app)
+asset_pipeline.init_app(lambda template: render_template(template, bot_username=TELEGRAM_BOT_USERNAME))
+
 # --- Routes ---
 @app.route('/')
-def index() -> str:
-    return render_template('index.html', bot_username=TELEGRAM_BOT_USERNAME)
+def index() -> Response:
+    return asset_pipeline.page('index')
 
 @app.route('/test')
 def test_route() -> str:
     return "Test route is working!"
 
 @app.route('/about')
-def about() -> str:
-    return render_template('about.html')
+def about() -> Response:
+    return asset_pipeline.page('about')
 
 @app.route('/whitepaper')
-def whitepaper() -> str:
-    return render_template('whitepaper.html')
+def whitepaper() -> Response:
+    return asset_pipeline.page('whitepaper')
 
 @app.route('/privacy-policy')
-def privacy_policy() -> str:
-    return render_template('privacy_policy.html')
+def privacy_policy() -> Response:
+    return asset_pipeline.page('privacy_policy')
 
 @app.route('/dashboard')
-def dashboard() -> str:
+def dashboard() -> Response:
     if 'user_id' not in session:
         return redirect(url_for('index')) # Redirect to home if not logged in
-    return render_template('dashboard.html')
+    response = asset_pipeline.page('dashboard')
+    response.headers['Cache-Control'] = 'private, no-cache' # Only logged-in users get this page
+    return response
 
 @app.route('/admin')
 # @admin_required # Commented out for Vercel debugging
@@ -124,21 +283,69 @@ def admin_panel() -> str:
     return render_template('admin.html')
 
 # --- Admin Decorator ---
-def admin_required(f): # Temporarily simplified for Vercel debugging
+def admin_required(f):
+    # Only the logged-in user whose Telegram id is TELEGRAM_ADMIN_ID gets through;
+    # checked against the database on every request, so demoting the admin takes effect at once.
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # if 'user_id' not in session:
-        #     return redirect(url_for('index'))
-        
-        # conn = get_db_connection()
-        # user = conn.execute("SELECT telegram_id FROM users WHERE id = ?", (session['user_id'],)).fetchone()
-        # conn.close()
-
-        # if user and user['telegram_id'] == TELEGRAM_ADMIN_ID:
-        #     return f(*args, **kwargs)
-        # else:
-        #     return jsonify({"success": False, "message": "Admin access required"}), 403
-        return f(*args, **kwargs) # Always allow access for debugging
+        if 'user_id' not in session:
+            return jsonify({"success": False, "message": "Not authenticated"}), 401
+
+        ensure_db() # Also guards routes that otherwise never touch the database
+        conn = store.for_user(session['user_id'])
+        user = conn.execute("SELECT telegram_id FROM users WHERE id = ?", (session['user_id'],)).fetchone()
+        conn.close()
+
+        if user and user['telegram_id'] == TELEGRAM_ADMIN_ID:
+            return f(*args, **kwargs)
+        return jsonify({"success": False, "message": "Admin access required"}), 403
+    return decorated_function
+
+# --- Idempotency Decorator ---
+def idempotent(f=None, *, precheck=None, durable: bool = True):
+    # Requests sent with an Idempotency-Key header run once per user and key;
+    # repeats get the stored response. Only successful responses are stored,
+    # so a request that was rejected (and changed nothing) can be retried.
+    # ``precheck`` runs before the key is looked up and returns a rejection or
+    # None; with durable=False keys are kept in this worker's memory only.
+    if f is None:
+        return lambda f: idempotent(f, precheck=precheck, durable=durable)
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if precheck is not None:
+            rejection = precheck()
+            if rejection is not None:
+                return rejection
+        key = request.headers.get('Idempotency-Key')
+        if not key or 'user_id' not in session:
+            return f(*args, **kwargs)
+        if len(key) > idempotency.MAX_KEY_LENGTH:
+            return jsonify({"success": False, "message": "Idempotency-Key is too long"}), 400
+
+        user_id: int = session['user_id']
+        key = f"{request.endpoint}:{key}" # The same key on another route is another request
+        try:
+            stored = idempotency_keys.begin(user_id, key, durable)
+        except idempotency.RequestInProgress:
+            response = jsonify({"success": False, "message": "This request is still being processed"})
+            response.headers['Retry-After'] = '1'
+            return response, 409
+        if stored is not None:
+            response = Response(stored.body, status=stored.status, mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            idempotency_keys.release(user_id, key)
+            raise
+        if 200 <= response.status_code < 300:
+            idempotency_keys.complete(user_id, key, response.status_code, response.get_data(), durable)
+        else:
+            idempotency_keys.release(user_id, key)
+        return response
     return decorated_function
 
 @app.route('/api/login', methods=['POST'])
@@ -147,82 +354,55 @@ def telegram_login() -> tuple[Dict[str, Any], int] | Dict[str, Any]:
     if not data:
         return jsonify({"success": False, "message": "No data provided"}), 400
 
-    # Telegram data validation (simplified for example, full validation is more complex)
-    # For production, you must implement full Telegram data validation as per their docs:
-    # https://core.telegram.org/widgets/login#checking-authorization
-    check_string = ""
-    for key in sorted(data.keys()):
-        if key != 'hash' and key != 'referrer_id': # referrer_id is custom, hash is for validation
-            check_string += f"{key}={data[key]}\n"
-    check_string = check_string.strip()
-
-    secret_key = hashlib.sha256(TELEGRAM_BOT_TOKEN.encode('utf-8')).digest()
-    h = hmac.new(secret_key, check_string.encode('utf-8'), hashlib.sha256)
-    expected_hash = h.hexdigest()
-
-    if expected_hash != data['hash']:
-        return jsonify({"success": False, "message": "Invalid Telegram data hash"}), 403
-
-    # Check auth_date freshness (e.g., within 24 hours)
-    if time.time() - data['auth_date'] > 86400: # 24 hours
-        return jsonify({"success": False, "message": "Telegram data is too old"}), 403
-
-    telegram_id: int = int(data['id'])
-    first_name: Optional[str] = str(data.get('first_name')) if data.get('first_name') else None
-    last_name: Optional[str] = str(data.get('last_name')) if data.get('last_name') else None
-    username: Optional[str] = str(data.get('username')) if data.get('username') else None
-    photo_url: Optional[str] = str(data.get('photo_url')) if data.get('photo_url') else None
-    auth_date: int = int(data.get('auth_date'))
-    received_hash: str = str(data.get('hash'))
-    referrer_id: Optional[int] = int(data.get('referrer_id')) if data.get('referrer_id') else None # Custom parameter for referral
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    user = cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+    # Full validation as per https://core.telegram.org/widgets/login#checking-authorization
+    error, user_id = login_verifier.verify(data)
+    if error:
+        return jsonify({"success": False, "message": error}), 403
 
-    if user is None:
-        # New user registration
-        referral_code = generate_referral_code(telegram_id)
-        cursor.execute(
-            "INSERT INTO users (telegram_id, first_name, last_name, username, photo_url, auth_date, hash, referral_code, referrer_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (telegram_id, first_name, last_name, username, photo_url, auth_date, received_hash, referral_code, referrer_id)
-        )
-        conn.commit()
-        user = cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
-        admin_message = f"New user registered: {username or first_name} (ID: {telegram_id})"
-        asyncio.run(send_telegram_message(TELEGRAM_ADMIN_CHAT_ID, admin_message))
-
-        welcome_message = (
-            "👋 Welcome to Smart Coin Labs!\n"
-            "📺 Watch ads and earn TON easily.\n"
-            "💎 Earn $0.50 TON for every 50 ads watched!\n"
-            "Click /start to begin now."
-        )
-        asyncio.run(send_telegram_message(str(telegram_id), welcome_message))
-    else:
-        # Existing user login, update details if necessary
-        cursor.execute(
-            "UPDATE users SET first_name=?, last_name=?, username=?, photo_url=?, auth_date=?, hash=? WHERE telegram_id=?",
-            (first_name, last_name, username, photo_url, auth_date, received_hash, telegram_id)
+    if user_id is None:
+        telegram_id: int = int(data['id'])
+        profile: Dict[str, Any] = {
+            key: str(data[key]) if data.get(key) else None
+            for key in ('first_name', 'last_name', 'username', 'photo_url', 'hash')
+        }
+        profile['auth_date'] = int(data['auth_date'])
+        referrer_id: Optional[int] = int(data.get('referrer_id')) if data.get('referrer_id') else None # Custom parameter for referral
+
+        def notify_created(conn: sqlite3.Connection) -> None:
+            # Queued in the same transaction as the new user
+            admin_message = f"New user registered: {profile['username'] or profile['first_name']} (ID: {telegram_id})"
+            telegram_outbox.enqueue(conn, TELEGRAM_ADMIN_CHAT_ID, admin_message)
+
+            welcome_message = (
+                "👋 Welcome to Smart Coin Labs!\n"
+                "📺 Watch ads and earn TON easily.\n"
+                "💎 Earn $0.50 TON for every 50 ads watched!\n"
+                "Click /start to begin now."
+            )
+            telegram_outbox.enqueue(conn, telegram_id, welcome_message)
+
+        user_id, created, changed = repository.register_login(
+            telegram_id, profile, generate_referral_code(telegram_id), referrer_id, notify_created
         )
-        conn.commit()
-
-    conn.close()
-
-    session['user_id'] = user['id'] # Store user ID in session
+        if created:
+            telegram_outbox.wake()
+        elif changed:
+            ad_views.invalidate(user_id)
+            user_cache.invalidate(user_id)
+        login_verifier.remember(data, user_id)
+
+    cached = user_cache.get(user_id)
+    if cached is None:
+        # Re-read through the accumulator so the cached view includes unflushed credits
+        user = ad_views.get_user(user_id)
+        if not user:
+            return jsonify({"success": False, "message": "User not found"}), 404
+        cached = user_cache.put(user)
+    session['user_id'] = user_id # Store user ID in session
     return jsonify({
         "success": True,
         "message": "Login successful",
-        "user": {
-            "id": user['id'],
-            "telegram_id": user['telegram_id'],
-            "first_name": user['first_name'],
-            "username": user['username'],
-            "earnings": user['earnings'],
-            "adsViewed": user['ads_viewed'],
-            "referralLink": url_for('index', ref=user['referral_code'], _external=True)
-        }
+        "user": cached.payload()
     })
 
 @app.route('/api/user_data', methods=['GET'])
@@ -231,31 +411,38 @@ def get_user_data() -> tuple[Dict[str, Any], int] | Dict[str, Any]:
         return jsonify({"success": False, "message": "Not authenticated"}), 401
 
     user_id: int = session['user_id']
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    user = cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-    conn.close()
-
-    if not user:
-        return jsonify({"success": False, "message": "User not found"}), 404
-
-    return jsonify({
-        "success": True,
-        "user": {
-            "id": user['id'],
-            "telegram_id": user['telegram_id'],
-            "first_name": user['first_name'],
-            "username": user['username'],
-            "earnings": user['earnings'],
-            "adsViewed": user['ads_viewed'],
-            "referralLink": url_for('index', ref=user['referral_code'], _external=True)
-        }
-    })
+    cached = user_cache.get(user_id)
+    if cached is not None and cached.etag in request.if_none_match:
+        # Unchanged profile: answer 304 without touching the database
+        response = make_response('', 304)
+    else:
+        if cached is None:
+            user = ad_views.get_user(user_id) # Includes credits that are not flushed yet
+            if not user:
+                return jsonify({"success": False, "message": "User not found"}), 404
+            cached = user_cache.put(user)
+        response = make_response(jsonify({"success": True, "user": cached.payload()}))
+
+    response.set_etag(cached.etag)
+    response.headers['Cache-Control'] = 'private, no-cache' # Browsers revalidate with If-None-Match
+    return response
 
 # --- Telegram Bot Webhook ---
-application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+def register_bot_user(telegram_id: int, first_name: Optional[str], username: Optional[str]) -> None:
+    # Blocking sqlite3 work for start_command; it runs in a thread, off the bot's event loop.
+    # This scenario should ideally be handled by the web login, but as a fallback
+    # or for direct bot interaction, we can register them here.
+    admin_message = f"New user registered via bot: {username or first_name} (ID: {telegram_id})"
+    registered = repository.register_bot_user(
+        telegram_id, first_name, username, generate_referral_code(telegram_id),
+        lambda conn: telegram_outbox.enqueue(conn, TELEGRAM_ADMIN_CHAT_ID, admin_message)
+    )
+    if registered:
+        telegram_outbox.wake()
+
+async def start_command(update: "Update", context: "ContextTypes.DEFAULT_TYPE") -> None:
+    import asyncio
 
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.effective_user:
         print("No effective user in update.")
         return
@@ -264,21 +451,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     user_first_name = update.effective_user.first_name
     user_username = update.effective_user.username
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    user = cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (user_telegram_id,)).fetchone()
-
-    if user is None:
-        # This scenario should ideally be handled by the web login, but as a fallback
-        # or for direct bot interaction, we can register them here.
-        referral_code = generate_referral_code(user_telegram_id)
-        cursor.execute(
-            "INSERT INTO users (telegram_id, first_name, username, referral_code) VALUES (?, ?, ?, ?)",
-            (user_telegram_id, user_first_name, user_username, referral_code)
-        )
-        conn.commit()
-        admin_message = f"New user registered via bot: {user_username or user_first_name} (ID: {user_telegram_id})"
-        await send_telegram_message(TELEGRAM_ADMIN_CHAT_ID, admin_message)
+    await asyncio.to_thread(register_bot_user, user_telegram_id, user_first_name, user_username)
 
     welcome_message = (
         "👋 Welcome to Smart Coin Labs!\n"
@@ -288,68 +461,100 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     )
     # Use context.bot.send_message for async operations
     await context.bot.send_message(chat_id=user_telegram_id, text=welcome_message)
-    conn.close()
 
-application.add_handler(CommandHandler("start", start_command))
+def bot_handlers() -> list:
+    from telegram.ext import CommandHandler
+    return [CommandHandler("start", start_command)]
+
+# The Application is started lazily, once per worker, on its own event loop.
+bot_runtime = BotRuntime(TELEGRAM_BOT_TOKEN, handlers=bot_handlers)
+atexit.register(bot_runtime.stop)
 
 @app.route('/telegram-webhook', methods=['POST'])
-async def telegram_webhook() -> tuple[Dict[str, Any], int]:
-    await application.update_queue.put(Update.de_json(request.get_json(force=True), application.bot))
+def telegram_webhook() -> tuple[Dict[str, Any], int]:
+    # Acknowledge as soon as the update is queued; handlers run concurrently in the background.
+    update: Dict[str, Any] = request.get_json(force=True)
+    update_id = update.get('update_id') if isinstance(update, dict) else None
+    key = f"telegram:{update_id}" if isinstance(update_id, int) else None
+    if key is not None:
+        try:
+            if idempotency_keys.begin(TELEGRAM_UPDATES_OWNER, key) is not None:
+                return jsonify({"status": "duplicate"}), 200 # Redelivered after a slow or lost answer
+        except idempotency.RequestInProgress:
+            return jsonify({"status": "duplicate"}), 200
+    if not bot_runtime.submit(update):
+        if key is not None:
+            idempotency_keys.release(TELEGRAM_UPDATES_OWNER, key)
+        # A non-2xx answer makes Telegram redeliver instead of the update being lost.
+        return jsonify({"status": "busy"}), 503
+    if key is not None:
+        idempotency_keys.complete(TELEGRAM_UPDATES_OWNER, key, 200, b'')
     return jsonify({"status": "ok"}), 200
 
-@app.route('/api/view_ad', methods=['POST'])
-def view_ad() -> tuple[Dict[str, Any], int] | Dict[str, Any]:
+@app.route('/api/ad/start', methods=['POST'])
+def start_ad() -> tuple[Dict[str, Any], int]:
     if 'user_id' not in session:
         return jsonify({"success": False, "message": "Not authenticated"}), 401
 
-    user_id: int = session['user_id']
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    user = cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-    if not user:
-        conn.close()
-        return jsonify({"success": False, "message": "User not found"}), 404
-
-    new_ads_viewed: int = user['ads_viewed'] + 1
-    new_earnings: float = user['earnings'] + 0.0001
+    return jsonify({
+        "success": True,
+        "ticket": ad_tickets.issue(session['user_id']),
+        "minWatchSeconds": ad_tickets.min_watch
+    }), 200
 
-    # Check for 50 ad milestone bonus
-    if new_ads_viewed % 50 == 0:
-        new_earnings += 0.50 # Bonus for every 50 ads: $0.50 TON
+def check_ad_view() -> Optional[tuple[Response, int]]:
+    # Runs before the idempotency key is looked up, so throttled or forged credits never reach SQLite.
+    if 'user_id' not in session:
+        return jsonify({"success": False, "message": "Not authenticated"}), 401
 
-    # Handle referral commission
-    if user['referrer_id']:
-        referrer = cursor.execute("SELECT * FROM users WHERE id = ?", (user['referrer_id'],)).fetchone()
-        if referrer:
-            commission: float = 0.0001 * 0.10 # 10% of 0.0001
-            cursor.execute("UPDATE users SET earnings = earnings + ? WHERE id = ?", (commission, referrer['id']))
-            conn.commit()
+    user_id: int = session['user_id']
+    retry_after = max(view_ad_user_limiter.check(user_id), view_ad_ip_limiter.check(ad_guard.client_ip(request)))
+    if retry_after:
+        response = jsonify({"success": False, "message": "Too many ad views, please slow down"})
+        response.headers['Retry-After'] = str(math.ceil(retry_after))
+        return response, 429
+    data: Dict[str, Any] = request.get_json(silent=True) or {}
+    try:
+        ad_tickets.verify(user_id, data.get('ticket'))
+    except ad_guard.AdTicketError as e:
+        return jsonify({"success": False, "message": str(e)}), e.status_code
+    return None
 
-    cursor.execute(
-        "UPDATE users SET ads_viewed = ?, earnings = ? WHERE id = ?",
-        (new_ads_viewed, new_earnings, user_id)
-    )
-    conn.commit()
+@app.route('/api/view_ad', methods=['POST'])
+# Keys stay in memory: a retry replays on the worker that credited the view, and
+# the ad-view accumulator's batched writes are not undone by a write per request.
+@idempotent(precheck=check_ad_view, durable=False)
+def view_ad() -> tuple[Dict[str, Any], int] | Dict[str, Any]:
+    user_id: int = session['user_id']
+    data: Dict[str, Any] = request.get_json(silent=True) or {}
+    try:
+        ad_tickets.redeem(user_id, data.get('ticket'))
+    except ad_guard.AdTicketError as e:
+        return jsonify({"success": False, "message": str(e)}), e.status_code
+
+    # Crediting (including the 50-ad milestone bonus and the referrer's commission)
+    # is accumulated in memory and flushed to the database in batches.
+    updated_user = ad_views.record(user_id)
+    if not updated_user:
+        return jsonify({"success": False, "message": "User not found"}), 404
 
-    updated_user = cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-    conn.close()
+    cached = user_cache.put(updated_user)
+    publish_balance(cached.fields)
+    for referrer_id in referral_engine.chain(user_id, updated_user['referrer_id']):
+        user_cache.invalidate(referrer_id) # Their commission just changed
+        if event_hub.has_subscribers(f"user:{referrer_id}"):
+            referrer = ad_views.get_user(referrer_id)
+            if referrer:
+                publish_balance(user_cache.put(referrer).fields)
 
     return jsonify({
         "success": True,
         "message": "Ad viewed successfully",
-        "user": {
-            "id": updated_user['id'],
-            "telegram_id": updated_user['telegram_id'],
-            "first_name": updated_user['first_name'],
-            "username": updated_user['username'],
-            "earnings": updated_user['earnings'],
-            "adsViewed": updated_user['ads_viewed'],
-            "referralLink": url_for('index', ref=updated_user['referral_code'], _external=True)
-        }
+        "user": cached.payload()
     })
 
 @app.route('/api/withdraw', methods=['POST'])
+@idempotent
 def withdraw() -> tuple[Dict[str, Any], int] | Dict[str, Any]:
     if 'user_id' not in session:
         return jsonify({"success": False, "message": "Not authenticated"}), 401
@@ -365,59 +570,106 @@ def withdraw() -> tuple[Dict[str, Any], int] | Dict[str, Any]:
     if not ton_wallet_address.startswith('UQ') and not ton_wallet_address.startswith('EQ'):
         return jsonify({"success": False, "message": "Invalid TON wallet address format"}), 400
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    user = cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-    if not user:
-        conn.close()
-        return jsonify({"success": False, "message": "User not found"}), 404
-
-    if user['ads_viewed'] < 50:
-        conn.close()
-        return jsonify({"success": False, "message": "You must view at least 50 ads before withdrawing"}), 400
+    # Persist any batched ad credits first so the full balance is withdrawn
+    ad_views.flush()
+
+    def notify_admin(conn: sqlite3.Connection, withdrawal: sqlite3.Row, user: sqlite3.Row) -> None:
+        # Queue the admin notification in the same transaction as the withdrawal
+        message = (
+            f"<b>New Withdrawal Request!</b>\n"
+            f"User: {user['first_name'] or user['username']} (ID: {user['telegram_id']})\n"
+            f"Amount: {withdrawal['amount']:.4f} TON\n"
+            f"TON Wallet: <code>{ton_wallet_address}</code>\n"
+            f"⏳ Status: Pending\n"
+            f"Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+        )
+        telegram_outbox.enqueue(conn, TELEGRAM_ADMIN_CHAT_ID, message)
 
-    withdrawal_amount: float = user['earnings'] # Withdraw all available earnings
+    try:
+        # The debit (all available earnings) and the withdrawal row are written
+        # in one transaction, guarded by the balance and ads_viewed checks.
+        withdrawal, user = repository.request_withdrawal(user_id, ton_wallet_address, notify_admin)
+    except payouts.WithdrawalError as e:
+        return jsonify({"success": False, "message": str(e)}), e.status_code
+    telegram_outbox.wake()
+
+    ad_views.invalidate(user_id) # Credits recorded since the flush above must not see the old balance
+    cached = user_cache.put(ad_views.get_user(user_id))
+    publish_balance(cached.fields)
+    event_hub.publish(ADMIN_EVENTS_TOPIC, "withdrawal",
+                      dict(withdrawal, username=user['username'], first_name=user['first_name']))
 
-    if withdrawal_amount <= 0:
-        conn.close()
-        return jsonify({"success": False, "message": "No earnings to withdraw"}), 400
+    return jsonify({
+        "success": True,
+        "message": "Withdrawal request submitted successfully",
+        "user": cached.payload()
+    })
 
-    # Deduct earnings and record withdrawal
-    cursor.execute("UPDATE users SET earnings = 0.0 WHERE id = ?", (user_id,))
-    cursor.execute(
-        "INSERT INTO withdrawals (user_id, amount, ton_wallet_address) VALUES (?, ?, ?)",
-        (user_id, withdrawal_amount, ton_wallet_address)
-    )
-    conn.commit()
+@app.route('/api/events', methods=['GET'])
+def user_events() -> tuple[Dict[str, Any], int] | Response:
+    # Server-sent "balance" events; the first one is the current balance.
+    if 'user_id' not in session:
+        return jsonify({"success": False, "message": "Not authenticated"}), 401
 
-    # Send admin notification via Telegram bot
-    message = (
-        f"<b>New Withdrawal Request!</b>\n"
-        f"User: {user['first_name'] or user['username']} (ID: {user['telegram_id']})\n"
-        f"Amount: {withdrawal_amount:.4f} TON\n"
-        f"TON Wallet: <code>{ton_wallet_address}</code>\n"
-        f"⏳ Status: Pending\n"
-        f"Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-    )
-    asyncio.run(send_telegram_message(TELEGRAM_ADMIN_CHAT_ID, message))
+    user_id: int = session['user_id']
+    cached = user_cache.get(user_id)
+    if cached is None:
+        user = ad_views.get_user(user_id)
+        if not user:
+            return jsonify({"success": False, "message": "User not found"}), 404
+        cached = user_cache.put(user)
+    snapshot = {"earnings": cached.fields['earnings'], "adsViewed": cached.fields['adsViewed']}
+    return event_stream_response([f"user:{user_id}"], (("balance", snapshot),))
+
+@app.route('/api/referrals', methods=['GET'])
+def get_referrals() -> tuple[Dict[str, Any], int]:
+    if 'user_id' not in session:
+        return jsonify({"success": False, "message": "Not authenticated"}), 401
 
-    updated_user = cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
-    conn.close()
+    user_id: int = session['user_id']
+    try:
+        parent_id = int(request.args.get('parent') or user_id)
+        before_id = int(request.args['cursor']) if request.args.get('cursor') else None
+        limit = admin_queries.parse_page_size(request.args.get('limit'))
+    except (ValueError, admin_queries.InvalidQuery):
+        return jsonify({"success": False, "message": "Invalid parameters"}), 400
+    # Deeper levels of the tree are only visible while they still pay commission.
+    if parent_id != user_id and user_id not in referral_engine.chain(parent_id)[:referral_engine.max_depth - 1]:
+        return jsonify({"success": False, "message": "Not in your referral tree"}), 403
+
+    referees, next_cursor = repository.list_referees(user_id, parent_id, before_id, limit)
+    summary = repository.referral_summary(user_id) if before_id is None and parent_id == user_id else None
+    for referee in referees:
+        referee['commission'] = ledger.to_ton(referee.pop('commission_nano'))
+    response: Dict[str, Any] = {"success": True, "referrals": referees,
+                                "next_cursor": str(next_cursor) if next_cursor is not None else None}
+    if summary is not None:
+        # Totals per level are only sent with the first page of the viewer's own referees.
+        response["levels"] = [
+            {"level": row['level'], "referees": row['referees'], "commission": ledger.to_ton(row['commission_nano'])}
+            for row in summary
+        ]
+    return jsonify(response), 200
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats() -> tuple[Dict[str, Any], int]:
+    if 'user_id' not in session:
+        return jsonify({"success": False, "message": "Not authenticated"}), 401
 
+    totals = repository.platform_totals()
     return jsonify({
         "success": True,
-        "message": "Withdrawal request submitted successfully",
-        "user": {
-            "id": updated_user['id'],
-            "telegram_id": updated_user['telegram_id'],
-            "first_name": updated_user['first_name'],
-            "username": updated_user['username'],
-            "earnings": updated_user['earnings'],
-            "adsViewed": updated_user['ads_viewed'],
-            "referralLink": url_for('index', ref=updated_user['referral_code'], _external=True)
-        }
-    })
+        "stats": {
+            "users": totals['users'],
+            "adsViewed": totals['ads_viewed'],
+            "totalEarned": ledger.to_ton(totals['earned_nano']),
+            "totalPaid": ledger.to_ton(totals['withdrawals_completed_nano'])
+        },
+        "topEarners": [
+            {"name": entry['first_name'] or entry['username'], "earned": ledger.to_ton(entry['earned_nano'])}
+            for entry in leaderboards.top('earners', DASHBOARD_LEADERBOARD_SIZE)
+        ]
+    }), 200
 
 @app.route('/api/logout', methods=['POST'])
 def logout() -> tuple[Dict[str, Any], int]:
@@ -427,74 +679,163 @@ def logout() -> tuple[Dict[str, Any], int]:
 @app.route('/api/admin/users', methods=['GET'])
 @admin_required
 def admin_get_users() -> tuple[Dict[str, Any], int]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    search_term = request.args.get('search', '')
-
-    if search_term:
-        users = cursor.execute(
-            "SELECT * FROM users WHERE username LIKE ? OR telegram_id LIKE ?",
-            (f"%{search_term}%", f"%{search_term}%")
-        ).fetchall()
-    else:
-        users = cursor.execute("SELECT * FROM users").fetchall()
-    
-    conn.close()
-    return jsonify({"success": True, "users": [dict(user) for user in users]}), 200
+    try:
+        users, next_cursor = repository.list_users(
+            search=request.args.get('search', ''),
+            sort=request.args.get('sort', 'id'),
+            order=request.args.get('order', 'desc'),
+            cursor=request.args.get('cursor'),
+            limit=admin_queries.parse_page_size(request.args.get('limit'))
+        )
+    except admin_queries.InvalidQuery as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    return jsonify({"success": True, "users": users, "next_cursor": next_cursor}), 200
 
 @app.route('/api/admin/withdrawals', methods=['GET'])
 @admin_required
 def admin_get_withdrawals() -> tuple[Dict[str, Any], int]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    search_term = request.args.get('search', '')
-
-    if search_term:
-        # Join with users table to get username for search
-        withdrawals = cursor.execute(
-            """
-            SELECT w.*, u.username, u.first_name
-            FROM withdrawals w
-            JOIN users u ON w.user_id = u.id
-            WHERE u.username LIKE ? OR w.ton_wallet_address LIKE ?
-            """,
-            (f"%{search_term}%", f"%{search_term}%")
-        ).fetchall()
-    else:
-        withdrawals = cursor.execute(
-            """
-            SELECT w.*, u.username, u.first_name
-            FROM withdrawals w
-            JOIN users u ON w.user_id = u.id
-            """
-        ).fetchall()
-    
-    conn.close()
-    return jsonify({"success": True, "withdrawals": [dict(w) for w in withdrawals]}), 200
+    try:
+        withdrawals, next_cursor = repository.list_withdrawals(
+            search=request.args.get('search', ''),
+            status=request.args.get('status') or None,
+            cursor=request.args.get('cursor'),
+            limit=admin_queries.parse_page_size(request.args.get('limit'))
+        )
+    except admin_queries.InvalidQuery as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    return jsonify({"success": True, "withdrawals": withdrawals, "next_cursor": next_cursor}), 200
+
+@app.route('/api/admin/events', methods=['GET'])
+@admin_required
+def admin_events() -> Response:
+    # Server-sent "withdrawal" (new row) and "withdrawal_status" ({ids, status}) events.
+    return event_stream_response([ADMIN_EVENTS_TOPIC])
+
+@app.route('/api/admin/export/<table>', methods=['GET'])
+@admin_required
+def admin_export(table: str) -> tuple[Dict[str, Any], int] | Response:
+    # Streamed in chunks from a dedicated connection; memory stays flat however big the table is.
+    fmt = request.args.get('format', 'ndjson')
+    try:
+        chunks = dbtools.export_rows(store, table, fmt)
+    except dbtools.ToolError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    response = Response(chunks, mimetype=dbtools.MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{table}.{fmt}"'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/api/admin/stats', methods=['GET'])
+@admin_required
+def admin_get_stats() -> tuple[Dict[str, Any], int]:
+    try:
+        limit = min(admin_queries.parse_page_size(request.args.get('limit')), stats.LEADERBOARD_SIZE)
+    except admin_queries.InvalidQuery as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    totals = repository.platform_totals()
+    # Amounts are reported in TON: earned_nano -> earned, withdrawals_<status>_nano -> withdrawals_<status>_amount
+    for name in [name for name in totals if name.endswith('_nano')]:
+        key = name[:-len('_nano')]
+        totals[key + '_amount' if key.startswith('withdrawals_') else key] = ledger.to_ton(totals.pop(name))
+    leaders = {}
+    for board in stats.BOARDS:
+        leaders[board] = [{
+            "id": entry['user_id'],
+            "username": entry['username'],
+            "first_name": entry['first_name'],
+            "earned": ledger.to_ton(entry['earned_nano']),
+            "referral_earned": ledger.to_ton(entry['referral_nano']),
+            "referees": entry['referees']
+        } for entry in leaderboards.top(board, limit)]
+    return jsonify({"success": True, "stats": totals, "top_earners": leaders['earners'],
+                    "top_referrers": leaders['referrers']}), 200
+
+@app.route('/api/admin/payouts', methods=['GET'])
+@admin_required
+def admin_get_payout_queue() -> tuple[Dict[str, Any], int]:
+    # The next batch of pending withdrawals to pay out, oldest first.
+    try:
+        limit = admin_queries.parse_page_size(request.args.get('limit'))
+    except admin_queries.InvalidQuery as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    queue = repository.payout_queue(limit)
+    return jsonify({
+        "success": True,
+        "withdrawals": queue["withdrawals"],
+        "total": ledger.to_ton(queue["total_nano"])
+    }), 200
+
+@app.route('/api/admin/withdrawals/status', methods=['POST'])
+@admin_required
+def admin_update_withdrawal_statuses() -> tuple[Dict[str, Any], int]:
+    data: Dict[str, Any] = request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    if not isinstance(ids, list):
+        return jsonify({"success": False, "message": "ids must be a list"}), 400
+    return _update_withdrawal_statuses(ids, data.get('status'))
 
 @app.route('/api/admin/withdrawals/<int:withdrawal_id>/<status>', methods=['POST'])
 @admin_required
 def admin_update_withdrawal_status(withdrawal_id: int, status: str) -> tuple[Dict[str, Any], int]:
-    if status not in ['completed', 'rejected']:
-        return jsonify({"success": False, "message": "Invalid status"}), 400
+    return _update_withdrawal_statuses([withdrawal_id], status)
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute(
-        "UPDATE withdrawals SET status = ? WHERE id = ?",
-        (status, withdrawal_id)
-    )
-    conn.commit()
-    conn.close()
+def _update_withdrawal_statuses(withdrawal_ids: list, status: Any) -> tuple[Dict[str, Any], int]:
+    # Status changes move money, so they must come from the admin panel's own fetch():
+    # a cross-site form or link can carry the admin's cookie but cannot send a JSON request.
+    if not request.is_json:
+        return jsonify({"success": False, "message": "Expected an application/json request"}), 415
+    try:
+        updated = repository.update_withdrawal_statuses(withdrawal_ids, status)
+    except payouts.WithdrawalError as e:
+        return jsonify({"success": False, "message": str(e)}), e.status_code
+    if updated:
+        event_hub.publish(ADMIN_EVENTS_TOPIC, "withdrawal_status", {"ids": updated, "status": status})
 
     # Optionally, notify the user via Telegram about the withdrawal status change
     # For this, you'd need to fetch user_id from the withdrawal and then their telegram_id
     # This is a future enhancement.
 
-    return jsonify({"success": True, "message": f"Withdrawal {withdrawal_id} marked as {status}"}), 200
+    skipped = sorted(set(withdrawal_ids) - set(updated))
+    return jsonify({
+        "success": True,
+        "message": f"{len(updated)} withdrawal(s) marked as {status}",
+        "updated": updated,
+        "skipped": skipped # Unknown ids and withdrawals that were no longer pending
+    }), 200
 
 @app.after_request
 def add_security_headers(response):
     response.headers['Content-Security-Policy'] = "frame-ancestors 'self' https://oauth.telegram.org http://127.0.0.1:5000;"
     return response
+
+# --- Instrumentation (opt-in with METRICS_ENABLED=1, see instrumentation.py) ---
+if instrumentation.METRICS_ENABLED:
+    @app.before_request
+    def start_request_metrics() -> None:
+        instrumentation.start_request()
+
+    @app.after_request
+    def record_request_metrics(response):
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        server_timing = instrumentation.finish_request(route, request.method, response.status_code)
+        if server_timing:
+            response.headers['Server-Timing'] = server_timing
+        return response
+
+    @app.teardown_request
+    def discard_request_metrics(exc: Optional[BaseException] = None) -> None:
+        # after_request is skipped when an exception propagates (e.g. in testing); record it as a 500.
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        instrumentation.finish_request(route, request.method, 500)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        # Per-route traffic and SQL timings are never public: without a token there is no endpoint.
+        if not instrumentation.METRICS_TOKEN:
+            return jsonify({"success": False, "message": "Not found"}), 404
+        expected = f"Bearer {instrumentation.METRICS_TOKEN}".encode("utf-8")
+        if not hmac.compare_digest(request.headers.get('Authorization', '').encode("utf-8", "surrogateescape"), expected):
+            return jsonify({"success": False, "message": "Unauthorized"}), 401
+        response = make_response(instrumentation.render_metrics())
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return response
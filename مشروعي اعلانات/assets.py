@@ -0,0 +1,292 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import threading
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from flask import Flask, Response, request
+
+try:
+    import brotli # Optional: without it only gzip variants are produced
+except ImportError:
+    brotli = None
+
+# --- Configuration ---
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(APP_DIR, "static")
+TEMPLATES_DIR = os.path.join(APP_DIR, "templates")
+DIST_DIR = os.path.join(STATIC_DIR, "dist") # Written by build_static.py
+MANIFEST_NAME = "manifest.json"
+
+ASSET_FILES = ("style.css", "script.js", "admin_script.js")
+# Pages whose HTML only depends on configuration, rendered once instead of per request.
+STATIC_PAGES = {
+    "index": "index.html",
+    "about": "about.html",
+    "whitepaper": "whitepaper.html",
+    "privacy_policy": "privacy_policy.html",
+    "dashboard": "dashboard.html",
+}
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable" # Names change whenever content does
+PAGE_CACHE_CONTROL = "public, no-cache" # Revalidated with the ETag, so a deploy shows up at once
+MIN_COMPRESS_BYTES = 512
+
+
+class CompiledFile(NamedTuple):
+    body: bytes
+    gzip: Optional[bytes]
+    brotli: Optional[bytes]
+    etag: str
+    mimetype: str
+
+
+# --- Minification ---
+_CSS_STRING = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')')
+
+
+def minify_css(source: str) -> str:
+    source = re.sub(r"/\*.*?\*/", "", source, flags=re.S)
+    parts = _CSS_STRING.split(source)
+    for i in range(0, len(parts), 2): # Odd indexes are string literals, left untouched
+        part = re.sub(r"\s+", " ", parts[i])
+        part = re.sub(r"\s*([{};,>])\s*", r"\1", part)
+        parts[i] = part.replace(";}", "}")
+    return "".join(parts).strip()
+
+
+def minify_js(source: str) -> str:
+    """Drops comments, indentation and blank lines; line breaks are kept, so
+    automatic semicolon insertion behaves exactly as in the source."""
+    out: List[str] = []
+    i, length = 0, len(source)
+    last_significant = ""
+    while i < length:
+        char = source[i]
+        if char in "'\"`":
+            end = i + 1
+            while end < length and source[end] != char:
+                end += 2 if source[end] == "\\" else 1
+            out.append(source[i:end + 1])
+            i = end + 1
+            last_significant = char
+        elif source.startswith("//", i):
+            end = source.find("\n", i)
+            i = length if end == -1 else end
+        elif source.startswith("/*", i):
+            end = source.find("*/", i + 2)
+            i = length if end == -1 else end + 2
+        elif char == "/" and (not last_significant or last_significant in "(,=:[!&|?{};"):
+            # A regex literal, copied verbatim (including any // inside it)
+            end, in_class = i + 1, False
+            while end < length and (source[end] != "/" or in_class):
+                if source[end] == "\\":
+                    end += 1
+                elif source[end] == "[":
+                    in_class = True
+                elif source[end] == "]":
+                    in_class = False
+                end += 1
+            out.append(source[i:end + 1])
+            i = end + 1
+            last_significant = "/"
+        else:
+            out.append(char)
+            if not char.isspace():
+                last_significant = char
+            i += 1
+    lines = (line.strip() for line in "".join(out).splitlines())
+    return "\n".join(line for line in lines if line) + "\n"
+
+
+MINIFIERS: Dict[str, Callable[[str], str]] = {".css": minify_css, ".js": minify_js}
+
+
+# --- Compilation ---
+def compile_file(body: bytes, mimetype: str) -> CompiledFile:
+    gzipped = brotlied = None
+    if len(body) >= MIN_COMPRESS_BYTES:
+        gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+        if brotli is not None:
+            brotlied = brotli.compress(body, quality=11)
+    return CompiledFile(body, gzipped, brotlied, hashlib.sha1(body).hexdigest()[:20], mimetype)
+
+
+def hashed_name(filename: str, body: bytes) -> str:
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}.{hashlib.sha256(body).hexdigest()[:12]}{ext}"
+
+
+def source_fingerprint() -> str:
+    # Detects a dist/ that was built from older sources than the ones deployed.
+    digest = hashlib.sha256()
+    for directory, names in ((STATIC_DIR, ASSET_FILES), (TEMPLATES_DIR, sorted(STATIC_PAGES.values()))):
+        for name in names:
+            with open(os.path.join(directory, name), "rb") as f:
+                digest.update(name.encode("utf-8") + b"\0" + f.read())
+    return digest.hexdigest()
+
+
+class AssetPipeline:
+    """Fingerprinted, minified and precompressed assets plus pre-rendered pages.
+
+    Uses the output of build_static.py when it matches the current sources and
+    otherwise compiles everything in memory on first use, so a deployment that
+    skipped the build step still gets the same URLs and headers.
+    """
+
+    def __init__(self, app: Flask) -> None:
+        self._app = app
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._manifest: Dict[str, str] = {} # "style.css" -> "style.<hash>.css"
+        self._assets: Dict[str, CompiledFile] = {} # keyed by hashed name
+        self._pages: Dict[str, CompiledFile] = {}
+        self._render_page: Optional[Callable[[str], str]] = None
+
+    # --- Flask integration ---
+    def init_app(self, render_page: Callable[[str], str]) -> None:
+        self._render_page = render_page
+        self._app.url_defaults(self._hashed_static_url)
+        self._app.add_url_rule("/static/dist/<path:filename>", "hashed_static", self._serve_asset)
+
+    def _hashed_static_url(self, endpoint: str, values: Dict[str, str]) -> None:
+        # Every url_for('static', filename='style.css') in the templates gets the fingerprinted name.
+        if endpoint == "static" and values.get("filename") in ASSET_FILES:
+            self._load()
+            hashed = self._manifest.get(values["filename"])
+            if hashed is not None:
+                values["filename"] = f"dist/{hashed}"
+
+    def _serve_asset(self, filename: str) -> Response:
+        self._load()
+        compiled = self._assets.get(filename)
+        if compiled is None:
+            return Response("Not Found", status=404)
+        return send_compiled(compiled, IMMUTABLE_CACHE_CONTROL)
+
+    def page(self, endpoint: str) -> Response:
+        compiled = self._pages.get(endpoint)
+        if compiled is None:
+            self._load()
+            with self._lock:
+                compiled = self._pages.get(endpoint)
+                if compiled is None:
+                    # Rendered inside the current request, once per process.
+                    html = self._render_page(STATIC_PAGES[endpoint]).encode("utf-8")
+                    compiled = self._pages[endpoint] = compile_file(html, "text/html")
+        return send_compiled(compiled, PAGE_CACHE_CONTROL)
+
+    # --- Building ---
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            if not self._load_dist():
+                self._compile_assets()
+            self._loaded = True
+
+    def _compile_assets(self) -> None:
+        for filename in ASSET_FILES:
+            with open(os.path.join(STATIC_DIR, filename), "rb") as f:
+                source = f.read()
+            minify = MINIFIERS.get(os.path.splitext(filename)[1])
+            body = minify(source.decode("utf-8")).encode("utf-8") if minify else source
+            name = hashed_name(filename, body)
+            self._manifest[filename] = name
+            self._assets[name] = compile_file(body, _mimetype(filename))
+
+    def _load_dist(self) -> bool:
+        try:
+            with open(os.path.join(DIST_DIR, MANIFEST_NAME)) as f:
+                manifest = json.load(f)
+            if manifest.get("sources") != source_fingerprint():
+                print("static/dist is out of date; compiling assets in memory (run build_static.py)")
+                return False
+            for filename, name in manifest["assets"].items():
+                self._manifest[filename] = name
+                self._assets[name] = _read_compiled(os.path.join(DIST_DIR, name), _mimetype(filename))
+            for endpoint, name in manifest["pages"].items():
+                self._pages[endpoint] = _read_compiled(os.path.join(DIST_DIR, name), "text/html")
+        except (OSError, ValueError, KeyError):
+            self._manifest.clear()
+            self._assets.clear()
+            self._pages.clear()
+            return False
+        return True
+
+    def build(self, out_dir: str = DIST_DIR) -> Dict[str, object]:
+        """Compiles assets and renders every static page into ``out_dir``; returns the manifest."""
+        with self._lock:
+            self._manifest.clear()
+            self._assets.clear()
+            self._pages.clear()
+            self._compile_assets()
+            self._loaded = True
+        pages: Dict[str, str] = {}
+        for endpoint, template in STATIC_PAGES.items():
+            with self._app.test_request_context("/"):
+                html = self._render_page(template).encode("utf-8")
+            self._pages[endpoint] = compile_file(html, "text/html")
+            pages[endpoint] = f"pages/{endpoint}.html"
+
+        os.makedirs(os.path.join(out_dir, "pages"), exist_ok=True)
+        for name, compiled in list(self._assets.items()) + [(pages[e], c) for e, c in self._pages.items()]:
+            _write_compiled(os.path.join(out_dir, name), compiled)
+        manifest = {"sources": source_fingerprint(), "assets": dict(self._manifest), "pages": pages}
+        with open(os.path.join(out_dir, MANIFEST_NAME), "w") as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+
+# --- Responses ---
+def send_compiled(compiled: CompiledFile, cache_control: str) -> Response:
+    if compiled.etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        body, encoding = _negotiate(compiled)
+        response = Response(body, mimetype=compiled.mimetype)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(compiled.etag)
+    response.headers["Cache-Control"] = cache_control
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def _negotiate(compiled: CompiledFile) -> Tuple[bytes, Optional[str]]:
+    accepted = request.accept_encodings
+    if compiled.brotli is not None and accepted["br"]:
+        return compiled.brotli, "br"
+    if compiled.gzip is not None and accepted["gzip"]:
+        return compiled.gzip, "gzip"
+    return compiled.body, None
+
+
+def _mimetype(filename: str) -> str:
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def _read_compiled(path: str, mimetype: str) -> CompiledFile:
+    with open(path, "rb") as f:
+        body = f.read()
+    variants = []
+    for suffix in (".gz", ".br"):
+        try:
+            with open(path + suffix, "rb") as f:
+                variants.append(f.read())
+        except FileNotFoundError:
+            variants.append(None)
+    return CompiledFile(body, variants[0], variants[1], hashlib.sha1(body).hexdigest()[:20], mimetype)
+
+
+def _write_compiled(path: str, compiled: CompiledFile) -> None:
+    for suffix, data in (("", compiled.body), (".gz", compiled.gzip), (".br", compiled.brotli)):
+        if data is not None:
+            with open(path + suffix, "wb") as f:
+                f.write(data)
@@ -0,0 +1,30 @@
+# gunicorn settings used by benchmarks/run.py; the worker count and bind
+# address are passed on the command line.
+import json
+import os
+
+# Each open event stream (/api/events, /api/admin/events) holds its request for
+# minutes; gevent serves them as greenlets instead of pinning a worker thread each.
+worker_class = os.environ.get("BENCH_WORKER_CLASS", "gevent")
+if worker_class == "gevent":
+    # Patched before the app is preloaded, so its locks, events and threads are cooperative.
+    from gevent import monkey
+    monkey.patch_all()
+
+from benchmarks import lock_stats
+
+lock_stats.install() # Before the app is preloaded, so every worker counts lock waits
+
+# Preloading imports the app once in the master instead of once per worker.
+preload_app = True
+threads = int(os.environ.get("BENCH_THREADS", "4")) # gthread only
+worker_connections = int(os.environ.get("BENCH_WORKER_CONNECTIONS", "1000")) # gevent only
+accesslog = None
+loglevel = "warning"
+
+
+def worker_exit(server, worker) -> None:
+    stats_dir = os.environ.get("BENCH_STATS_DIR")
+    if stats_dir:
+        with open(os.path.join(stats_dir, f"{os.getpid()}.json"), "w") as f:
+            json.dump(lock_stats.snapshot(), f)
@@ -0,0 +1,91 @@
+"""Cold-import budget for the serverless entry point.
+
+Imports wsgi.py in fresh interpreters with ``-X importtime``, prints the
+slowest modules and exits non-zero when the median import time exceeds the
+budget or when a module that must stay lazy was imported:
+
+    python benchmarks/import_budget.py --runs 5 --budget-ms 350
+
+tests/test_import_budget.py runs the same checks under pytest.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Only needed by the webhook bot and the Telegram sender, both loaded on first use.
+LAZY_MODULES = ("telegram", "requests", "httpx", "asyncio")
+DEFAULT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", "350"))
+DEFAULT_RUNS = int(os.environ.get("IMPORT_BUDGET_RUNS", "5"))
+
+
+def import_once() -> Tuple[Dict[str, int], List[str]]:
+    # Returns the cumulative import time (us) per module and the lazy modules that got imported.
+    env = {
+        **os.environ,
+        "PYTHONPATH": PROJECT_DIR,
+        "PYTHONDONTWRITEBYTECODE": "",
+        "TELEGRAM_BOT_TOKEN": os.environ.get("TELEGRAM_BOT_TOKEN", "123456:budget"),
+        "TELEGRAM_ADMIN_ID": os.environ.get("TELEGRAM_ADMIN_ID", "1"),
+        "FLASK_SECRET_KEY": os.environ.get("FLASK_SECRET_KEY", "budget-secret-key"),
+    }
+    check = f"import sys, wsgi; print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", check],
+        cwd=PROJECT_DIR, env=env, capture_output=True, text=True, check=True
+    )
+    cumulative: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        # "import time:  self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, module = line[len("import time:"):].split("|")
+        cumulative[module.strip()] = int(cumulative_us)
+    loaded = [name for name in result.stdout.strip().split(",") if name]
+    return cumulative, loaded
+
+
+def measure(runs: int) -> Tuple[List[float], Dict[str, List[int]], List[str]]:
+    # Returns the wsgi import time (ms) of each run, every module's samples (us) and the lazy modules loaded.
+    totals: List[float] = []
+    slowest: Dict[str, List[int]] = {}
+    loaded: List[str] = []
+    for _ in range(runs):
+        cumulative, lazy = import_once()
+        totals.append(cumulative.get("wsgi", 0) / 1000)
+        for module, micros in cumulative.items():
+            slowest.setdefault(module, []).append(micros)
+        loaded.extend(name for name in lazy if name not in loaded)
+    return totals, slowest, loaded
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS)
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--top", type=int, default=15, help="slowest modules to list")
+    args = parser.parse_args()
+
+    totals, slowest, loaded = measure(args.runs)
+    print(f"{'module':<40} {'median ms':>10}")
+    ranked = sorted(slowest.items(), key=lambda item: statistics.median(item[1]), reverse=True)
+    for module, samples in ranked[:args.top]:
+        print(f"{module:<40} {statistics.median(samples) / 1000:>10.1f}")
+
+    median = statistics.median(totals)
+    print(f"\nimport wsgi: median {median:.1f} ms over {args.runs} runs (budget {args.budget_ms:.0f} ms)")
+    failures = []
+    if median > args.budget_ms:
+        failures.append(f"cold import took {median:.1f} ms, over the {args.budget_ms:.0f} ms budget")
+    if loaded:
+        failures.append(f"modules that must be imported lazily were loaded: {', '.join(loaded)}")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
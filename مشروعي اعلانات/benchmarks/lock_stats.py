@@ -0,0 +1,79 @@
+import sqlite3
+import threading
+import time
+from typing import Any, Dict
+
+import db
+
+# SQLite's own busy handler waits silently, so benchmarked connections run
+# with busy_timeout=0 and wait here instead, counting every time a statement
+# found the database locked. The total wait budget is the same as db.py's.
+SQLITE_BUSY = 5
+RETRY_SLEEP_SEC = 0.001
+
+_stats = {"lock_waits": 0, "lock_wait_ms": 0.0, "lock_timeouts": 0}
+_stats_lock = threading.Lock()
+
+
+def _retry_busy(run, *args: Any) -> Any:
+    started = None
+    while True:
+        try:
+            result = run(*args)
+        except sqlite3.OperationalError as e:
+            if getattr(e, 'sqlite_errorcode', None) != SQLITE_BUSY:
+                raise # Includes SQLITE_BUSY_SNAPSHOT, which waiting cannot fix
+            if started is None:
+                started = time.perf_counter()
+                with _stats_lock:
+                    _stats["lock_waits"] += 1
+            elif time.perf_counter() - started > db.BUSY_TIMEOUT_MS / 1000:
+                with _stats_lock:
+                    _stats["lock_timeouts"] += 1
+                    _stats["lock_wait_ms"] += (time.perf_counter() - started) * 1000
+                raise
+            time.sleep(RETRY_SLEEP_SEC)
+            continue
+        if started is not None:
+            with _stats_lock:
+                _stats["lock_wait_ms"] += (time.perf_counter() - started) * 1000
+        return result
+
+
+class LockCountingCursor(sqlite3.Cursor):
+    def execute(self, *args: Any) -> sqlite3.Cursor:
+        return _retry_busy(super().execute, *args)
+
+    def executemany(self, *args: Any) -> sqlite3.Cursor:
+        return _retry_busy(super().executemany, *args)
+
+
+class LockCountingConnection(db.PooledConnection):
+    def cursor(self, factory: Any = LockCountingCursor) -> sqlite3.Cursor:
+        return super().cursor(factory)
+
+    def execute(self, *args: Any) -> sqlite3.Cursor:
+        if args and args[0].lstrip().upper().startswith("PRAGMA BUSY_TIMEOUT"):
+            args = ("PRAGMA busy_timeout=0",) + args[1:]
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args: Any) -> sqlite3.Cursor:
+        return self.cursor().executemany(*args)
+
+    def commit(self) -> None:
+        _retry_busy(super().commit)
+
+
+def install() -> None:
+    """Makes db.get_db_connection() hand out lock-counting connections from now on."""
+    db.use_connection_class(LockCountingConnection)
+
+
+def snapshot() -> Dict[str, Any]:
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset() -> None:
+    with _stats_lock:
+        _stats.update(lock_waits=0, lock_wait_ms=0.0, lock_timeouts=0)
@@ -0,0 +1,345 @@
+"""Load test for the API hot paths.
+
+Seeds a throwaway copy of the database, starts a local Telegram stub and
+drives the endpoints through the Flask test client, a local gunicorn, or both:
+
+    python benchmarks/run.py --users 20000 --requests 2000 --concurrency 16 --workers 4
+
+Reports p50/p95/p99 latency, throughput and SQLite lock waits per endpoint.
+``--json`` writes the same numbers to a file to compare against a baseline.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = "123456:benchmark"
+ADMIN_TELEGRAM_ID = 1
+
+PHASES = ("login", "user_data", "view_ad", "withdraw", "admin_users", "admin_withdrawals", "admin_search")
+
+
+# --- Targets ---
+class TestClientTarget:
+    name = "testclient"
+
+    def __init__(self, app) -> None:
+        self._app = app
+
+    def client(self) -> Any:
+        return self._app.test_client()
+
+    def request(self, client: Any, method: str, path: str, payload: Optional[Dict[str, Any]] = None) -> int:
+        return client.open(path, method=method, json=payload).status_code
+
+    def fetch_json(self, client: Any, method: str, path: str) -> Dict[str, Any]:
+        return client.open(path, method=method).get_json()
+
+
+class HttpTarget:
+    name = "gunicorn"
+
+    def __init__(self, base_url: str) -> None:
+        self._base_url = base_url
+
+    def client(self) -> Any:
+        import requests
+        return requests.Session()
+
+    def request(self, client: Any, method: str, path: str, payload: Optional[Dict[str, Any]] = None) -> int:
+        return client.request(method, self._base_url + path, json=payload, timeout=30).status_code
+
+    def fetch_json(self, client: Any, method: str, path: str) -> Dict[str, Any]:
+        return client.request(method, self._base_url + path, timeout=30).json()
+
+
+# --- Scenarios ---
+def login_payload(telegram_id: int) -> Dict[str, Any]:
+    # Same check string and secret as /api/login.
+    data = {"id": telegram_id, "first_name": f"User{telegram_id}", "auth_date": int(time.time())}
+    check_string = "\n".join(f"{key}={data[key]}" for key in sorted(data))
+    secret_key = hashlib.sha256(BOT_TOKEN.encode("utf-8")).digest()
+    data["hash"] = hmac.new(secret_key, check_string.encode("utf-8"), hashlib.sha256).hexdigest()
+    return data
+
+
+def build_scenarios(target, telegram_ids: Dict[str, List[int]]) -> Dict[str, Callable[[int], Callable[[], int]]]:
+    # Each scenario takes a request number and returns the timed call; any
+    # setup (logging in a fresh user) happens before the clock starts.
+    all_ids = telegram_ids["all"]
+    eligible = list(telegram_ids["eligible"])
+    eligible_lock = threading.Lock()
+    local = threading.local()
+
+    def logged_in_client() -> Any:
+        # One session per thread, like a browser tab that stays logged in.
+        if getattr(local, "client", None) is None:
+            local.client = target.client()
+            target.request(local.client, "POST", "/api/login", login_payload(random.choice(all_ids)))
+        return local.client
+
+    def admin_client() -> Any:
+        if getattr(local, "admin", None) is None:
+            local.admin = target.client()
+            target.request(local.admin, "POST", "/api/login", login_payload(ADMIN_TELEGRAM_ID))
+        return local.admin
+
+    def login(n: int) -> Callable[[], int]:
+        client = target.client()
+        payload = login_payload(all_ids[n % len(all_ids)])
+        return lambda: target.request(client, "POST", "/api/login", payload)
+
+    def withdraw(n: int) -> Callable[[], int]:
+        # Every withdrawal comes from a different user with a withdrawable balance.
+        with eligible_lock:
+            telegram_id = eligible.pop() if eligible else random.choice(all_ids)
+        client = target.client()
+        target.request(client, "POST", "/api/login", login_payload(telegram_id))
+        wallet = "UQ" + hashlib.sha1(str(telegram_id).encode()).hexdigest()[:46].ljust(46, "A")
+        return lambda: target.request(client, "POST", "/api/withdraw", {"tonWalletAddress": wallet})
+
+    def view_ad(n: int) -> Callable[[], int]:
+        client = logged_in_client()
+        ticket = target.fetch_json(client, "POST", "/api/ad/start")["ticket"]
+        return lambda: target.request(client, "POST", "/api/view_ad", {"ticket": ticket})
+
+    def simple(method: str, path: str, client_factory: Callable[[], Any]) -> Callable[[int], Callable[[], int]]:
+        def scenario(n: int) -> Callable[[], int]:
+            client = client_factory()
+            return lambda: target.request(client, method, path)
+        return scenario
+
+    return {
+        "login": login,
+        "user_data": simple("GET", "/api/user_data", logged_in_client),
+        "view_ad": view_ad,
+        "withdraw": withdraw,
+        "admin_users": simple("GET", "/api/admin/users?sort=earnings&order=desc", admin_client),
+        "admin_withdrawals": simple("GET", "/api/admin/withdrawals?status=pending", admin_client),
+        "admin_search": simple("GET", "/api/admin/users?search=user_1", admin_client),
+    }
+
+
+# --- Measurement ---
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def run_phase(scenario: Callable[[int], Callable[[], int]], requests_count: int, concurrency: int) -> Dict[str, Any]:
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {"2xx": 0, "3xx": 0, "4xx": 0, "5xx": 0, "error": 0}
+    lock = threading.Lock()
+
+    def one(n: int) -> None:
+        try:
+            call = scenario(n)
+            started = time.perf_counter()
+            status = call()
+            elapsed = time.perf_counter() - started
+        except Exception as e:
+            print(f"Benchmark request failed: {e}")
+            with lock:
+                statuses["error"] += 1
+            return
+        with lock:
+            latencies.append(elapsed * 1000)
+            statuses[f"{status // 100}xx"] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(requests_count)))
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": requests_count,
+        "statuses": statuses,
+        "throughput_rps": requests_count / wall if wall else 0.0,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+    }
+
+
+def print_report(target_name: str, results: Dict[str, Dict[str, Any]], lock_totals: Dict[str, Any]) -> None:
+    print(f"\n== {target_name} ==")
+    print(f"{'endpoint':<18} {'req':>6} {'2xx/3xx':>8} {'4xx':>5} {'5xx':>5} {'rps':>9} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'lock waits':>11}")
+    for phase, result in results.items():
+        statuses = result["statuses"]
+        lock_waits = result.get("lock_waits", "-")
+        print(f"{phase:<18} {result['requests']:>6} {statuses['2xx'] + statuses['3xx']:>8} {statuses['4xx']:>5} "
+              f"{statuses['5xx'] + statuses['error']:>5} {result['throughput_rps']:>9.1f} {result['p50_ms']:>8.2f} "
+              f"{result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} {lock_waits:>11}")
+    print(f"SQLite lock waits: {lock_totals['lock_waits']} ({lock_totals['lock_wait_ms']:.1f} ms waiting, "
+          f"{lock_totals['lock_timeouts']} timed out)")
+
+
+# --- Runners ---
+def run_testclient(args: argparse.Namespace, telegram_ids: Dict[str, List[int]]) -> Dict[str, Any]:
+    import app as app_module
+    import lock_stats
+
+    target = TestClientTarget(app_module.app)
+    scenarios = build_scenarios(target, telegram_ids)
+    lock_stats.reset()
+    results = {}
+    for phase in args.phases:
+        before = lock_stats.snapshot()["lock_waits"]
+        results[phase] = run_phase(scenarios[phase], args.requests, args.concurrency)
+        results[phase]["lock_waits"] = lock_stats.snapshot()["lock_waits"] - before
+    # Write out pending credits and stop the background threads before the database is replaced.
+    app_module.ad_views.stop()
+    app_module.telegram_outbox.stop()
+    totals = lock_stats.snapshot()
+    print_report(target.name, results, totals)
+    return {"phases": results, "lock_stats": totals}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_gunicorn(args: argparse.Namespace, telegram_ids: Dict[str, List[int]], env: Dict[str, str]) -> Dict[str, Any]:
+    import requests
+
+    port = _free_port()
+    stats_dir = tempfile.mkdtemp(prefix="bench-locks-")
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", os.path.join("benchmarks", "gunicorn_conf.py"),
+         "-w", str(args.workers), "-b", f"127.0.0.1:{port}", "wsgi:app"],
+        cwd=PROJECT_DIR,
+        env={**env, "BENCH_WORKER_CLASS": args.worker_class, "BENCH_THREADS": str(args.threads),
+             "BENCH_STATS_DIR": stats_dir}
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                requests.get(base_url + "/", timeout=1)
+                break
+            except requests.ConnectionError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    raise RuntimeError("gunicorn did not start")
+                time.sleep(0.2)
+
+        target = HttpTarget(base_url)
+        scenarios = build_scenarios(target, telegram_ids)
+        results = {phase: run_phase(scenarios[phase], args.requests, args.concurrency) for phase in args.phases}
+    finally:
+        process.terminate() # Workers write their lock counts on exit
+        process.wait(timeout=30)
+
+    # Lock waits are only collected per worker lifetime, so gunicorn reports a run total.
+    totals = {"lock_waits": 0, "lock_wait_ms": 0.0, "lock_timeouts": 0}
+    for name in os.listdir(stats_dir):
+        with open(os.path.join(stats_dir, name)) as f:
+            for key, value in json.load(f).items():
+                totals[key] += value
+    shutil.rmtree(stats_dir, ignore_errors=True)
+    per_worker = f"{args.threads} threads" if args.worker_class == "gthread" else args.worker_class
+    print_report(f"{target.name} ({args.workers} workers x {per_worker})", results, totals)
+    return {"phases": results, "lock_stats": totals}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--referral-ratio", type=float, default=0.5, help="share of users with a referrer")
+    parser.add_argument("--withdrawals", type=int, default=5000)
+    parser.add_argument("--requests", type=int, default=1000, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8, help="client threads")
+    parser.add_argument("--mode", choices=("testclient", "gunicorn", "both"), default="both")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--worker-class", choices=("gevent", "gthread"), default="gevent", help="gunicorn worker class")
+    parser.add_argument("--threads", type=int, default=4, help="threads per gthread worker")
+    parser.add_argument("--phases", nargs="+", choices=PHASES, default=list(PHASES))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", help="seed this file instead of a temporary one (it is overwritten)")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+    db_path = os.path.abspath(args.db or os.path.join(work_dir, "smartcoinlabs.db"))
+
+    # app.py and its modules read their configuration at import time.
+    sys.path.insert(0, PROJECT_DIR)
+    from telegram_stub import start_telegram_stub
+    stub, stub_url = start_telegram_stub()
+    env = {
+        **os.environ,
+        "PYTHONPATH": PROJECT_DIR,
+        "DATABASE_PATH": db_path,
+        "TELEGRAM_API_URL": stub_url,
+        "TELEGRAM_BOT_TOKEN": BOT_TOKEN,
+        "FLASK_SECRET_KEY": "benchmark-secret-key",
+        "TELEGRAM_ADMIN_ID": str(ADMIN_TELEGRAM_ID),
+        "TELEGRAM_ADMIN_CHAT_ID": str(ADMIN_TELEGRAM_ID),
+        # Measure the crediting path itself rather than the anti-fraud throttle.
+        "AD_MIN_WATCH_SEC": "0",
+        "VIEW_AD_USER_RATE_PER_MIN": "1e9",
+        "VIEW_AD_USER_BURST": "1000000",
+        "VIEW_AD_IP_RATE_PER_MIN": "1e9",
+        "VIEW_AD_IP_BURST": "1000000",
+    }
+    os.environ.update(env)
+
+    import lock_stats
+    lock_stats.install()
+
+    report: Dict[str, Any] = {"config": {k: v for k, v in vars(args).items() if k != "json"}}
+    # Each target starts from the same freshly seeded database.
+    if args.mode in ("testclient", "both"):
+        report["testclient"] = run_testclient(args, prepare_database(args))
+    if args.mode in ("gunicorn", "both"):
+        report["gunicorn"] = run_gunicorn(args, prepare_database(args), env)
+    print(f"\nTelegram stub received {stub.calls} API calls")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def prepare_database(args: argparse.Namespace) -> Dict[str, List[int]]:
+    import app as app_module
+    from db import close_all_connections
+    from seed import seed_database
+
+    close_all_connections()
+    for path in app_module.store.paths: # DATABASE_PATH, or its shard files under STORAGE_BACKEND=sharded
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    started = time.perf_counter()
+    app_module.init_db()
+    telegram_ids = seed_database(app_module.store, args.users, args.referral_ratio,
+                                 args.withdrawals, random.Random(args.seed))
+    # Don't hold connections (and WAL read marks) open while gunicorn works.
+    close_all_connections()
+    print(f"Seeded {args.users} users and {args.withdrawals} withdrawals into {', '.join(app_module.store.paths)} "
+          f"in {time.perf_counter() - started:.1f}s")
+    return telegram_ids
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import random
+from collections import defaultdict
+from typing import Dict, List
+
+import ledger
+import stats
+import storage
+
+# Seeded users get telegram_id = TELEGRAM_ID_BASE + n (+ a shard offset), so the benchmark can log them in.
+TELEGRAM_ID_BASE = 7_000_000_000
+
+
+def seed_database(store: storage.SQLiteStorage, users: int, referral_ratio: float,
+                  withdrawals: int, rng: random.Random) -> Dict[str, List[int]]:
+    """Fills an initialised, empty ``store`` and returns the telegram ids the scenarios use.
+
+    Rows are written to the shard the app routes them to: a user and its
+    withdrawals to store.shard_of(id). ``eligible`` users have viewed enough
+    ads and hold a balance, so their first withdrawal succeeds.
+    """
+    # telegram_id and id share a shard, as for users created by a login, so a
+    # login finds the user on the first shard it looks at.
+    offset = (1 - TELEGRAM_ID_BASE) % store.shard_count
+    user_rows = []
+    for n in range(users):
+        user_id = n + 1
+        telegram_id = TELEGRAM_ID_BASE + n + offset
+        referrer_id = rng.randint(1, n) if n and rng.random() < referral_ratio else None
+        user_rows.append((
+            user_id, telegram_id, f"User{n}", f"user_{n}", rng.randint(0, 120),
+            f"REF{telegram_id}", referrer_id
+        ))
+    balances = [(rng.randint(1, ledger.to_nano(2.0)), row[0]) for row in user_rows]
+
+    statuses = ('pending', 'pending', 'completed', 'rejected')
+    withdrawal_rows = []
+    for _ in range(withdrawals):
+        user_id = rng.randint(1, users)
+        amount_nano = rng.randint(ledger.to_nano(0.01), ledger.to_nano(1.0))
+        prefix = rng.choice(('UQ', 'EQ'))
+        wallet = prefix + ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_-')
+                                  for _ in range(46))
+        withdrawal_rows.append((user_id, ledger.to_ton(amount_nano), amount_nano, wallet, rng.choice(statuses)))
+
+    by_shard = defaultdict(list)
+    for row in user_rows:
+        by_shard[store.shard_of(row[0])].append(row)
+    # The insert trigger only counts referees stored with their referrer (see stats.py).
+    cross_shard_referees: Dict[int, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+    for row in user_rows:
+        if row[6] is not None and store.shard_of(row[6]) != store.shard_of(row[0]):
+            cross_shard_referees[store.shard_of(row[6])][row[6]] += 1
+
+    for shard in range(store.shard_count):
+        conn = store.connect(shard)
+        try:
+            conn.executemany(
+                "INSERT INTO users (id, telegram_id, first_name, username, ads_viewed, referral_code, referrer_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                by_shard[shard]
+            )
+            # Balances go straight into the snapshots the users_balance_snapshot trigger created.
+            conn.executemany(
+                "UPDATE balance_snapshots SET balance_nano = ? WHERE user_id = ?",
+                [balance for balance in balances if store.shard_of(balance[1]) == shard]
+            )
+            stats.count_referees(conn, cross_shard_referees[shard])
+            id_column, id_value, id_params = storage.id_insert('withdrawals', store.id_sequence(shard))
+            conn.executemany(
+                f"INSERT INTO withdrawals ({id_column}user_id, amount, amount_nano, ton_wallet_address, status) "
+                f"VALUES ({id_value}?, ?, ?, ?, ?)",
+                [(*id_params, *row) for row in withdrawal_rows if store.shard_of(row[0]) == shard]
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    eligible = [row[1] for row in user_rows if row[4] >= 50]
+    return {"all": [row[1] for row in user_rows], "eligible": eligible}
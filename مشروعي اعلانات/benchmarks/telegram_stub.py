@@ -0,0 +1,34 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Tuple
+
+
+class _TelegramStubHandler(BaseHTTPRequestHandler):
+    # Answers every Bot API method with success, like a Telegram that never rate-limits.
+    protocol_version = "HTTP/1.1" # Keep-alive, as the outbox session expects
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        self.server.calls += 1
+        body = json.dumps({"ok": True, "result": True}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def start_telegram_stub(host: str = "127.0.0.1", port: int = 0) -> Tuple[ThreadingHTTPServer, str]:
+    """Starts the stub on a background thread and returns it with its base URL (for TELEGRAM_API_URL)."""
+    server = ThreadingHTTPServer((host, port), _TelegramStubHandler)
+    server.daemon_threads = True
+    server.calls = 0
+    threading.Thread(target=server.serve_forever, name="telegram-stub", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
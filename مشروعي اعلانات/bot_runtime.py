@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+from outbox import TELEGRAM_API_URL
+
+if TYPE_CHECKING:
+    import asyncio
+    from telegram.ext import Application, BaseHandler, ContextTypes
+
+# --- Configuration ---
+MAX_CONCURRENT_UPDATES = int(os.environ.get("BOT_MAX_CONCURRENT_UPDATES", "16"))
+MAX_QUEUED_UPDATES = int(os.environ.get("BOT_MAX_QUEUED_UPDATES", "1000"))
+SUBMIT_TIMEOUT_SEC = 2.0
+STARTUP_TIMEOUT_SEC = 30.0
+# After a failed start, updates are refused (503, so Telegram redelivers) until this much time has passed.
+STARTUP_RETRY_SEC = float(os.environ.get("BOT_STARTUP_RETRY_SEC", "30"))
+
+
+class BotRuntime:
+    """Runs the webhook bot's Application on a private event loop, once per worker.
+
+    Flask threads hand updates over with ``submit()`` and return immediately;
+    the Application processes up to ``max_concurrent_updates`` of them at a time.
+    python-telegram-bot is only imported (and ``handlers()`` only called) when
+    the first update arrives, so workers that never see one don't load it.
+    One thread starts it; updates that arrive meanwhile, or within
+    ``startup_retry`` seconds of a failed start, are refused at once.
+    """
+
+    def __init__(self, token: str, handlers: Callable[[], List["BaseHandler"]],
+                 max_concurrent_updates: int = MAX_CONCURRENT_UPDATES,
+                 max_queued_updates: int = MAX_QUEUED_UPDATES, startup_retry: float = STARTUP_RETRY_SEC) -> None:
+        self._token = token
+        self._handlers = handlers
+        self._max_concurrent_updates = max_concurrent_updates
+        self._max_queued_updates = max_queued_updates
+        self._startup_retry = startup_retry
+        self._retry_at = 0.0 # time.monotonic() before which a failed start is not retried
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._loop: Optional["asyncio.AbstractEventLoop"] = None
+        self._thread: Optional[threading.Thread] = None
+        self._application: Optional["Application"] = None
+
+    # --- Public API ---
+    def submit(self, data: Dict[str, Any]) -> bool:
+        """Queues one webhook update; False means the worker is saturated or the bot failed to start."""
+        if not self._ensure_started():
+            return False
+        import asyncio
+        from telegram import Update
+
+        update = Update.de_json(data, self._application.bot)
+        future = asyncio.run_coroutine_threadsafe(self._enqueue(update), self._loop)
+        try:
+            return future.result(timeout=SUBMIT_TIMEOUT_SEC)
+        except Exception as e:
+            print(f"Error queueing Telegram update: {e}")
+            return False
+
+    def stop(self) -> None:
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                return
+            import asyncio
+
+            try:
+                asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(timeout=10)
+            except Exception as e:
+                print(f"Error stopping Telegram bot: {e}")
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+            self._loop = None
+
+    # --- Internals ---
+    def _ensure_started(self) -> bool:
+        if self._loop is not None and self._pid == os.getpid():
+            return True
+        if time.monotonic() < self._retry_at:
+            return False
+        if not self._lock.acquire(blocking=False):
+            return False # Another thread is starting it; don't queue up behind its timeout
+        try:
+            # A forked gunicorn worker must not reuse the parent's loop thread.
+            if self._loop is not None and self._pid == os.getpid():
+                return True
+            if time.monotonic() < self._retry_at:
+                return False
+            return self._start()
+        finally:
+            self._lock.release()
+
+    def _start(self) -> bool:
+        # Called with the lock held.
+        import asyncio
+        from telegram.ext import Application
+
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, name="telegram-bot", daemon=True)
+        thread.start()
+        application = (
+            Application.builder()
+            .token(self._token)
+            .base_url(f"{TELEGRAM_API_URL.rstrip('/')}/bot")
+            .updater(None) # Updates arrive through the Flask webhook route
+            .update_queue(asyncio.Queue(maxsize=self._max_queued_updates))
+            .concurrent_updates(self._max_concurrent_updates)
+            .connection_pool_size(self._max_concurrent_updates)
+            .build()
+        )
+        application.add_handlers(self._handlers())
+        application.add_error_handler(self._on_error)
+        try:
+            asyncio.run_coroutine_threadsafe(self._startup(application), loop).result(timeout=STARTUP_TIMEOUT_SEC)
+        except Exception as e:
+            print(f"Error starting Telegram bot (retrying in {self._startup_retry:.0f}s): {e}")
+            loop.call_soon_threadsafe(loop.stop)
+            self._retry_at = time.monotonic() + self._startup_retry
+            return False
+        self._application = application
+        self._loop = loop
+        self._thread = thread
+        self._pid = os.getpid()
+        return True
+
+    @staticmethod
+    async def _startup(application: "Application") -> None:
+        await application.initialize()
+        await application.start()
+
+    async def _shutdown(self) -> None:
+        await self._application.stop()
+        await self._application.shutdown()
+
+    async def _enqueue(self, update: Any) -> bool:
+        import asyncio
+
+        try:
+            self._application.update_queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram redelivers updates that were not acknowledged with 2xx.
+            return False
+        return True
+
+    @staticmethod
+    async def _on_error(update: object, context: "ContextTypes.DEFAULT_TYPE") -> None:
+        print(f"Error handling Telegram update {update}: {context.error}")
@@ -0,0 +1,18 @@
+"""Pre-builds static/dist: fingerprinted, minified and precompressed assets
+plus the pre-rendered public pages. Run before deploying:
+
+    python build_static.py
+
+Without it the app compiles the same output in memory on first use.
+"""
+from app import app, asset_pipeline
+import assets
+
+if __name__ == '__main__':
+    manifest = asset_pipeline.build()
+    if assets.brotli is None:
+        print("brotli is not installed; only gzip variants were written")
+    for source, name in manifest['assets'].items():
+        print(f"{source} -> dist/{name}")
+    for endpoint, name in manifest['pages'].items():
+        print(f"{endpoint} -> dist/{name}")
@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import threading
+import weakref
+from typing import Dict, Optional
+
+# --- Configuration ---
+DATABASE = os.environ.get("DATABASE_PATH", "smartcoinlabs.db")
+BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", "16384"))
+MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+STATEMENT_CACHE_SIZE = 256 # Prepared statements kept per connection
+
+
+class PooledConnection(sqlite3.Connection):
+    """A connection that stays open for reuse by its thread.
+
+    Route handlers keep calling ``conn.close()`` as before; that is a no-op here
+    and the connection is only really closed by ``close_all_connections()``.
+    """
+
+    def close(self) -> None:
+        pass
+
+    def really_close(self) -> None:
+        super().close()
+
+
+_connection_class = PooledConnection
+_local = threading.local()
+_connections: "weakref.WeakSet[PooledConnection]" = weakref.WeakSet()
+_connections_lock = threading.Lock()
+_generation = 0 # Bumped by close_all_connections(), so other threads drop their closed connections
+
+
+def _open_connection(path: Optional[str] = None) -> PooledConnection:
+    # check_same_thread is off only so close_all_connections() can close
+    # connections from the exiting thread; each one is still used by one thread.
+    conn = sqlite3.connect(
+        path or DATABASE,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        factory=_connection_class,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=False
+    )
+    conn.row_factory = sqlite3.Row
+    # WAL lets readers proceed while view_ad()/withdraw() hold the write lock;
+    # synchronous=NORMAL is durable in WAL mode and skips the fsync per commit.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def open_connection(path: Optional[str] = None) -> PooledConnection:
+    # A connection outside the per-thread pool, for long-running work (exports,
+    # backups) that must not hold a request's connection. Close it with really_close().
+    return _open_connection(path)
+
+
+def use_connection_class(connection_class: type) -> None:
+    # Lets instrumentation (or a benchmark) wrap connections opened from now
+    # on; connection_class must subclass PooledConnection.
+    global _connection_class
+    _connection_class = connection_class
+
+
+def get_db_connection(path: Optional[str] = None) -> sqlite3.Connection:
+    # One pooled connection per thread and database file (a sharded store has several).
+    path = path or DATABASE
+    conns: Optional[Dict[str, PooledConnection]] = getattr(_local, "conns", None)
+    if conns is None or _local.generation != _generation:
+        conns = _local.conns = {}
+        _local.generation = _generation
+    conn = conns.get(path)
+    if conn is None:
+        conn = conns[path] = _open_connection(path)
+        with _connections_lock:
+            _connections.add(conn)
+    return conn
+
+
+def release_connection(exc: Optional[BaseException] = None) -> None:
+    # Called at Flask app-context teardown: never hand an open transaction
+    # (and the write lock that comes with it) to the next request.
+    for conn in getattr(_local, "conns", {}).values():
+        if conn.in_transaction:
+            conn.rollback()
+
+
+def close_all_connections() -> None:
+    # Background threads (the ad-view flusher, the event relay) keep running
+    # and open new connections on their next use.
+    global _generation
+    with _connections_lock:
+        connections = list(_connections)
+        _connections.clear()
+        _generation += 1
+    for conn in connections:
+        try:
+            conn.really_close()
+        except sqlite3.Error as e:
+            print(f"Error closing database connection: {e}")
+    _local.__dict__.pop("conns", None)
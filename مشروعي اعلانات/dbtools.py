@@ -0,0 +1,349 @@
+"""Bulk export/import and maintenance for smartcoinlabs.db.
+
+    python dbtools.py export users --format csv -o users.csv
+    python dbtools.py import users users.ndjson
+    python dbtools.py maintain --backup backups/smartcoinlabs.db
+
+Exports stream rows in constant memory (also served by /api/admin/export/<table>),
+imports are batched with executemany, and maintenance only takes short write
+locks, so all of it can run against the live database. Every command works on
+the store configured by STORAGE_BACKEND; exporting from one backend and
+importing into the other is how an existing database is moved onto shards.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sqlite3
+import sys
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, TextIO
+
+import ledger
+import stats
+import storage
+from storage import SQLiteStorage
+
+# --- Configuration ---
+EXPORT_FORMATS = ('ndjson', 'csv')
+EXPORT_CHUNK_ROWS = 1000 # Rows fetched from SQLite, and written out, at a time
+IMPORT_BATCH_ROWS = 5000 # Rows per import transaction; the write lock is released between batches
+INCREMENTAL_VACUUM_PAGES = 1000 # Free pages released per maintenance write transaction
+ANALYSIS_LIMIT = 1000 # Rows sampled per index by PRAGMA optimize
+
+# Users carry their net balance (withdrawals already debited), so a re-imported
+# database has the same balances without replaying the ledger.
+EXPORTS = {
+    'users': (
+        ('id', 'telegram_id', 'first_name', 'last_name', 'username', 'photo_url', 'auth_date',
+         'ads_viewed', 'referral_code', 'referrer_id', 'created_at', 'balance_nano'),
+        "FROM user_balances ORDER BY id"
+    ),
+    'withdrawals': (
+        ('id', 'user_id', 'amount', 'amount_nano', 'ton_wallet_address', 'status', 'created_at'),
+        "FROM withdrawals ORDER BY id"
+    ),
+}
+MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+INTEGER_COLUMNS = {'id', 'telegram_id', 'auth_date', 'ads_viewed', 'referrer_id', 'balance_nano',
+                   'user_id', 'amount_nano'}
+
+
+class ToolError(ValueError):
+    pass
+
+
+def _check_table(table: str) -> Sequence[str]:
+    if table not in EXPORTS:
+        raise ToolError(f"Unknown table {table!r}; expected one of {', '.join(EXPORTS)}")
+    return EXPORTS[table][0]
+
+
+# --- Export ---
+def export_rows(store: SQLiteStorage, table: str, fmt: str = 'ndjson',
+                chunk_rows: int = EXPORT_CHUNK_ROWS) -> Iterator[str]:
+    """Yields ``table`` as NDJSON or CSV text, ``chunk_rows`` rows per chunk.
+
+    Runs on its own connection, so it can be streamed after the request that
+    started it has ended; the single SELECT reads one consistent snapshot (of
+    each shard in turn) and, under WAL, never blocks writers.
+    """
+    columns = _check_table(table)
+    if fmt not in EXPORT_FORMATS:
+        raise ToolError(f"Unknown format {fmt!r}; expected one of {', '.join(EXPORT_FORMATS)}")
+    return _export(store, table, columns, fmt, chunk_rows)
+
+
+def _export(store: SQLiteStorage, table: str, columns: Sequence[str], fmt: str, chunk_rows: int) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    if fmt == 'csv':
+        writer.writerow(columns)
+    for shard in range(store.shard_count):
+        conn = store.open_connection(shard)
+        try:
+            cursor = conn.execute(f"SELECT {', '.join(columns)} {EXPORTS[table][1]}")
+            while True:
+                rows = cursor.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                if fmt == 'csv':
+                    writer.writerows(rows)
+                else:
+                    for row in rows:
+                        buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+                        buffer.write('\n')
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        finally:
+            conn.really_close()
+    if fmt == 'csv' and buffer.tell():
+        yield buffer.getvalue() # Header of an empty table
+
+
+# --- Import ---
+def read_rows(source: TextIO, fmt: str) -> Iterator[Dict[str, Any]]:
+    if fmt == 'csv':
+        for record in csv.DictReader(source):
+            # CSV has no NULL or numbers: empty cells are NULL, integer columns are parsed.
+            yield {key: (None if value == '' else int(value) if key in INTEGER_COLUMNS else value)
+                   for key, value in record.items()}
+    else:
+        for line in source:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _batches(rows: Iterable[Dict[str, Any]], columns: Sequence[str], size: int) -> Iterator[List[tuple]]:
+    batch: List[tuple] = []
+    for row in rows:
+        batch.append(tuple(row.get(column) for column in columns))
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_rows(store: SQLiteStorage, table: str, rows: Iterable[Dict[str, Any]],
+                batch_rows: int = IMPORT_BATCH_ROWS) -> Dict[str, int]:
+    """Inserts exported rows, committing every ``batch_rows``; returns inserted/skipped counts.
+
+    Rows whose id (or telegram_id, referral_code) already exists are skipped,
+    so an interrupted import can simply be run again. Each row goes to the
+    shard of its user, so ids keep routing after a move to or from shards;
+    import users before their withdrawals.
+    """
+    columns = _check_table(table)
+    counts = {'inserted': 0, 'skipped': 0}
+    user_column = columns.index('id' if table == 'users' else 'user_id')
+    conns = [store.open_connection(shard) for shard in range(store.shard_count)]
+    try:
+        for batch in _batches(rows, columns, batch_rows):
+            by_shard: Dict[int, List[tuple]] = {}
+            for row in batch:
+                by_shard.setdefault(store.shard_of(row[user_column]), []).append(row)
+            referees: Dict[int, Dict[int, int]] = {}
+            for shard, shard_rows in by_shard.items():
+                inserted = _import_batch(conns[shard], table, columns, shard_rows)
+                if table == 'users':
+                    # Referees of a referrer stored on another shard are not counted by the
+                    # insert trigger; they are added to the referrer's shard below.
+                    for referrer_id in inserted:
+                        if referrer_id is not None and store.shard_of(referrer_id) != shard:
+                            counter = referees.setdefault(store.shard_of(referrer_id), {})
+                            counter[referrer_id] = counter.get(referrer_id, 0) + 1
+                counts['inserted'] += len(inserted)
+                counts['skipped'] += len(shard_rows) - len(inserted)
+            for shard, counter in referees.items():
+                conns[shard].execute("BEGIN IMMEDIATE")
+                stats.count_referees(conns[shard], counter)
+                conns[shard].commit()
+        if table == 'withdrawals' and store.shard_count > 1:
+            _align_withdrawal_sequences(conns)
+    finally:
+        for conn in conns:
+            conn.really_close()
+    return counts
+
+
+def _import_batch(conn: sqlite3.Connection, table: str, columns: Sequence[str], batch: List[tuple]) -> List[Any]:
+    # Returns the referrer_id of every inserted user, or a None per inserted withdrawal.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        inserted = _import_users(conn, columns, batch) if table == 'users' else \
+            [None] * _import_withdrawals(conn, columns, batch)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return inserted
+
+
+def _align_withdrawal_sequences(conns: List[sqlite3.Connection]) -> None:
+    # New withdrawal ids are allocated above each shard's own sequence (see
+    # storage.id_insert()); raising them all to the highest imported id keeps
+    # ids roughly in request order across shards.
+    high = max(conn.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'withdrawals'").fetchone()[0]
+               for conn in conns)
+    for conn in conns:
+        conn.execute("BEGIN IMMEDIATE")
+        if not conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'withdrawals'", (high,)).rowcount:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('withdrawals', ?)", (high,))
+        conn.commit()
+
+
+def _import_users(conn: sqlite3.Connection, columns: Sequence[str], batch: List[tuple]) -> List[Optional[int]]:
+    # Staged first so the INSERT ... RETURNING below tells which users are new:
+    # only those get their exported balance credited.
+    user_columns = ', '.join(columns[:-1])
+    conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS import_users ({', '.join(columns)})")
+    conn.execute("DELETE FROM temp.import_users")
+    conn.executemany(f"INSERT INTO temp.import_users VALUES ({', '.join('?' * len(columns))})", batch)
+    inserted = conn.execute(
+        f"""
+        INSERT INTO users ({user_columns})
+        SELECT {user_columns} FROM temp.import_users WHERE true
+        ON CONFLICT DO NOTHING
+        RETURNING id, referrer_id
+        """
+    ).fetchall()
+    conn.execute(
+        """
+        INSERT INTO earnings_ledger (user_id, amount_nano, kind)
+        SELECT i.id, i.balance_nano, 'import' FROM temp.import_users i
+        WHERE i.balance_nano != 0 AND i.id IN (SELECT value FROM json_each(?))
+        """,
+        (json.dumps([row['id'] for row in inserted]),)
+    )
+    return [row['referrer_id'] for row in inserted]
+
+
+def _import_withdrawals(conn: sqlite3.Connection, columns: Sequence[str], batch: List[tuple]) -> int:
+    # rowcount leaves out the rows written by the search-index triggers.
+    return conn.executemany(
+        f"INSERT INTO withdrawals ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+        "ON CONFLICT DO NOTHING",
+        batch
+    ).rowcount
+
+
+# --- Maintenance ---
+def backup(conn: sqlite3.Connection, path: str) -> None:
+    # Copied in a single step: under WAL that is one read transaction, so
+    # writers carry on and the copy is never restarted by their commits.
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    target = sqlite3.connect(path + '.tmp')
+    try:
+        conn.backup(target)
+    finally:
+        target.close()
+    os.replace(path + '.tmp', path) # A half-written backup never replaces the last good one
+
+
+def maintain(conn: sqlite3.Connection, backup_path: Optional[str] = None, full_vacuum: bool = False) -> Dict[str, Any]:
+    """Nightly maintenance; each step is reported in the returned dict.
+
+    Only ``full_vacuum`` locks the database for the whole rewrite, so it is
+    opt-in. It also switches the file to incremental auto-vacuum, after which
+    every run returns free pages in short steps instead.
+    """
+    report: Dict[str, Any] = {}
+    if backup_path:
+        started = time.perf_counter()
+        backup(conn, backup_path)
+        report['backup'] = {'path': backup_path, 'seconds': round(time.perf_counter() - started, 3)}
+
+    report['ledger_rows_compacted'] = ledger.compact(conn)
+
+    conn.execute(f"PRAGMA analysis_limit={ANALYSIS_LIMIT}")
+    conn.execute("PRAGMA optimize") # ANALYZE, but only for tables whose statistics are stale
+
+    if full_vacuum:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        report['vacuum'] = 'full'
+    elif conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2: # INCREMENTAL
+        free_before = free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        while free:
+            # The pragma frees one page per result row, so the rows must be consumed.
+            conn.execute(f"PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES})").fetchall()
+            remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if remaining >= free:
+                break # Nothing freed (the database is busy); the next run continues
+            free = remaining
+        report['vacuum'] = {'pages_released': free_before - free}
+    else:
+        report['vacuum'] = {'free_pages': conn.execute("PRAGMA freelist_count").fetchone()[0],
+                            'hint': 'run with --vacuum once to enable incremental vacuuming'}
+
+    # PASSIVE never waits for readers or writers; pages still in use are
+    # checkpointed by a later run (or SQLite's own auto-checkpoint).
+    busy, wal_pages, checkpointed = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+    report['wal_checkpoint'] = {'busy': busy, 'wal_pages': wal_pages, 'checkpointed': checkpointed}
+    return report
+
+
+# --- CLI ---
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = commands.add_parser('export', help='stream a table as NDJSON or CSV')
+    export_parser.add_argument('table', choices=tuple(EXPORTS))
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS, default='ndjson')
+    export_parser.add_argument('-o', '--output', help='file to write (default: stdout)')
+
+    import_parser = commands.add_parser('import', help='bulk-insert rows written by export')
+    import_parser.add_argument('table', choices=tuple(EXPORTS))
+    import_parser.add_argument('input', help="file to read, or '-' for stdin")
+    import_parser.add_argument('--format', choices=EXPORT_FORMATS,
+                               help='default: from the file extension, else ndjson')
+    import_parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_ROWS)
+
+    maintain_parser = commands.add_parser('maintain', help='backup, compaction, ANALYZE, vacuum and checkpoint')
+    maintain_parser.add_argument('--backup', metavar='PATH', help='write an online backup here first')
+    maintain_parser.add_argument('--vacuum', action='store_true',
+                                 help='full VACUUM (blocks writers while it runs; enables incremental vacuum)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        output = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+        try:
+            for chunk in export_rows(storage.create_storage(), args.table, args.format):
+                output.write(chunk)
+        finally:
+            if args.output:
+                output.close()
+        return
+
+    from app import init_db, store # Creates the schema when importing into a new database
+    init_db()
+    if args.command == 'import':
+        fmt = args.format or ('csv' if args.input.endswith('.csv') else 'ndjson')
+        source = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8', newline='')
+        try:
+            counts = import_rows(store, args.table, read_rows(source, fmt), args.batch_size)
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        print(f"{args.table}: {counts['inserted']} inserted, {counts['skipped']} skipped (already present)")
+        return
+
+    # One report per shard; a sharded store's backups are named like its files.
+    backups = storage.shard_paths(args.backup, store.shard_count) if args.backup and store.shard_count > 1 \
+        else [args.backup] * store.shard_count
+    reports = []
+    for shard in range(store.shard_count):
+        conn = store.open_connection(shard)
+        try:
+            reports.append(maintain(conn, backups[shard], args.vacuum))
+        finally:
+            conn.really_close()
+    print(json.dumps(reports[0] if store.shard_count == 1 else reports, indent=2))
+
+
+if __name__ == '__main__':
+    main()
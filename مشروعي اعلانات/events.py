@@ -0,0 +1,370 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+# --- Configuration ---
+SSE_HEARTBEAT_SEC = float(os.environ.get("SSE_HEARTBEAT_SEC", "15")) # Also how soon a closed connection is noticed
+# Streams end after this long and EventSource reconnects (resuming from Last-Event-ID),
+# so a stream never pins a worker thread, or outlives a serverless request, indefinitely.
+SSE_MAX_STREAM_SEC = float(os.environ.get("SSE_MAX_STREAM_SEC", "300"))
+SSE_RETRY_MS = 3000 # Reconnect delay suggested to the browser
+MAX_QUEUED_EVENTS = 256 # Per subscriber; a client that stops reading loses its oldest events
+HISTORY_EVENTS = 50 # Kept per topic for clients resuming with Last-Event-ID
+HISTORY_TOPICS = 10000 # Topics with history; the least recently published are dropped
+# "shared" passes events between workers through the events table; "local" keeps them in this process.
+EVENTS_BACKEND = os.environ.get("EVENTS_BACKEND", "shared")
+EVENTS_POLL_SEC = float(os.environ.get("EVENTS_POLL_SEC", "0.25")) # Buffered events are written, and new rows read, this often
+EVENTS_RETENTION_SEC = float(os.environ.get("EVENTS_RETENTION_SEC", "300")) # Rows older than this are purged
+MAX_OUTGOING_EVENTS = 10000 # Written per relay pass at most; the oldest are dropped while the database is unavailable
+POLL_BATCH = 1000 # Rows read per shard and pass
+LISTENER_TTL_SEC = 30.0 # A worker's listener rows are refreshed well before this; a dead worker's expire
+PURGE_INTERVAL_SEC = 60.0
+
+# Events of every worker, on the shard of their topic. AUTOINCREMENT keeps ids
+# increasing across purges, so a Last-Event-ID never points back into reused ids.
+EVENTS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        topic TEXT NOT NULL,
+        body TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+'''
+EVENTS_INDEX = "CREATE INDEX IF NOT EXISTS idx_events_topic ON events (topic, id)"
+
+# Topics with an open stream on some worker, on the shard of the topic, so
+# publishers on every worker can skip events (and the queries behind them)
+# nobody is listening for.
+LISTENERS_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS event_listeners (
+        topic TEXT NOT NULL,
+        worker INTEGER NOT NULL,
+        expires_at REAL NOT NULL,
+        PRIMARY KEY (topic, worker)
+    ) WITHOUT ROWID
+'''
+
+
+class Subscription:
+    __slots__ = ("topics", "queue", "ready")
+
+    def __init__(self, topics: Tuple[str, ...]) -> None:
+        self.topics = topics
+        self.queue: Deque[str] = deque(maxlen=MAX_QUEUED_EVENTS)
+        self.ready = threading.Event()
+
+
+class EventHub:
+    """Pub/sub fanout for server-sent events.
+
+    Events are serialized once at publish time and the same string is queued
+    for every subscriber of the topic, so fanout costs one deque append and
+    one Event.set() per listener. An idle subscriber is a deque and an Event;
+    the thread (or, under ``gunicorn -k gevent``, the greenlet) serving it
+    sleeps in Event.wait() between events.
+
+    Without ``connect`` only this process's publishes are seen. With it,
+    publish() only buffers the event: a relay thread in every worker writes
+    the buffer to the events table (one transaction per shard) and reads the
+    rows all workers wrote since its last pass, so a client gets every event
+    whichever worker served the write, within about 2 * poll_interval. Each
+    relay also records the topics its clients subscribe to in
+    event_listeners (kept for LISTENER_TTL_SEC after a stream closes, so a
+    reconnecting client can resume) and reads back every worker's, which is
+    what has_subscribers() and publish() check; a new stream is seen by the
+    other workers after their next pass. A pass reads nothing from a shard
+    nobody wrote to since the last one (PRAGMA data_version).
+    """
+
+    def __init__(self, connect: Optional[Callable[[int], sqlite3.Connection]] = None, shard_count: int = 1,
+                 topic_shard: Callable[[str], int] = lambda topic: 0,
+                 on_first_use: Callable[[], None] = lambda: None,
+                 poll_interval: float = EVENTS_POLL_SEC, retention: float = EVENTS_RETENTION_SEC) -> None:
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+        self._history: "OrderedDict[str, Deque[Tuple[int, str]]]" = OrderedDict()
+        # Shared channel
+        self._connect = connect
+        self._shard_count = shard_count
+        self._topic_shard = topic_shard
+        self._on_first_use = on_first_use # Creates the schema
+        self._poll_interval = poll_interval
+        self._retention = retention
+        self._outgoing: Deque[Tuple[int, str, str, float]] = deque(maxlen=MAX_OUTGOING_EVENTS)
+        self._outgoing_lock = threading.Lock()
+        self._cursors: Optional[List[int]] = None # Highest row id dispatched, per shard
+        self._data_versions: List[Optional[int]] = [None] * shard_count # As of the last read, per shard
+        self._registered: Dict[str, float] = {} # This worker's listener rows: when each topic's expires
+        self._listening: List[Dict[str, float]] = [{} for _ in range(shard_count)] # Every worker's, per shard
+        self._last_purge = time.monotonic()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+        self._thread_pid = 0
+        self._start_lock = threading.Lock()
+
+    def publish(self, topic: str, event: str, data: Any) -> None:
+        body = f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'), default=str)}\n\n"
+        if self._connect is not None:
+            if not self.has_subscribers(topic):
+                return # No stream is open, or was closed recently enough to resume
+            with self._outgoing_lock:
+                self._outgoing.append((self._topic_shard(topic), topic, body, time.time()))
+            self._ensure_started()
+            return
+        with self._lock:
+            self._next_id += 1
+            message = f"id: {self._next_id}\n{body}"
+            history = self._history.get(topic)
+            if history is None:
+                history = self._history[topic] = deque(maxlen=HISTORY_EVENTS)
+                if len(self._history) > HISTORY_TOPICS:
+                    self._history.popitem(last=False)
+            else:
+                self._history.move_to_end(topic)
+            history.append((self._next_id, message))
+            self._dispatch(topic, message)
+
+    def has_subscribers(self, topic: str) -> bool:
+        # Lets publishers skip building an event (and any query behind it) nobody is listening for.
+        # With the shared channel a listener may be connected to another worker.
+        if self._connect is not None:
+            self._ensure_started()
+            expires_at = self._listening[self._topic_shard(topic)].get(topic)
+            if expires_at is not None and expires_at > time.time():
+                return True
+        return bool(self._subscribers.get(topic))
+
+    def subscribe(self, topics: Iterable[str], last_event_id: Optional[str] = None) -> Subscription:
+        subscription = Subscription(tuple(topics))
+        if self._connect is not None:
+            self._ensure_started()
+        with self._lock:
+            if last_event_id and last_event_id.isdigit():
+                # Replays what was published while the client was reconnecting.
+                missed = self._missed(subscription.topics, int(last_event_id))
+                subscription.queue.extend(message for _, message in sorted(missed))
+                if missed:
+                    subscription.ready.set()
+            for topic in subscription.topics:
+                self._subscribers.setdefault(topic, set()).add(subscription)
+        if self._connect is not None:
+            self._wakeup.set() # Registers the topics now rather than at the next pass
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[topic]
+
+    def stream(self, subscription: Subscription, initial: Iterable[Tuple[str, Any]] = (),
+               heartbeat: float = SSE_HEARTBEAT_SEC, max_duration: float = SSE_MAX_STREAM_SEC) -> Iterator[str]:
+        """The text/event-stream body for ``subscription``; unsubscribes when the client goes away."""
+        try:
+            first = f"retry: {SSE_RETRY_MS}\n\n"
+            # Snapshots sent on every (re)connect carry no id, so they never move Last-Event-ID.
+            for event, data in initial:
+                first += f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'), default=str)}\n\n"
+            yield first
+            deadline = time.monotonic() + max_duration
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                if not subscription.ready.wait(min(heartbeat, remaining)):
+                    yield ": keepalive\n\n" # Comment line; also surfaces a closed connection
+                    continue
+                subscription.ready.clear()
+                messages = []
+                while subscription.queue:
+                    messages.append(subscription.queue.popleft())
+                if messages:
+                    yield "".join(messages)
+        finally:
+            self.unsubscribe(subscription)
+
+    def stop(self) -> None:
+        """Stops the relay after writing the events still buffered."""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None and self._thread_pid == os.getpid():
+            self._thread.join(timeout=5)
+
+    # --- Internals ---
+    def _dispatch(self, topic: str, message: str) -> None:
+        # Called with the lock held.
+        for subscription in self._subscribers.get(topic, ()):
+            subscription.queue.append(message)
+            subscription.ready.set()
+
+    def _missed(self, topics: Tuple[str, ...], last_event_id: int) -> List[Tuple[int, str]]:
+        # Called with the lock held, so nothing is dispatched between the replay and the subscription.
+        if self._connect is None:
+            return [entry for topic in topics for entry in self._history.get(topic, ()) if entry[0] > last_event_id]
+        # Event ids encode the shard (see _event_id()); rows of a topic are only comparable
+        # with an id from the same shard, which is where a single-topic stream's last event came from.
+        if self._cursors is None: # Stopped before it ever started
+            return []
+        shard, row_id = last_event_id % self._shard_count, last_event_id // self._shard_count
+        missed: List[Tuple[int, str]] = []
+        for topic in topics:
+            if self._topic_shard(topic) != shard:
+                continue
+            try:
+                rows = self._connect(shard).execute(
+                    "SELECT id, body FROM events WHERE topic = ? AND id > ? AND id <= ? ORDER BY id DESC LIMIT ?",
+                    (topic, row_id, self._cursors[shard], HISTORY_EVENTS)
+                ).fetchall()
+            except sqlite3.Error as e:
+                print(f"Error replaying events: {e}")
+                continue
+            missed.extend((row['id'], self._message(shard, row['id'], row['body'])) for row in rows)
+        return missed
+
+    def _event_id(self, shard: int, row_id: int) -> int:
+        return row_id * self._shard_count + shard
+
+    def _message(self, shard: int, row_id: int, body: str) -> str:
+        return f"id: {self._event_id(shard, row_id)}\n{body}"
+
+    def _ensure_started(self) -> None:
+        # Per process: a forked gunicorn worker must not rely on the parent's (dead) relay.
+        if self._stopped or (self._thread is not None and self._thread_pid == os.getpid()):
+            return
+        with self._start_lock:
+            if self._thread is None or self._thread_pid != os.getpid():
+                self._on_first_use()
+                # Only rows written from now on are relayed; older ones are reached through Last-Event-ID.
+                cursors = [self._max_id(shard) for shard in range(self._shard_count)]
+                with self._lock:
+                    self._cursors = cursors
+                self._data_versions = [None] * self._shard_count
+                self._registered = {} # The parent's rows expire on their own
+                self._listening = [{} for _ in range(self._shard_count)]
+                self._thread = threading.Thread(target=self._run, name="event-relay", daemon=True)
+                self._thread_pid = os.getpid()
+                self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopped:
+            self._wakeup.wait(self._poll_interval)
+            self._wakeup.clear()
+            try:
+                self._relay_once()
+            except Exception as e: # Keep the relay alive whatever happens to one pass
+                print(f"Error relaying events: {e}")
+        self._write_outgoing()
+
+    def _relay_once(self) -> None:
+        written = self._write_outgoing() | self._register()
+        for shard in range(self._shard_count):
+            if shard in written or self._changed(shard):
+                self._read_listeners(shard)
+                self._poll(shard)
+        if time.monotonic() - self._last_purge >= PURGE_INTERVAL_SEC:
+            self._last_purge = time.monotonic()
+            for shard in range(self._shard_count):
+                self._purge(shard)
+
+    def _write_outgoing(self) -> Set[int]:
+        with self._outgoing_lock:
+            outgoing = list(self._outgoing)
+            self._outgoing.clear()
+        by_shard: Dict[int, List[Tuple[str, str, float]]] = {}
+        for shard, topic, body, created_at in outgoing:
+            by_shard.setdefault(shard, []).append((topic, body, created_at))
+        for shard, rows in by_shard.items():
+            conn = self._connect(shard)
+            try:
+                conn.executemany("INSERT INTO events (topic, body, created_at) VALUES (?, ?, ?)", rows)
+                conn.commit()
+            except sqlite3.Error as e:
+                # Dropped: a live event is only worth sending while it is current.
+                conn.rollback()
+                print(f"Error writing events: {e}")
+        return set(by_shard)
+
+    def _register(self) -> Set[int]:
+        # Writes rows for the topics subscribed here that have none, or one expiring soon. Rows of
+        # closed streams are left to expire, so events published while a client reconnects are kept.
+        now = time.time()
+        with self._lock:
+            topics = list(self._subscribers)
+        worker = os.getpid()
+        by_shard: Dict[int, List[Tuple[str, int, float]]] = {}
+        for topic in topics:
+            if self._registered.get(topic, 0.0) - now < LISTENER_TTL_SEC / 2:
+                by_shard.setdefault(self._topic_shard(topic), []).append((topic, worker, now + LISTENER_TTL_SEC))
+        for shard, rows in by_shard.items():
+            conn = self._connect(shard)
+            try:
+                conn.executemany("INSERT OR REPLACE INTO event_listeners (topic, worker, expires_at) VALUES (?, ?, ?)",
+                                 rows)
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                print(f"Error registering event listeners: {e}")
+                continue
+            for topic, _, expires_at in rows:
+                self._registered[topic] = expires_at
+        for topic in [topic for topic, expires_at in self._registered.items() if expires_at <= now]:
+            del self._registered[topic]
+        return set(by_shard)
+
+    def _changed(self, shard: int) -> bool:
+        # data_version moves with every commit made through another connection, this process's included.
+        version = self._connect(shard).execute("PRAGMA data_version").fetchone()[0]
+        changed = version != self._data_versions[shard]
+        self._data_versions[shard] = version
+        return changed
+
+    def _read_listeners(self, shard: int) -> None:
+        rows = self._connect(shard).execute(
+            "SELECT topic, MAX(expires_at) FROM event_listeners WHERE expires_at > ? GROUP BY topic", (time.time(),)
+        ).fetchall()
+        self._listening[shard] = {row[0]: row[1] for row in rows}
+
+    def _poll(self, shard: int) -> None:
+        with self._lock:
+            if not self._subscribers:
+                # Nobody to deliver to; skip ahead so a new subscriber does not get a backlog.
+                self._cursors[shard] = max(self._cursors[shard], self._max_id(shard))
+                return
+            cursor = self._cursors[shard]
+        rows = self._connect(shard).execute(
+            "SELECT id, topic, body FROM events WHERE id > ? ORDER BY id LIMIT ?", (cursor, POLL_BATCH)
+        ).fetchall()
+        if not rows:
+            return
+        if len(rows) == POLL_BATCH:
+            self._data_versions[shard] = None # Read the rest next pass even if nothing else is written
+        with self._lock:
+            for row in rows:
+                self._dispatch(row['topic'], self._message(shard, row['id'], row['body']))
+            self._cursors[shard] = rows[-1]['id']
+
+    def _max_id(self, shard: int) -> int:
+        return self._connect(shard).execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+    def _purge(self, shard: int) -> None:
+        # Rows are appended in id order, so the expired ones are the ids below the first current row.
+        conn = self._connect(shard)
+        try:
+            conn.execute(
+                "DELETE FROM events WHERE id < COALESCE((SELECT id FROM events WHERE created_at > ? ORDER BY id LIMIT 1), "
+                "(SELECT MAX(id) + 1 FROM events))", (time.time() - self._retention,)
+            )
+            conn.execute("DELETE FROM event_listeners WHERE expires_at <= ?", (time.time(),))
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            print(f"Error purging events: {e}")
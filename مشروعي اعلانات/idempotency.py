@@ -0,0 +1,164 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, NamedTuple, Optional, Set, Tuple
+
+# --- Configuration ---
+IDEMPOTENCY_TTL_SEC = float(os.environ.get("IDEMPOTENCY_TTL_SEC", "86400")) # How long a key replays its response
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "10000")) # Responses kept in memory per process
+PURGE_INTERVAL_SEC = 600.0 # Expired rows are deleted at most this often
+MAX_KEY_LENGTH = 255
+
+# Completed requests by owner (a user id, or 0 for Telegram updates) and key.
+# Stored on the owner's shard, so recording one takes the same lock as the write it answers.
+IDEMPOTENCY_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        owner_id INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        status INTEGER NOT NULL,
+        body BLOB NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (owner_id, key)
+    ) WITHOUT ROWID
+'''
+IDEMPOTENCY_INDEX = "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys (created_at)"
+
+
+class RequestInProgress(Exception):
+    pass
+
+
+class StoredResponse(NamedTuple):
+    status: int
+    body: bytes
+    expires_at: float # time.time()
+
+
+class IdempotencyKeys:
+    """Seen-set of idempotency keys with the response each one produced.
+
+    Lookups hit an in-process LRU first and the idempotency_keys table on a
+    miss, so a retry that lands on another worker still replays the original
+    response; neither touches the tables the request itself writes. Keys that
+    are still being handled are tracked in memory only: a duplicate arriving
+    at the same worker meanwhile gets RequestInProgress, one racing it on
+    another worker is not caught (the ad ticket and balance checks still are).
+    Keys used with ``durable=False`` never touch the table: they replay on
+    this worker only, for requests too frequent to pay a write each.
+    """
+
+    def __init__(self, connect: Callable[[int], sqlite3.Connection],
+                 fan_out: Callable[[Callable[[sqlite3.Connection], int]], List[int]],
+                 ttl: float = IDEMPOTENCY_TTL_SEC, max_size: int = IDEMPOTENCY_CACHE_SIZE) -> None:
+        self._connect = connect # owner id -> connection of the owner's shard
+        self._fan_out = fan_out
+        self._ttl = ttl
+        self._max_size = max_size
+        self._responses: "OrderedDict[Tuple[int, str], StoredResponse]" = OrderedDict()
+        self._in_progress: Set[Tuple[int, str]] = set()
+        self._lock = threading.Lock()
+        self._last_purge = time.monotonic()
+        self._purge_lock = threading.Lock()
+
+    def begin(self, owner_id: int, key: str, durable: bool = True) -> Optional[StoredResponse]:
+        """Returns the stored response for a repeated key, or claims a new one.
+
+        A claimed key must be finished with complete() or release(). Raises
+        RequestInProgress while the first request with the key is running here.
+        """
+        entry_key = (owner_id, key)
+        with self._lock:
+            stored = self._cached(entry_key)
+            if stored is not None:
+                return stored
+            if entry_key in self._in_progress:
+                raise RequestInProgress(key)
+            self._in_progress.add(entry_key)
+        if not durable:
+            return None
+        try:
+            conn = self._connect(owner_id)
+            row = conn.execute(
+                "SELECT status, body, created_at FROM idempotency_keys WHERE owner_id = ? AND key = ? AND created_at > ?",
+                (owner_id, key, time.time() - self._ttl)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Error reading idempotency key: {e}")
+            row = None
+        if row is None:
+            return None
+        stored = StoredResponse(row['status'], bytes(row['body']), row['created_at'] + self._ttl)
+        with self._lock:
+            self._in_progress.discard(entry_key)
+            self._remember(entry_key, stored)
+        return stored
+
+    def complete(self, owner_id: int, key: str, status: int, body: bytes, durable: bool = True) -> None:
+        # Recorded after the request's own transaction; a crash in between lets one retry run again.
+        entry_key = (owner_id, key)
+        now = time.time()
+        with self._lock:
+            self._in_progress.discard(entry_key)
+            self._remember(entry_key, StoredResponse(status, body, now + self._ttl))
+        if not durable:
+            return
+        conn = self._connect(owner_id)
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO idempotency_keys (owner_id, key, status, body, created_at) VALUES (?, ?, ?, ?, ?)",
+                (owner_id, key, status, body, now)
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            # The in-memory entry still covers retries that reach this worker.
+            conn.rollback()
+            print(f"Error storing idempotency key: {e}")
+        finally:
+            conn.close()
+        self.purge_if_due()
+
+    def release(self, owner_id: int, key: str) -> None:
+        # For requests that failed without effect, so a retry runs them again.
+        with self._lock:
+            self._in_progress.discard((owner_id, key))
+
+    def purge_if_due(self, interval: float = PURGE_INTERVAL_SEC) -> Optional[int]:
+        if time.monotonic() - self._last_purge < interval or not self._purge_lock.acquire(blocking=False):
+            return None
+        try:
+            self._last_purge = time.monotonic()
+            return sum(self._fan_out(self._purge))
+        except sqlite3.Error as e:
+            print(f"Error purging idempotency keys: {e}")
+            return None
+        finally:
+            self._purge_lock.release()
+
+    # --- Internals ---
+    def _purge(self, conn: sqlite3.Connection) -> int:
+        try:
+            deleted = conn.execute("DELETE FROM idempotency_keys WHERE created_at <= ?",
+                                   (time.time() - self._ttl,)).rowcount
+            conn.commit()
+            return deleted
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+    def _cached(self, entry_key: Tuple[int, str]) -> Optional[StoredResponse]:
+        stored = self._responses.get(entry_key)
+        if stored is None:
+            return None
+        if stored.expires_at <= time.time():
+            del self._responses[entry_key]
+            return None
+        self._responses.move_to_end(entry_key)
+        return stored
+
+    def _remember(self, entry_key: Tuple[int, str], stored: StoredResponse) -> None:
+        self._responses[entry_key] = stored
+        self._responses.move_to_end(entry_key)
+        while len(self._responses) > self._max_size:
+            self._responses.popitem(last=False)
@@ -0,0 +1,289 @@
+import collections
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from db import PooledConnection
+
+# --- Configuration ---
+# Everything here is off unless METRICS_ENABLED=1; disabled, the hooks are never
+# registered and connections are not wrapped.
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "0") == "1"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN") # /metrics requires "Authorization: Bearer <token>"; 404 when unset
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "500"))
+# Sampling profiler for slow requests: stacks are written in the "folded"
+# format read by flamegraph.pl and speedscope.
+PROFILE_SLOW_REQUESTS = os.environ.get("PROFILE_SLOW_REQUESTS", "0") == "1"
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_SEC = float(os.environ.get("PROFILE_INTERVAL_MS", "5")) / 1000
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+MAX_STATEMENT_LABELS = 200 # Any further distinct statements are reported as "other"
+STATEMENT_LABEL_LENGTH = 120
+
+
+# --- Metric types ---
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self._help = help_text
+        self._labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Tuple[str, ...] = (), amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] += amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self._help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self._labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self._help = help_text
+        self._labelnames = tuple(labelnames)
+        self._buckets = tuple(buckets)
+        # labels -> [count per bucket..., +Inf count, sum]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Tuple[str, ...], value: float) -> None:
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [0.0] * (len(self._buckets) + 2)
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self._help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._values.items()):
+                for bound, count in zip(self._buckets, series):
+                    bucket_labels = _labels(self._labelnames, labels, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+                bucket_labels = _labels(self._labelnames, labels, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {series[-2]}")
+                lines.append(f"{self.name}_count{_labels(self._labelnames, labels)} {series[-2]}")
+                lines.append(f"{self.name}_sum{_labels(self._labelnames, labels)} {series[-1]}")
+        return lines
+
+
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "Request latency by route.",
+                             ("route", "method", "status"))
+REQUEST_QUERIES = Histogram("http_request_db_queries", "SQL statements executed per request.",
+                            ("route",), COUNT_BUCKETS)
+STATEMENT_DURATION = Histogram("db_statement_duration_seconds", "SQL statement execution time.", ("statement",))
+DB_COMMITS = Counter("db_commits_total", "Committed SQLite transactions.")
+TELEGRAM_DURATION = Histogram("telegram_request_duration_seconds", "Telegram Bot API call latency.",
+                              ("method", "outcome"))
+SLOW_REQUESTS = Counter("http_slow_requests_total", f"Requests slower than {SLOW_REQUEST_MS:g} ms.", ("route",))
+
+METRICS = (REQUEST_DURATION, REQUEST_QUERIES, STATEMENT_DURATION, DB_COMMITS, TELEGRAM_DURATION, SLOW_REQUESTS)
+
+
+def render_metrics() -> str:
+    # Metrics are per process: with several gunicorn workers each scrape sees one worker.
+    lines: List[str] = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def observe_telegram(method: str, seconds: float, outcome: str) -> None:
+    if METRICS_ENABLED:
+        TELEGRAM_DURATION.observe((method, outcome), seconds)
+
+
+# --- Per-request state ---
+class _RequestStats:
+    __slots__ = ("started", "queries", "db_seconds", "samples")
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.samples: Optional[collections.Counter] = None
+
+
+_local = threading.local()
+
+
+def _current() -> Optional[_RequestStats]:
+    return getattr(_local, "stats", None)
+
+
+# --- SQL instrumentation ---
+_statement_labels: Dict[str, str] = {}
+_statement_labels_lock = threading.Lock()
+
+
+def _statement_label(sql: str) -> str:
+    label = _statement_labels.get(sql)
+    if label is None:
+        with _statement_labels_lock:
+            if len(_statement_labels) >= MAX_STATEMENT_LABELS:
+                return "other"
+            label = _statement_labels[sql] = " ".join(sql.split())[:STATEMENT_LABEL_LENGTH]
+    return label
+
+
+def _timed(run, sql: str, *args: Any) -> Any:
+    started = time.perf_counter()
+    try:
+        return run(sql, *args)
+    finally:
+        elapsed = time.perf_counter() - started
+        STATEMENT_DURATION.observe((_statement_label(sql),), elapsed)
+        stats = _current()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += elapsed
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql: str, *args: Any) -> sqlite3.Cursor:
+        return _timed(super().execute, sql, *args)
+
+    def executemany(self, sql: str, *args: Any) -> sqlite3.Cursor:
+        return _timed(super().executemany, sql, *args)
+
+
+class InstrumentedConnection(PooledConnection):
+    """Pooled connection that times every statement and counts commits."""
+
+    def cursor(self, factory: Any = InstrumentedCursor) -> sqlite3.Cursor:
+        return super().cursor(factory)
+
+    def execute(self, sql: str, *args: Any) -> sqlite3.Cursor:
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql: str, *args: Any) -> sqlite3.Cursor:
+        return self.cursor().executemany(sql, *args)
+
+    def commit(self) -> None:
+        # With journal_mode=WAL and synchronous=NORMAL a commit does not fsync;
+        # fsyncs only happen at WAL checkpoints.
+        had_transaction = self.in_transaction
+        started = time.perf_counter()
+        super().commit()
+        if had_transaction:
+            DB_COMMITS.inc()
+            stats = _current()
+            if stats is not None:
+                stats.db_seconds += time.perf_counter() - started
+
+
+# --- Sampling profiler ---
+class _Sampler:
+    """Samples the stacks of threads that are serving a request."""
+
+    def __init__(self, interval: float) -> None:
+        self._interval = interval
+        self._active: Dict[int, collections.Counter] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    def start(self, samples: collections.Counter) -> None:
+        with self._lock:
+            self._active[threading.get_ident()] = samples
+            if self._thread is None or self._pid != os.getpid():
+                # One sampler thread per (forked) worker process
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name="request-sampler", daemon=True)
+                self._thread.start()
+
+    def stop(self) -> None:
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self._interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, samples in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[_fold(frame)] += 1
+
+
+def _fold(frame: Any) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+_sampler = _Sampler(PROFILE_INTERVAL_SEC)
+
+
+def _write_profile(route: str, duration_ms: float, samples: collections.Counter) -> None:
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{route.strip('/').replace('/', '_') or 'index'}"
+        path = os.path.join(PROFILE_DIR, f"{name}-{duration_ms:.0f}ms.folded")
+        with open(path, "w") as f:
+            for stack, count in samples.most_common():
+                f.write(f"{stack} {count}\n")
+    except OSError as e:
+        print(f"Error writing request profile: {e}")
+
+
+# --- Flask hooks ---
+def start_request() -> None:
+    stats = _RequestStats()
+    _local.stats = stats
+    if PROFILE_SLOW_REQUESTS:
+        stats.samples = collections.Counter()
+        _sampler.start(stats.samples)
+
+
+def finish_request(route: str, method: str, status: int) -> Optional[str]:
+    """Records the request and returns its Server-Timing header value (None if not started)."""
+    stats = _current()
+    if stats is None:
+        return None
+    _local.stats = None
+    if stats.samples is not None:
+        _sampler.stop()
+
+    duration = time.perf_counter() - stats.started
+    REQUEST_DURATION.observe((route, method, str(status)), duration)
+    REQUEST_QUERIES.observe((route,), stats.queries)
+    if duration * 1000 >= SLOW_REQUEST_MS:
+        SLOW_REQUESTS.inc((route,))
+        if stats.samples:
+            _write_profile(route, duration * 1000, stats.samples)
+    return (f'app;dur={duration * 1000:.2f}, '
+            f'db;dur={stats.db_seconds * 1000:.2f};desc="{stats.queries} queries"')
@@ -0,0 +1,162 @@
+import sqlite3
+import threading
+import time
+from typing import Callable, Iterable, List, Optional, Tuple
+
+# --- Units ---
+# Balances are integer nanotons (TON's native unit), so repeated 0.0001 credits
+# never accumulate float error. The API still reports TON as a float.
+NANO_PER_TON = 1_000_000_000
+
+COMPACTION_INTERVAL_SEC = 600.0
+SCHEMA_VERSION = 1 # PRAGMA user_version is shared: stats.py and search_index.py number their steps after this
+
+LEDGER_SCHEMA = (
+    # Append-only: rows are inserted for every credit/debit and only removed
+    # by compact(), after being folded into balance_snapshots.
+    """
+    CREATE TABLE IF NOT EXISTS earnings_ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        amount_nano INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_earnings_ledger_user ON earnings_ledger (user_id, id)",
+    """
+    CREATE TABLE IF NOT EXISTS balance_snapshots (
+        user_id INTEGER PRIMARY KEY,
+        balance_nano INTEGER NOT NULL DEFAULT 0,
+        last_ledger_id INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_balance_snapshots_balance ON balance_snapshots (balance_nano, user_id)",
+    # Every user has a snapshot row, so admin listings can sort by balance
+    # through idx_balance_snapshots_balance.
+    """
+    CREATE TRIGGER IF NOT EXISTS users_balance_snapshot AFTER INSERT ON users BEGIN
+        INSERT OR IGNORE INTO balance_snapshots (user_id) VALUES (new.id);
+    END
+    """,
+    # Read model used instead of `users` wherever a balance is needed:
+    # balance = snapshot + ledger rows written since the last compaction.
+    # SQLite flattens the view into each query and copies the ledger subquery
+    # into every place balance_nano is used, so it is exposed once, with no
+    # derived columns: earnings in TON is to_ton(balance_nano), computed by the
+    # reader. (Joining a grouped SUM instead makes every lookup aggregate the
+    # whole ledger.) Queries that both filter on and return the balance read it
+    # through a MATERIALIZED CTE; see payouts.request_withdrawal().
+    "DROP VIEW IF EXISTS user_balances",
+    """
+    CREATE VIEW user_balances AS
+    SELECT
+        u.id, u.telegram_id, u.first_name, u.last_name, u.username, u.photo_url,
+        u.auth_date, u.hash, u.ads_viewed, u.referral_code, u.referrer_id, u.created_at,
+        COALESCE(s.balance_nano, 0) + COALESCE((
+            SELECT SUM(l.amount_nano) FROM earnings_ledger l
+            WHERE l.user_id = u.id AND l.id > COALESCE(s.last_ledger_id, 0)
+        ), 0) AS balance_nano
+    FROM users u
+    LEFT JOIN balance_snapshots s ON s.user_id = u.id
+    """,
+)
+
+
+def to_nano(amount: float) -> int:
+    return int(round(amount * NANO_PER_TON))
+
+
+def to_ton(amount_nano: int) -> float:
+    return amount_nano / NANO_PER_TON
+
+
+# --- Schema ---
+def migrate(cursor: sqlite3.Cursor) -> None:
+    # Schema version 1 moves balances out of the REAL users.earnings column
+    # (now legacy and no longer written) into integer snapshots.
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    for statement in LEDGER_SCHEMA:
+        cursor.execute(statement)
+    if version >= SCHEMA_VERSION:
+        return
+
+    cursor.execute(
+        "INSERT OR IGNORE INTO balance_snapshots (user_id, balance_nano) "
+        f"SELECT id, CAST(ROUND(COALESCE(earnings, 0) * {NANO_PER_TON}) AS INTEGER) FROM users"
+    )
+    withdrawal_columns = {row[1] for row in cursor.execute("PRAGMA table_info(withdrawals)")}
+    if 'amount_nano' not in withdrawal_columns:
+        cursor.execute("ALTER TABLE withdrawals ADD COLUMN amount_nano INTEGER")
+    cursor.execute(
+        f"UPDATE withdrawals SET amount_nano = CAST(ROUND(amount * {NANO_PER_TON}) AS INTEGER) WHERE amount_nano IS NULL"
+    )
+    # Sorting by the legacy column is meaningless now.
+    cursor.execute("DROP INDEX IF EXISTS idx_users_earnings")
+    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+# --- Writes ---
+def credit_many(conn: sqlite3.Connection, entries: Iterable[Tuple[int, int, str]]) -> None:
+    # (user_id, amount_nano, kind); entries for users that do not exist (e.g. a
+    # deleted referrer) are skipped. Does not commit.
+    conn.executemany(
+        "INSERT INTO earnings_ledger (user_id, amount_nano, kind) "
+        "SELECT ?1, ?2, ?3 WHERE EXISTS (SELECT 1 FROM users WHERE id = ?1)",
+        entries
+    )
+
+
+def get_balance_nano(conn: sqlite3.Connection, user_id: int) -> int:
+    row = conn.execute("SELECT balance_nano FROM user_balances WHERE id = ?", (user_id,)).fetchone()
+    return row[0] if row is not None else 0
+
+
+def compact(conn: sqlite3.Connection) -> int:
+    """Folds all ledger rows into balance_snapshots and returns how many rows were folded."""
+    conn.execute("BEGIN IMMEDIATE") # The watermark must not move while we fold
+    try:
+        watermark = conn.execute("SELECT MAX(id) FROM earnings_ledger").fetchone()[0]
+        if watermark is None:
+            conn.rollback()
+            return 0
+        conn.execute(
+            """
+            INSERT INTO balance_snapshots (user_id, balance_nano, last_ledger_id)
+            SELECT user_id, SUM(amount_nano), ?1 FROM earnings_ledger WHERE id <= ?1 GROUP BY user_id
+            ON CONFLICT(user_id) DO UPDATE SET
+                balance_nano = balance_nano + excluded.balance_nano,
+                last_ledger_id = excluded.last_ledger_id,
+                updated_at = CURRENT_TIMESTAMP
+            """,
+            (watermark,)
+        )
+        # AUTOINCREMENT guarantees new rows get ids above the watermark, so
+        # "id > last_ledger_id" stays exact after these rows are gone.
+        folded = conn.execute("DELETE FROM earnings_ledger WHERE id <= ?", (watermark,)).rowcount
+        conn.commit()
+        return folded
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+
+
+_last_compaction = time.monotonic()
+_compaction_lock = threading.Lock()
+
+
+def compact_if_due(fan_out: Callable[[Callable[[sqlite3.Connection], int]], List[int]],
+                   interval: float = COMPACTION_INTERVAL_SEC) -> Optional[int]:
+    # Compacts every shard (on its own connection, in parallel when sharded).
+    global _last_compaction
+    if time.monotonic() - _last_compaction < interval or not _compaction_lock.acquire(blocking=False):
+        return None
+    try:
+        _last_compaction = time.monotonic()
+        return sum(fan_out(compact))
+    except sqlite3.Error as e:
+        print(f"Error compacting earnings ledger: {e}")
+        return None
+    finally:
+        _compaction_lock.release()
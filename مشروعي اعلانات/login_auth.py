@@ -0,0 +1,143 @@
+import hashlib
+import hmac
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, NamedTuple, Optional, Tuple
+
+import storage
+
+# --- Configuration ---
+MAX_AUTH_AGE_SEC = 86400 # Telegram login data older than 24 hours is rejected
+DEDUP_TTL_SEC = 300.0
+DEDUP_MAX_SIZE = 10000
+
+# Fields sent to /api/login that are not part of Telegram's signed data.
+UNSIGNED_FIELDS = ('hash', 'referrer_id')
+PROFILE_FIELDS = ('first_name', 'last_name', 'username', 'photo_url', 'auth_date', 'hash')
+
+
+def _check_string(data: Mapping[str, Any]) -> bytes:
+    check_string = "\n".join(f"{key}={data[key]}" for key in sorted(data) if key not in UNSIGNED_FIELDS)
+    # surrogatepass: JSON can carry lone surrogates, which plain UTF-8 refuses to encode.
+    return check_string.encode('utf-8', 'surrogatepass')
+
+
+def _is_hex_digest(value: Any) -> bool:
+    # Telegram's hash is a hex SHA-256; anything else is rejected before compare_digest(),
+    # which raises TypeError for non-ASCII strings.
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+
+class _VerifiedLogin(NamedTuple):
+    check_string: bytes
+    user_id: int
+    expires_at: float
+
+
+class LoginVerifier:
+    """Checks Telegram login data and remembers recently verified logins.
+
+    A Telegram WebApp sends the same signed data again on every reload; while
+    it is in the dedup cache such a login skips the HMAC and the database write.
+    """
+
+    def __init__(self, bot_token: str, max_age: int = MAX_AUTH_AGE_SEC,
+                 dedup_ttl: float = DEDUP_TTL_SEC, dedup_size: int = DEDUP_MAX_SIZE) -> None:
+        # Per Telegram's docs the key is SHA256(bot_token); it never changes, so compute it once.
+        self._secret_key = hashlib.sha256(bot_token.encode('utf-8')).digest()
+        self._max_age = max_age
+        self._dedup_ttl = dedup_ttl
+        self._dedup_size = dedup_size
+        self._verified: "OrderedDict[str, _VerifiedLogin]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def verify(self, data: Mapping[str, Any]) -> Tuple[Optional[str], Optional[int]]:
+        """Returns (error, None) for rejected data, else (None, user_id) where
+        user_id is set only if this exact login was already persisted recently."""
+        received_hash = data.get('hash')
+        if not _is_hex_digest(received_hash):
+            return "Invalid Telegram data hash", None
+        try:
+            auth_date = int(data['auth_date'])
+        except (KeyError, TypeError, ValueError):
+            return "Invalid Telegram data", None
+        # Cheap check first: stale data is rejected without hashing anything.
+        if time.time() - auth_date > self._max_age:
+            return "Telegram data is too old", None
+
+        check_string = _check_string(data)
+        with self._lock:
+            verified = self._verified.get(received_hash)
+            if verified is not None and verified.expires_at <= time.monotonic():
+                del self._verified[received_hash]
+                verified = None
+        if verified is not None and hmac.compare_digest(verified.check_string, check_string):
+            return None, verified.user_id
+
+        expected_hash = hmac.new(self._secret_key, check_string, hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected_hash, received_hash):
+            return "Invalid Telegram data hash", None
+        return None, None
+
+    def remember(self, data: Mapping[str, Any], user_id: int) -> None:
+        """Marks verified login data as persisted for ``user_id``."""
+        check_string = _check_string(data)
+        entry = _VerifiedLogin(check_string, user_id, time.monotonic() + self._dedup_ttl)
+        with self._lock:
+            self._verified[data['hash']] = entry
+            self._verified.move_to_end(data['hash'])
+            while len(self._verified) > self._dedup_size:
+                self._verified.popitem(last=False)
+
+
+def upsert_login(conn: sqlite3.Connection, telegram_id: int, profile: Dict[str, Any],
+                 referral_code: str, referrer_id: Optional[int],
+                 id_sequence: Optional[Tuple[int, int]] = None) -> Tuple[int, bool, bool]:
+    """Writes a verified login and returns (user_id, created, changed).
+
+    Does not commit: the caller must commit or roll back whatever the result.
+
+    A returning user costs one indexed read, plus one UPDATE of only the
+    profile fields that differ from the stored row; an unchanged login writes
+    nothing. ``id_sequence`` comes from the storage backend and picks the id
+    of a new user (see storage.id_insert()).
+    """
+    row = conn.execute(
+        f"SELECT id, {', '.join(PROFILE_FIELDS)} FROM users WHERE telegram_id = ?", (telegram_id,)
+    ).fetchone()
+    if row is None:
+        id_column, id_value, id_params = storage.id_insert('users', id_sequence)
+        created = conn.execute(
+            f"INSERT INTO users ({id_column}telegram_id, {', '.join(PROFILE_FIELDS)}, referral_code, referrer_id) "
+            f"VALUES ({id_value}?, {', '.join('?' for _ in PROFILE_FIELDS)}, ?, ?) "
+            "ON CONFLICT(telegram_id) DO NOTHING RETURNING id",
+            (*id_params, telegram_id, *(profile.get(field) for field in PROFILE_FIELDS), referral_code, referrer_id)
+        ).fetchone()
+        if created is not None:
+            return created['id'], True, True
+        # Created by a concurrent login since the read; update it like any returning user.
+        return upsert_login(conn, telegram_id, profile, referral_code, referrer_id, id_sequence)
+
+    changed = [field for field in PROFILE_FIELDS if row[field] != profile.get(field)]
+    if not changed:
+        return row['id'], False, False
+    conn.execute(
+        f"UPDATE users SET {', '.join(f'{field} = ?' for field in changed)} WHERE id = ?",
+        (*(profile.get(field) for field in changed), row['id'])
+    )
+    return row['id'], False, True
+
+
+def insert_bot_user(conn: sqlite3.Connection, telegram_id: int, first_name: Optional[str], username: Optional[str],
+                    referral_code: str, id_sequence: Optional[Tuple[int, int]] = None) -> bool:
+    # Registers a user who started the bot before logging in on the web; returns
+    # whether the user is new. OR IGNORE keeps concurrent /start commands from the
+    # same new user from colliding. Does not commit.
+    id_column, id_value, id_params = storage.id_insert('users', id_sequence)
+    return conn.execute(
+        f"INSERT OR IGNORE INTO users ({id_column}telegram_id, first_name, username, referral_code) "
+        f"VALUES ({id_value}?, ?, ?, ?)",
+        (*id_params, telegram_id, first_name, username, referral_code)
+    ).rowcount > 0
@@ -0,0 +1,261 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+
+import instrumentation
+
+if TYPE_CHECKING:
+    import requests # Imported by the sender thread on first use; it is slow to import
+
+# --- Configuration ---
+# Point TELEGRAM_API_URL at a local stub server to exercise the sender in tests.
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
+GLOBAL_RATE_PER_SEC = 30.0 # Telegram's bulk limit for a single bot
+PER_CHAT_INTERVAL = 1.0 # At most one message per second to the same chat
+CLAIM_LEASE_SEC = 60.0 # A claimed row is retried if its worker dies before finishing
+MAX_ATTEMPTS = 8
+MAX_BACKOFF_SEC = 300.0
+
+OUTBOX_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS telegram_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id TEXT NOT NULL,
+        text TEXT NOT NULL,
+        parse_mode TEXT,
+        status TEXT DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at REAL DEFAULT 0,
+        last_error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+OUTBOX_INDEX = "CREATE INDEX IF NOT EXISTS idx_telegram_outbox_due ON telegram_outbox (status, next_attempt_at)"
+
+
+class TelegramOutbox:
+    """Durable queue of Telegram messages drained by a background sender.
+
+    Producers insert rows with ``enqueue()`` inside their own transaction and
+    call ``wake()`` after committing; the request never waits for Telegram.
+    ``start()`` runs the sender before anything is enqueued, so rows left
+    pending by a restarted or crashed worker are sent without new traffic.
+    Every shard has its own telegram_outbox table (so a message commits with
+    the write it announces); ``connect(shard)`` opens one and the sender drains them all.
+    """
+
+    def __init__(self, connect: Callable[[int], sqlite3.Connection], token: str,
+                 shard_count: int = 1, api_url: str = TELEGRAM_API_URL, batch_size: int = 20,
+                 poll_interval: float = 2.0) -> None:
+        self._connect = connect
+        self._shard_count = shard_count
+        self._first_shard = 0 # Rotated so one busy shard cannot starve the others
+        self._send_url = f"{api_url.rstrip('/')}/bot{token}/sendMessage"
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._session: Optional["requests.Session"] = None
+        self._next_send_at = 0.0 # Global pacing, also pushed out by 429 retry_after
+        self._chat_ready_at: Dict[str, float] = {}
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+        self._thread_pid = 0
+        self._start_lock = threading.Lock()
+
+    # --- Producer API ---
+    def enqueue(self, conn: sqlite3.Connection, chat_id: Any, text: str,
+                parse_mode: Optional[str] = 'HTML') -> None:
+        # Does not commit: the message becomes visible together with the
+        # caller's own writes (e.g. the withdrawal it announces).
+        conn.execute(
+            "INSERT INTO telegram_outbox (chat_id, text, parse_mode) VALUES (?, ?, ?)",
+            (str(chat_id), text, parse_mode)
+        )
+
+    def wake(self) -> None:
+        self.start()
+        self._wakeup.set()
+
+    def start(self) -> None:
+        """Starts the sender in this process, unless it is running already."""
+        # Per process: a forked gunicorn worker must not rely on the parent's (dead) sender.
+        if self._stopped or (self._thread is not None and self._thread_pid == os.getpid()):
+            return
+        with self._start_lock:
+            if self._thread is None or self._thread_pid != os.getpid():
+                if self._session is not None and self._thread_pid != os.getpid():
+                    self._session = None # The parent's keep-alive socket is not ours to share
+                self._thread = threading.Thread(target=self._run, name="telegram-outbox", daemon=True)
+                self._thread_pid = os.getpid()
+                self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None and self._thread_pid == os.getpid():
+            self._thread.join(timeout=5)
+        if self._session is not None:
+            self._session.close()
+
+    # --- Sender ---
+    def drain_once(self) -> int:
+        """Claims one batch of due messages, sends them and returns how many were claimed."""
+        rows = self._claim(time.time())
+        if not rows:
+            return 0
+
+        # shard -> (sent, retries, deferred, failed)
+        outcomes: Dict[int, Tuple[List[Tuple[int]], List[Tuple[float, Optional[str], int]],
+                                  List[Tuple[float, int]], List[Tuple[Optional[str], int]]]] = {}
+        for shard, row in rows:
+            if self._stopped:
+                # Leave the rest to the lease so another run picks them up.
+                break
+            sent, retries, deferred, failed = outcomes.setdefault(shard, ([], [], [], []))
+            chat_id = row['chat_id']
+            now = time.monotonic()
+            chat_ready_at = self._chat_ready_at.get(chat_id, 0.0)
+            if chat_ready_at > now:
+                deferred.append((time.time() + chat_ready_at - now, row['id']))
+                continue
+            if self._next_send_at > now:
+                time.sleep(self._next_send_at - now)
+
+            started = time.monotonic()
+            outcome, retry_after, error = self._send(row)
+            now = time.monotonic()
+            instrumentation.observe_telegram('sendMessage', now - started, outcome)
+            self._next_send_at = max(self._next_send_at, now + 1.0 / GLOBAL_RATE_PER_SEC)
+            self._chat_ready_at[chat_id] = now + PER_CHAT_INTERVAL
+
+            if outcome == 'sent':
+                sent.append((row['id'],))
+            elif outcome == 'failed' or row['attempts'] + 1 >= MAX_ATTEMPTS:
+                failed.append((error, row['id']))
+            else:
+                if retry_after is not None:
+                    self._next_send_at = max(self._next_send_at, now + retry_after)
+                    delay = retry_after
+                else:
+                    delay = min(MAX_BACKOFF_SEC, 2 ** row['attempts']) * random.uniform(0.5, 1.5)
+                retries.append((time.time() + delay, error, row['id']))
+
+        self._forget_idle_chats()
+        for shard, results in outcomes.items():
+            self._record_results(shard, *results)
+        return len(rows)
+
+    def _claim(self, now: float) -> List[Tuple[int, sqlite3.Row]]:
+        claimed: List[Tuple[int, sqlite3.Row]] = []
+        for step in range(self._shard_count):
+            if len(claimed) >= self._batch_size:
+                break
+            shard = (self._first_shard + step) % self._shard_count
+            claimed.extend((shard, row) for row in self._claim_shard(shard, now, self._batch_size - len(claimed)))
+        self._first_shard = (self._first_shard + 1) % self._shard_count
+        return claimed
+
+    def _claim_shard(self, shard: int, now: float, limit: int) -> List[sqlite3.Row]:
+        # Claiming pushes next_attempt_at past the lease, so concurrent workers
+        # (one sender per gunicorn worker) never pick up the same row.
+        conn = self._connect(shard)
+        try:
+            rows = conn.execute(
+                """
+                UPDATE telegram_outbox SET next_attempt_at = ?
+                WHERE id IN (
+                    SELECT id FROM telegram_outbox
+                    WHERE status = 'pending' AND next_attempt_at <= ?
+                    ORDER BY id LIMIT ?
+                )
+                RETURNING id, chat_id, text, parse_mode, attempts
+                """,
+                (now + CLAIM_LEASE_SEC, now, limit)
+            ).fetchall()
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            print(f"Error claiming Telegram outbox rows: {e}")
+            return []
+        finally:
+            conn.close()
+        return sorted(rows, key=lambda row: row['id'])
+
+    def _send(self, row: sqlite3.Row) -> Tuple[str, Optional[float], Optional[str]]:
+        payload: Dict[str, Any] = {'chat_id': row['chat_id'], 'text': row['text']}
+        if row['parse_mode']:
+            payload['parse_mode'] = row['parse_mode']
+        import requests
+
+        try:
+            response = self._get_session().post(self._send_url, json=payload, timeout=(3.05, 10))
+        except requests.exceptions.RequestException as e:
+            return 'retry', None, str(e)
+
+        if response.status_code == 200:
+            return 'sent', None, None
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        error = f"HTTP {response.status_code}: {body.get('description', response.text[:200])}"
+        if response.status_code == 429:
+            retry_after = float(body.get('parameters', {}).get('retry_after', 1))
+            return 'retry', retry_after, error
+        if response.status_code >= 500:
+            return 'retry', None, error
+        # Any other 4xx (blocked bot, bad chat id, malformed HTML) will not fix itself.
+        return 'failed', None, error
+
+    def _record_results(self, shard: int, sent: List[Tuple[int]], retries: List[Tuple[float, Optional[str], int]],
+                        deferred: List[Tuple[float, int]], failed: List[Tuple[Optional[str], int]]) -> None:
+        conn = self._connect(shard)
+        try:
+            conn.executemany("DELETE FROM telegram_outbox WHERE id = ?", sent)
+            conn.executemany(
+                "UPDATE telegram_outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = COALESCE(?, last_error) WHERE id = ?",
+                retries
+            )
+            # Deferred only because of the per-chat limit; not a failed attempt.
+            conn.executemany("UPDATE telegram_outbox SET next_attempt_at = ? WHERE id = ?", deferred)
+            conn.executemany(
+                "UPDATE telegram_outbox SET status = 'failed', attempts = attempts + 1, last_error = ? WHERE id = ?",
+                failed
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            # Unrecorded rows fall back to their lease and are sent again.
+            conn.rollback()
+            print(f"Error recording Telegram outbox results: {e}")
+        finally:
+            conn.close()
+
+    def _get_session(self) -> "requests.Session":
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            # One keep-alive connection to api.telegram.org, reused for every send.
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=0))
+            session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=0))
+            self._session = session
+        return self._session
+
+    def _forget_idle_chats(self) -> None:
+        now = time.monotonic()
+        if len(self._chat_ready_at) > 1000:
+            self._chat_ready_at = {chat: ready for chat, ready in self._chat_ready_at.items() if ready > now}
+
+    def _run(self) -> None:
+        while not self._stopped:
+            try:
+                claimed = self.drain_once()
+            except Exception as e: # Keep the sender alive whatever happens to one batch
+                print(f"Error draining Telegram outbox: {e}")
+                claimed = 0
+            if claimed < self._batch_size:
+                self._wakeup.wait(self._poll_interval)
+                self._wakeup.clear()
@@ -0,0 +1,118 @@
+import json
+import sqlite3
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import ledger
+import storage
+from storage import FanOut
+
+# --- Configuration ---
+MIN_ADS_FOR_WITHDRAWAL = 50
+WITHDRAWAL_STATUSES = ('completed', 'rejected')
+MAX_BATCH_SIZE = 500 # Withdrawals per payout batch or bulk status update
+
+
+class WithdrawalError(ValueError):
+    def __init__(self, message: str, status_code: int = 400) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# --- Withdrawals ---
+def request_withdrawal(conn: sqlite3.Connection, user_id: int, ton_wallet_address: str,
+                       id_sequence: Optional[Tuple[int, int]] = None) -> sqlite3.Row:
+    """Debits the user's whole balance and records the withdrawal.
+
+    Leaves the transaction open so the caller can add its own writes (the
+    admin notification) and commit; rolls back and raises WithdrawalError if
+    the user cannot withdraw. ``conn`` is the user's shard.
+    """
+    # The write lock is taken up front, so the balance read by the guarded
+    # insert below cannot change before the debit is written.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Materialized, so the balance is summed once for both the check and the debit.
+        debit = conn.execute(
+            """
+            WITH b AS MATERIALIZED (
+                SELECT id, balance_nano FROM user_balances WHERE id = ? AND ads_viewed >= ?
+            )
+            INSERT INTO earnings_ledger (user_id, amount_nano, kind)
+            SELECT id, -balance_nano, 'withdrawal' FROM b WHERE balance_nano > 0
+            RETURNING -amount_nano AS amount_nano
+            """,
+            (user_id, MIN_ADS_FOR_WITHDRAWAL)
+        ).fetchone()
+        if debit is None:
+            raise WithdrawalError(*_rejection(conn, user_id))
+        id_column, id_value, id_params = storage.id_insert('withdrawals', id_sequence)
+        return conn.execute(
+            f"""
+            INSERT INTO withdrawals ({id_column}user_id, amount, amount_nano, ton_wallet_address)
+            VALUES ({id_value}?, ?, ?, ?)
+            RETURNING *
+            """,
+            (*id_params, user_id, ledger.to_ton(debit['amount_nano']), debit['amount_nano'], ton_wallet_address)
+        ).fetchone()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _rejection(conn: sqlite3.Connection, user_id: int) -> Tuple[str, int]:
+    # Only runs after the guarded insert matched nothing, to explain why.
+    user = conn.execute("SELECT ads_viewed, balance_nano FROM user_balances WHERE id = ?", (user_id,)).fetchone()
+    if user is None:
+        return "User not found", 404
+    if user['ads_viewed'] < MIN_ADS_FOR_WITHDRAWAL:
+        return f"You must view at least {MIN_ADS_FOR_WITHDRAWAL} ads before withdrawing", 400
+    return "No earnings to withdraw", 400
+
+
+# --- Payout queue ---
+def payout_queue(fan_out: FanOut, limit: int) -> Dict[str, Any]:
+    # Oldest pending withdrawals first, straight off idx_withdrawals_status.
+    limit = min(limit, MAX_BATCH_SIZE)
+    results = fan_out(lambda conn: conn.execute(
+        """
+        SELECT w.*, u.username, u.first_name
+        FROM withdrawals w
+        JOIN users u ON w.user_id = u.id
+        WHERE w.status = 'pending'
+        ORDER BY w.id
+        LIMIT ?
+        """,
+        (limit,)
+    ).fetchall())
+    # Ids only grow within a shard, so across shards the request time decides who is paid first.
+    rows = storage.merge_sorted(results, key=lambda row: (storage.sort_value(row['created_at']), row['id']))
+    withdrawals = [dict(row) for row in rows[:limit]]
+    total_nano = sum(row['amount_nano'] or 0 for row in withdrawals)
+    return {"withdrawals": withdrawals, "total_nano": total_nano}
+
+
+def check_status_update(withdrawal_ids: Sequence[int], status: Any) -> None:
+    if status not in WITHDRAWAL_STATUSES:
+        raise WithdrawalError("Invalid status")
+    if not withdrawal_ids or len(withdrawal_ids) > MAX_BATCH_SIZE:
+        raise WithdrawalError(f"Between 1 and {MAX_BATCH_SIZE} withdrawal ids are required")
+    if not all(isinstance(withdrawal_id, int) for withdrawal_id in withdrawal_ids):
+        raise WithdrawalError("Withdrawal ids must be integers")
+
+
+def update_statuses(conn: sqlite3.Connection, withdrawal_ids: Sequence[int], status: str) -> List[int]:
+    """Moves pending withdrawals to ``status`` in one statement and returns the ids that changed.
+
+    Withdrawals that were already completed or rejected are left alone, so a
+    batch submitted twice cannot pay anyone twice. Does not commit.
+    """
+    check_status_update(withdrawal_ids, status)
+    rows = conn.execute(
+        """
+        UPDATE withdrawals SET status = ?
+        WHERE status = 'pending' AND id IN (SELECT value FROM json_each(?))
+        RETURNING id
+        """,
+        (status, json.dumps(list(withdrawal_ids)))
+    ).fetchall()
+    return sorted(row['id'] for row in rows)
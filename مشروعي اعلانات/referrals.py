@@ -0,0 +1,180 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from storage import FanOut, merge_sorted
+
+# --- Configuration ---
+# Commission paid to each referral level, as a fraction of the referee's ad reward:
+# "0.10" pays the direct referrer 10%; "0.10,0.05" also pays their referrer 5%.
+REFERRAL_COMMISSION_RATES = tuple(
+    float(rate) for rate in os.environ.get("REFERRAL_COMMISSION_RATES", "0.10").split(",") if rate.strip()
+)
+
+REFERRAL_SCHEMA = (
+    # "Who did I refer" is a range scan on this index instead of a table scan.
+    "CREATE INDEX IF NOT EXISTS idx_users_referrer ON users (referrer_id, id)",
+    # Lifetime commission per (referrer, referee) pair, maintained by the
+    # ad-view flusher; ledger rows are compacted away, these totals are not.
+    """
+    CREATE TABLE IF NOT EXISTS referral_earnings (
+        referrer_id INTEGER NOT NULL,
+        referee_id INTEGER NOT NULL,
+        level INTEGER NOT NULL,
+        total_nano INTEGER NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (referrer_id, referee_id)
+    ) WITHOUT ROWID
+    """,
+)
+
+
+class ReferralEngine:
+    """Resolves referral chains and turns one ad reward into per-level commissions.
+
+    A user's chain of referrers never changes once registered, so it is loaded
+    with a recursive query (one per shard the chain crosses) and then served
+    from an in-process LRU. ``connect`` returns the connection of a user's shard.
+    """
+
+    def __init__(self, connect: Callable[[int], sqlite3.Connection],
+                 rates: Sequence[float] = REFERRAL_COMMISSION_RATES, cache_size: int = 100000) -> None:
+        self._connect = connect
+        self._rates = tuple(rates)
+        self._cache_size = cache_size
+        self._chains: "OrderedDict[int, Tuple[int, ...]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_depth(self) -> int:
+        return len(self._rates)
+
+    def chain(self, user_id: int, referrer_id: Optional[int] = None) -> Tuple[int, ...]:
+        """Referrer ids of ``user_id``, nearest first, at most ``max_depth`` long."""
+        with self._lock:
+            chain = self._chains.get(user_id)
+            if chain is not None:
+                self._chains.move_to_end(user_id)
+                return chain
+        if self.max_depth <= 1 and referrer_id is not None:
+            # Single-level commissions only need the referrer_id the caller already has.
+            chain = (referrer_id,) if referrer_id != user_id else ()
+        else:
+            chain = self._load_chain(user_id)
+        with self._lock:
+            self._chains[user_id] = chain
+            while len(self._chains) > self._cache_size:
+                self._chains.popitem(last=False)
+        return chain
+
+    def commissions_for(self, user_id: int, referrer_id: Optional[int], reward_nano: int) -> List[Tuple[int, int, int]]:
+        """(referrer_id, level, amount_nano) for every level paid on one ad reward."""
+        if not referrer_id or not self._rates:
+            return []
+        return [
+            (ancestor_id, level, int(reward_nano * rate))
+            for level, (ancestor_id, rate) in enumerate(zip(self.chain(user_id, referrer_id), self._rates), start=1)
+        ]
+
+    def _load_chain(self, user_id: int) -> Tuple[int, ...]:
+        # The recursion stops where the next referrer is stored in another
+        # shard's file; the walk then continues from that referrer's shard.
+        ids: List[int] = []
+        start_id: Optional[int] = user_id
+        while start_id is not None and len(ids) <= self.max_depth:
+            conn = self._connect(start_id)
+            try:
+                rows = conn.execute(
+                    """
+                    WITH RECURSIVE chain(id, referrer_id, level) AS (
+                        SELECT id, referrer_id, 0 FROM users WHERE id = ?1
+                        UNION ALL
+                        SELECT u.id, u.referrer_id, chain.level + 1
+                        FROM users u JOIN chain ON u.id = chain.referrer_id
+                        WHERE chain.level < ?2
+                    )
+                    SELECT id, referrer_id FROM chain ORDER BY level
+                    """,
+                    (start_id, self.max_depth - len(ids))
+                ).fetchall()
+            finally:
+                conn.close()
+            ids.extend(row['id'] for row in rows)
+            start_id = rows[-1]['referrer_id'] if rows else None
+        # ids[0] is the user. Stop at the first cycle (including self-referral) instead of paying it.
+        chain: List[int] = []
+        for referrer_id in ids[1:self.max_depth + 1]:
+            if referrer_id == user_id or referrer_id in chain:
+                break
+            chain.append(referrer_id)
+        return tuple(chain)
+
+
+# --- Writes ---
+def record_commissions(conn: sqlite3.Connection, entries: Iterable[Tuple[int, int, int, int]]) -> None:
+    # (referrer_id, referee_id, level, amount_nano), already aggregated per
+    # flush. Does not commit.
+    conn.executemany(
+        """
+        INSERT INTO referral_earnings (referrer_id, referee_id, level, total_nano)
+        SELECT ?1, ?2, ?3, ?4 WHERE EXISTS (SELECT 1 FROM users WHERE id = ?1)
+        ON CONFLICT(referrer_id, referee_id) DO UPDATE SET
+            total_nano = total_nano + excluded.total_nano,
+            updated_at = CURRENT_TIMESTAMP
+        """,
+        entries
+    )
+
+
+# --- Queries ---
+def list_referees(fan_out: FanOut, viewer_conn: sqlite3.Connection, viewer_id: int, parent_id: int,
+                  before_id: Optional[int], limit: int) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    # Direct referees of parent_id (the viewer or someone in their tree), with
+    # what the viewer has earned from each of them. Referees can be on any
+    # shard; the viewer's commissions are on the viewer's (``viewer_conn``).
+    params: List[Any] = [parent_id]
+    where = "u.referrer_id = ?"
+    if before_id is not None:
+        where += " AND u.id < ?"
+        params.append(before_id)
+    results = fan_out(lambda conn: conn.execute(
+        f"""
+        SELECT
+            u.id, u.first_name, u.username, u.ads_viewed, u.created_at,
+            COALESCE(s.referees, 0) AS referral_count
+        FROM users u
+        LEFT JOIN user_stats s ON s.user_id = u.id
+        WHERE {where}
+        ORDER BY u.id DESC
+        LIMIT ?
+        """,
+        params + [limit + 1]
+    ).fetchall())
+    rows = merge_sorted(results, key=lambda row: row['id'], reverse=True)
+    has_more = len(rows) > limit
+    referees = [dict(row) for row in rows[:limit]]
+    commissions = dict(viewer_conn.execute(
+        """
+        SELECT referee_id, total_nano FROM referral_earnings
+        WHERE referrer_id = ? AND referee_id IN (SELECT value FROM json_each(?))
+        """,
+        (viewer_id, json.dumps([referee['id'] for referee in referees]))
+    ).fetchall())
+    for referee in referees:
+        referee['commission_nano'] = commissions.get(referee['id'], 0)
+    return referees, (referees[-1]['id'] if has_more else None)
+
+
+def summarize(conn: sqlite3.Connection, referrer_id: int) -> List[Dict[str, Any]]:
+    rows = conn.execute(
+        """
+        SELECT level, COUNT(*) AS referees, SUM(total_nano) AS commission_nano
+        FROM referral_earnings WHERE referrer_id = ?
+        GROUP BY level ORDER BY level
+        """,
+        (referrer_id,)
+    ).fetchall()
+    return [dict(row) for row in rows]
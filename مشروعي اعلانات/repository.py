@@ -0,0 +1,170 @@
+import json
+import sqlite3
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import admin_queries
+import login_auth
+import payouts
+import referrals
+import stats
+from storage import SQLiteStorage
+
+
+class Repository:
+    """The writes and queries of the routes, routed to the right shard of ``storage``.
+
+    Each method works the same on one database file or on many; the ones that
+    touch a single user run on that user's shard in one transaction. The only
+    cross-shard writes are referee counts for a referrer stored on another
+    shard, committed right after the new user (see _count_referee()).
+    """
+
+    def __init__(self, storage: SQLiteStorage) -> None:
+        self.storage = storage
+
+    # --- Users ---
+    def register_login(self, telegram_id: int, profile: Dict[str, Any], referral_code: str,
+                       referrer_id: Optional[int],
+                       on_created: Callable[[sqlite3.Connection], None]) -> Tuple[int, bool, bool]:
+        """login_auth.upsert_login() on the user's shard; ``on_created`` adds its writes to a new user's transaction."""
+        shard = self._telegram_shard(telegram_id)
+        conn = self.storage.connect(shard)
+        try:
+            user_id, created, changed = login_auth.upsert_login(
+                conn, telegram_id, profile, referral_code, referrer_id, self.storage.id_sequence(shard)
+            )
+            if created:
+                on_created(conn)
+            # Also when nothing changed, so no path leaves a transaction open.
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        if created and referrer_id is not None:
+            self._count_referee(shard, referrer_id)
+        return user_id, created, changed
+
+    def register_bot_user(self, telegram_id: int, first_name: Optional[str], username: Optional[str],
+                          referral_code: str, on_created: Callable[[sqlite3.Connection], None]) -> bool:
+        # Runs on the bot's worker thread, where no request teardown rolls back a failed transaction.
+        shard = self._telegram_shard(telegram_id)
+        conn = self.storage.connect(shard)
+        try:
+            created = login_auth.insert_bot_user(conn, telegram_id, first_name, username, referral_code,
+                                                 self.storage.id_sequence(shard))
+            if created:
+                on_created(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return created
+
+    def _telegram_shard(self, telegram_id: int) -> int:
+        # New users are created on shard telegram_id % shard_count, so that is
+        # where a returning user almost always is; users that came in through
+        # an import are stored by id and need the fan-out.
+        if self.storage.shard_count == 1:
+            return 0
+        home = telegram_id % self.storage.shard_count
+        query = lambda conn: conn.execute("SELECT 1 FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+        if query(self.storage.connect(home)):
+            return home
+        others = [shard for shard in range(self.storage.shard_count) if shard != home]
+        for shard, found in zip(others, self.storage.fan_out(query, others)):
+            if found:
+                return shard
+        return home
+
+    def _count_referee(self, shard: int, referrer_id: int) -> None:
+        # The insert trigger counted the referee if the referrer shares its shard.
+        referrer_shard = self.storage.shard_of(referrer_id)
+        if referrer_shard == shard:
+            return
+        conn = self.storage.connect(referrer_shard)
+        try:
+            stats.count_referees(conn, {referrer_id: 1})
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            print(f"Error counting referee for user {referrer_id}: {e}")
+        finally:
+            conn.close()
+
+    # --- Withdrawals ---
+    def request_withdrawal(self, user_id: int, ton_wallet_address: str,
+                           on_requested: Callable[[sqlite3.Connection, sqlite3.Row, sqlite3.Row], None]
+                           ) -> Tuple[sqlite3.Row, sqlite3.Row]:
+        """payouts.request_withdrawal() on the user's shard; returns (withdrawal, user).
+
+        ``on_requested(conn, withdrawal, user)`` runs inside the transaction
+        before it commits. Raises payouts.WithdrawalError.
+        """
+        shard = self.storage.shard_of(user_id)
+        conn = self.storage.connect(shard)
+        try:
+            withdrawal = payouts.request_withdrawal(conn, user_id, ton_wallet_address,
+                                                    self.storage.id_sequence(shard))
+            user = conn.execute("SELECT first_name, username, telegram_id FROM users WHERE id = ?",
+                                (user_id,)).fetchone()
+            on_requested(conn, withdrawal, user)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        return withdrawal, user
+
+    def update_withdrawal_statuses(self, withdrawal_ids: Sequence[int], status: str) -> List[int]:
+        """payouts.update_statuses() on every shard holding one of the ids; returns the ids that changed.
+
+        Each shard commits on its own, so a failure can leave other shards' updates applied;
+        the update only moves pending withdrawals, so submitting the batch again is safe.
+        """
+        payouts.check_status_update(withdrawal_ids, status)
+        if self.storage.shard_count == 1:
+            shards = [0]
+        else:
+            ids = json.dumps(list(withdrawal_ids))
+            found = self.storage.fan_out(lambda conn: conn.execute(
+                "SELECT 1 FROM withdrawals WHERE id IN (SELECT value FROM json_each(?)) LIMIT 1", (ids,)
+            ).fetchone())
+            shards = [shard for shard, row in enumerate(found) if row]
+
+        def update(conn: sqlite3.Connection) -> List[int]:
+            try:
+                updated = payouts.update_statuses(conn, withdrawal_ids, status)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            return updated
+
+        return sorted(withdrawal_id for updated in self.storage.fan_out(update, shards) for withdrawal_id in updated)
+
+    def payout_queue(self, limit: int) -> Dict[str, Any]:
+        return payouts.payout_queue(self.storage.fan_out, limit)
+
+    # --- Queries ---
+    def list_users(self, **kwargs: Any) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        return admin_queries.list_users(self.storage, **kwargs)
+
+    def list_withdrawals(self, **kwargs: Any) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        return admin_queries.list_withdrawals(self.storage, **kwargs)
+
+    def list_referees(self, viewer_id: int, parent_id: int, before_id: Optional[int],
+                      limit: int) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        return referrals.list_referees(self.storage.fan_out, self.storage.for_user(viewer_id),
+                                       viewer_id, parent_id, before_id, limit)
+
+    def referral_summary(self, referrer_id: int) -> List[Dict[str, Any]]:
+        # Commissions are stored with the referrer who earned them.
+        return referrals.summarize(self.storage.for_user(referrer_id), referrer_id)
+
+    def platform_totals(self) -> Dict[str, int]:
+        return stats.platform_totals(self.storage.fan_out)
@@ -0,0 +1,178 @@
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+# --- Schema ---
+# External-content FTS5 tables: the text lives in users/withdrawals, the index
+# is kept in sync by triggers. The users triggers only fire for the searchable
+# columns, so the batched ads_viewed updates never touch the index.
+SEARCH_SCHEMA = (
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+        username, first_name, last_name, telegram_id,
+        content='users', content_rowid='id',
+        prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts (rowid, username, first_name, last_name, telegram_id)
+        VALUES (new.id, new.username, new.first_name, new.last_name, new.telegram_id);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts (users_fts, rowid, username, first_name, last_name, telegram_id)
+        VALUES ('delete', old.id, old.username, old.first_name, old.last_name, old.telegram_id);
+    END
+    """,
+    # A login that rewrites an unchanged name must not reindex the row.
+    """
+    CREATE TRIGGER IF NOT EXISTS users_fts_update
+    AFTER UPDATE OF username, first_name, last_name, telegram_id ON users
+    WHEN old.username IS NOT new.username OR old.first_name IS NOT new.first_name
+        OR old.last_name IS NOT new.last_name OR old.telegram_id IS NOT new.telegram_id
+    BEGIN
+        INSERT INTO users_fts (users_fts, rowid, username, first_name, last_name, telegram_id)
+        VALUES ('delete', old.id, old.username, old.first_name, old.last_name, old.telegram_id);
+        INSERT INTO users_fts (rowid, username, first_name, last_name, telegram_id)
+        VALUES (new.id, new.username, new.first_name, new.last_name, new.telegram_id);
+    END
+    """,
+    # Trigram tokens make any 3+ character fragment of a TON address searchable.
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS withdrawals_fts USING fts5(
+        ton_wallet_address,
+        content='withdrawals', content_rowid='id',
+        tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS withdrawals_fts_insert AFTER INSERT ON withdrawals BEGIN
+        INSERT INTO withdrawals_fts (rowid, ton_wallet_address) VALUES (new.id, new.ton_wallet_address);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS withdrawals_fts_delete AFTER DELETE ON withdrawals BEGIN
+        INSERT INTO withdrawals_fts (withdrawals_fts, rowid, ton_wallet_address)
+        VALUES ('delete', old.id, old.ton_wallet_address);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS withdrawals_fts_update AFTER UPDATE OF ton_wallet_address ON withdrawals BEGIN
+        INSERT INTO withdrawals_fts (withdrawals_fts, rowid, ton_wallet_address)
+        VALUES ('delete', old.id, old.ton_wallet_address);
+        INSERT INTO withdrawals_fts (rowid, ton_wallet_address) VALUES (new.id, new.ton_wallet_address);
+    END
+    """,
+)
+
+MIN_TRIGRAM_LENGTH = 3
+SCHEMA_VERSION = 3 # PRAGMA user_version step (after stats.SCHEMA_VERSION) that adds the WHEN clause
+
+_available: Optional[bool] = None
+_available_lock = threading.Lock()
+
+
+def init_search_index(cursor: sqlite3.Cursor) -> bool:
+    # Returns False (and leaves the LIKE/prefix fallbacks in charge) when this
+    # SQLite build has no FTS5 or no trigram tokenizer.
+    existing = {row[0] for row in cursor.execute(
+        "SELECT name FROM sqlite_master WHERE name IN ('users_fts', 'withdrawals_fts')"
+    )}
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    if version < SCHEMA_VERSION:
+        # Databases from before the WHEN clause have a users_fts_update that fires on every login.
+        cursor.execute("DROP TRIGGER IF EXISTS users_fts_update")
+    try:
+        for statement in SEARCH_SCHEMA:
+            cursor.execute(statement)
+    except sqlite3.OperationalError as e:
+        print(f"Full-text search disabled: {e}")
+        _set_available(False)
+        return False
+    # Index rows that were written before the FTS tables existed.
+    if 'users_fts' not in existing:
+        cursor.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+    if 'withdrawals_fts' not in existing:
+        cursor.execute("INSERT INTO withdrawals_fts (withdrawals_fts) VALUES ('rebuild')")
+    if version < SCHEMA_VERSION:
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    _set_available(True)
+    return True
+
+
+def _set_available(available: bool) -> None:
+    global _available
+    with _available_lock:
+        _available = available
+
+
+def fts_available(conn: sqlite3.Connection) -> bool:
+    global _available
+    if _available is None:
+        with _available_lock:
+            if _available is None:
+                row = conn.execute(
+                    "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN ('users_fts', 'withdrawals_fts')"
+                ).fetchone()
+                _available = row[0] == 2
+    return _available
+
+
+def _quote(token: str) -> str:
+    return '"' + token.replace('"', '""') + '"'
+
+
+def user_match_expression(search: str) -> Optional[str]:
+    # Every word must match as a prefix: "john do" -> "john"* AND "do"*
+    tokens = [token.lstrip('@') for token in search.split()]
+    tokens = [token for token in tokens if token]
+    if not tokens:
+        return None
+    return ' '.join(_quote(token) + '*' for token in tokens)
+
+
+def wallet_match_expression(search: str) -> Optional[str]:
+    search = search.strip()
+    if len(search) < MIN_TRIGRAM_LENGTH or ' ' in search:
+        return None
+    return _quote(search)
+
+
+# --- Queries ---
+def search_users(conn: sqlite3.Connection, search: str, limit: int) -> List[Dict[str, Any]]:
+    expression = user_match_expression(search)
+    if expression is None:
+        return []
+    rows = conn.execute(
+        """
+        SELECT u.*, users_fts.rank AS sort_key FROM users_fts
+        JOIN user_balances u ON u.id = users_fts.rowid
+        WHERE users_fts MATCH ?
+        ORDER BY users_fts.rank
+        LIMIT ?
+        """,
+        (expression, limit)
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def withdrawal_search_condition(search: str) -> Optional[Tuple[str, List[Any]]]:
+    # Matches withdrawals whose wallet contains the term, or whose user's
+    # name/username/telegram_id does; both sides are FTS index lookups.
+    user_expression = user_match_expression(search)
+    wallet_expression = wallet_match_expression(search)
+    parts: List[str] = []
+    params: List[Any] = []
+    if wallet_expression is not None:
+        parts.append("SELECT rowid FROM withdrawals_fts WHERE withdrawals_fts MATCH ?")
+        params.append(wallet_expression)
+    if user_expression is not None:
+        parts.append(
+            "SELECT id FROM withdrawals WHERE user_id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)"
+        )
+        params.append(user_expression)
+    if not parts:
+        return None
+    return f"w.id IN ({' UNION '.join(parts)})", params
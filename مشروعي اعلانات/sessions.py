@@ -0,0 +1,252 @@
+import hashlib
+import os
+import secrets
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from flask import Flask, Request, Response
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+from itsdangerous import BadSignature, Signer
+
+# --- Configuration ---
+# "server" keeps session data in SQLite behind an in-process cache and puts
+# only a signed session id in the cookie; "cookie" is Flask's signed-cookie session.
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "server")
+SESSION_TTL_SEC = float(os.environ.get("SESSION_TTL_SEC", str(30 * 86400)))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "10000"))
+# How long a worker trusts its cached copy; a logout on another worker takes effect here after this.
+SESSION_CACHE_TTL_SEC = float(os.environ.get("SESSION_CACHE_TTL_SEC", "60"))
+PURGE_INTERVAL_SEC = 600.0 # Expired sessions are deleted at most this often
+DEV_SECRET_KEY = b"smartcoinlabs-development-key" # Debug mode only; never valid in production
+# Keys that say who the session belongs to; a session whose value for one of
+# them changes (a login, a switch to another account) gets a new id.
+IDENTITY_KEYS = ('user_id',)
+
+SESSION_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    ) WITHOUT ROWID
+'''
+SESSION_INDEX = "CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)"
+
+
+def secret_key(debug: bool) -> bytes:
+    """The key that signs session cookies and ad tickets; FLASK_SECRET_KEY, the same in every worker and instance.
+
+    Required outside debug mode; a debug server without it signs with a
+    fixed, public development key so sessions survive the reloader.
+    """
+    configured = os.environ.get("FLASK_SECRET_KEY")
+    if configured:
+        return configured.encode("utf-8")
+    if not debug:
+        raise RuntimeError("FLASK_SECRET_KEY is not set; it is required outside debug mode")
+    print("FLASK_SECRET_KEY is not set; using the fixed development key (debug mode only)")
+    return DEV_SECRET_KEY
+
+
+class StoredSession(NamedTuple):
+    data: Dict[str, Any]
+    expires_at: float # time.time() at which the session ends
+    cached_until: float # time.monotonic() after which it is re-read
+
+
+class SQLiteSessionStore:
+    """Session data by session id, spread over the storage shards.
+
+    Reads are served from an in-process LRU (O(1) per request once a worker
+    has seen the session) and fall back to a primary-key lookup. Expiry
+    slides: a session used after half its lifetime is extended, so an
+    active session costs one write per SESSION_TTL_SEC / 2.
+    """
+
+    def __init__(self, connect: Callable[[int], sqlite3.Connection], shard_count: int,
+                 fan_out: Callable[[Callable[[sqlite3.Connection], int]], List[int]],
+                 on_first_use: Callable[[], None] = lambda: None, ttl: float = SESSION_TTL_SEC,
+                 cache_size: int = SESSION_CACHE_SIZE, cache_ttl: float = SESSION_CACHE_TTL_SEC) -> None:
+        self._connect = connect
+        self._shard_count = shard_count
+        self._fan_out = fan_out
+        # Creates the schema; only requests that carry a session cookie get this far.
+        self._on_first_use = on_first_use
+        self.ttl = ttl
+        self._cache_size = cache_size
+        self._cache_ttl = cache_ttl
+        self._serializer = TaggedJSONSerializer()
+        self._entries: "OrderedDict[str, StoredSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_purge = time.monotonic()
+        self._purge_lock = threading.Lock()
+
+    def load(self, sid: str) -> Optional[StoredSession]:
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is not None:
+                if entry.cached_until > time.monotonic() and entry.expires_at > time.time():
+                    self._entries.move_to_end(sid)
+                    return entry
+                del self._entries[sid]
+        self._on_first_use()
+        conn = self._conn(sid)
+        try:
+            row = conn.execute("SELECT data, expires_at FROM sessions WHERE id = ? AND expires_at > ?",
+                               (sid, time.time())).fetchone()
+        except sqlite3.Error as e:
+            print(f"Error loading session: {e}")
+            return None
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return self._remember(sid, self._serializer.loads(row['data']), row['expires_at'])
+
+    def save(self, sid: str, data: Dict[str, Any]) -> StoredSession:
+        expires_at = time.time() + self.ttl
+        self._write("INSERT OR REPLACE INTO sessions (id, data, expires_at) VALUES (?, ?, ?)",
+                    (sid, self._serializer.dumps(data), expires_at), sid)
+        self.purge_if_due()
+        return self._remember(sid, data, expires_at)
+
+    def touch(self, sid: str, entry: StoredSession) -> Optional[StoredSession]:
+        # Extends a session past the first half of its lifetime; returns the new entry if it did.
+        if entry.expires_at - time.time() > self.ttl / 2:
+            return None
+        expires_at = time.time() + self.ttl
+        self._write("UPDATE sessions SET expires_at = ? WHERE id = ?", (expires_at, sid), sid)
+        return self._remember(sid, entry.data, expires_at)
+
+    def delete(self, sid: str) -> None:
+        with self._lock:
+            self._entries.pop(sid, None)
+        self._write("DELETE FROM sessions WHERE id = ?", (sid,), sid)
+
+    def purge_if_due(self, interval: float = PURGE_INTERVAL_SEC) -> Optional[int]:
+        if time.monotonic() - self._last_purge < interval or not self._purge_lock.acquire(blocking=False):
+            return None
+        try:
+            self._last_purge = time.monotonic()
+            return sum(self._fan_out(self._purge))
+        except sqlite3.Error as e:
+            print(f"Error purging sessions: {e}")
+            return None
+        finally:
+            self._purge_lock.release()
+
+    # --- Internals ---
+    def _conn(self, sid: str) -> sqlite3.Connection:
+        return self._connect(zlib.crc32(sid.encode("ascii")) % self._shard_count)
+
+    def _write(self, sql: str, params: tuple, sid: str) -> None:
+        conn = self._conn(sid)
+        try:
+            conn.execute(sql, params)
+            conn.commit()
+        except sqlite3.Error as e:
+            # The cached copy still serves this worker until it expires.
+            conn.rollback()
+            print(f"Error writing session: {e}")
+        finally:
+            conn.close()
+
+    def _purge(self, conn: sqlite3.Connection) -> int:
+        try:
+            deleted = conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),)).rowcount
+            conn.commit()
+            return deleted
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+    def _remember(self, sid: str, data: Dict[str, Any], expires_at: float) -> StoredSession:
+        entry = StoredSession(data, expires_at, time.monotonic() + self._cache_ttl)
+        with self._lock:
+            self._entries[sid] = entry
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self._cache_size:
+                self._entries.popitem(last=False)
+        return entry
+
+
+class ServerSession(SecureCookieSession):
+    def __init__(self, initial: Optional[Dict[str, Any]] = None, sid: Optional[str] = None,
+                 stored: Optional[StoredSession] = None) -> None:
+        super().__init__(initial)
+        self.sid = sid
+        self.stored = stored # As loaded, to skip writes that would not change anything
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keeps session data server side; the cookie only holds a signed, random session id."""
+
+    def __init__(self, store: SQLiteSessionStore) -> None:
+        self.store = store
+
+    def _signer(self, app: Flask) -> Signer:
+        return Signer(app.secret_key, salt="session-id", key_derivation="hmac", digest_method=hashlib.sha256)
+
+    def open_session(self, app: Flask, request: Request) -> ServerSession:
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if not cookie:
+            return ServerSession()
+        try:
+            # Checked before any lookup, so made-up ids never reach the store.
+            sid = self._signer(app).unsign(cookie).decode("ascii")
+        except (BadSignature, UnicodeDecodeError):
+            return ServerSession()
+        stored = self.store.load(sid)
+        if stored is None:
+            return ServerSession(sid=sid)
+        return ServerSession(dict(stored.data), sid, stored)
+
+    def save_session(self, app: Flask, session: ServerSession, response: Response) -> None:
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if not session:
+            if session.modified:
+                if session.stored is not None:
+                    self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure,
+                                       samesite=samesite, httponly=httponly)
+                response.vary.add("Cookie")
+            return
+
+        if session.stored is not None and dict(session) == session.stored.data:
+            # Unchanged (a login that stores the same user id again); only extend it when due.
+            entry = self.store.touch(session.sid, session.stored)
+        else:
+            if session.sid is None or session.stored is None:
+                session.sid = secrets.token_urlsafe(24) # A fresh id whenever a session starts
+            elif any(session.get(key) != session.stored.data.get(key) for key in IDENTITY_KEYS):
+                # No fixation: an id known before the login stops working with it.
+                self.store.delete(session.sid)
+                session.sid = secrets.token_urlsafe(24)
+            entry = self.store.save(session.sid, dict(session))
+        if entry is None:
+            return
+        response.set_cookie(
+            name,
+            self._signer(app).sign(session.sid).decode("ascii"),
+            expires=datetime.fromtimestamp(entry.expires_at, timezone.utc),
+            httponly=httponly,
+            domain=domain,
+            path=path,
+            secure=secure,
+            samesite=samesite,
+        )
+        response.vary.add("Cookie")
@@ -6,13 +6,36 @@ document.addEventListener('DOMContentLoaded', () => {
     const withdrawalSearchInput = document.getElementById('withdrawal-search-input');
     const withdrawalSearchButton = document.getElementById('withdrawal-search-button');
     const adminLogoutButton = document.getElementById('admin-logout-button');
+    const usersLoadMoreButton = document.getElementById('users-load-more');
+    const withdrawalsLoadMoreButton = document.getElementById('withdrawals-load-more');
+    const payoutQueueButton = document.getElementById('payout-queue-button');
+    const approveSelectedButton = document.getElementById('approve-selected-button');
+    const rejectSelectedButton = document.getElementById('reject-selected-button');
+    const selectAllWithdrawals = document.getElementById('select-all-withdrawals');
 
-    async function fetchUsers(searchTerm = '') {
+    // Listings are paginated server-side; these hold the state of the current listing
+    let userSearchTerm = '';
+    let userSort = 'id';
+    let userOrder = 'desc';
+    let usersNextCursor = null;
+    let withdrawalSearchTerm = '';
+    let withdrawalsNextCursor = null;
+    let showingPayoutQueue = false;
+    const shownWithdrawals = new Map(); // id -> withdrawal of every row in the table, for live updates
+
+    async function fetchUsers(searchTerm = '', append = false) {
         try {
-            const response = await fetch(`/api/admin/users?search=${searchTerm}`);
+            userSearchTerm = searchTerm;
+            const params = new URLSearchParams({ search: searchTerm, sort: userSort, order: userOrder });
+            if (append && usersNextCursor) {
+                params.set('cursor', usersNextCursor);
+            }
+            const response = await fetch(`/api/admin/users?${params}`);
             const data = await response.json();
             if (data.success) {
-                renderUsers(data.users);
+                renderUsers(data.users, append);
+                usersNextCursor = data.next_cursor;
+                usersLoadMoreButton.style.display = usersNextCursor ? 'inline-block' : 'none';
             } else {
                 alert('Failed to fetch users: ' + data.message);
             }
@@ -22,8 +45,10 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    function renderUsers(users) {
-        usersTableBody.innerHTML = '';
+    function renderUsers(users, append = false) {
+        if (!append) {
+            usersTableBody.innerHTML = '';
+        }
         users.forEach(user => {
             const row = usersTableBody.insertRow();
             row.insertCell().textContent = user.id;
@@ -38,12 +63,20 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
-    async function fetchWithdrawals(searchTerm = '') {
+    async function fetchWithdrawals(searchTerm = withdrawalSearchTerm, append = false) {
         try {
-            const response = await fetch(`/api/admin/withdrawals?search=${searchTerm}`);
+            withdrawalSearchTerm = searchTerm;
+            showingPayoutQueue = false;
+            const params = new URLSearchParams({ search: searchTerm });
+            if (append && withdrawalsNextCursor) {
+                params.set('cursor', withdrawalsNextCursor);
+            }
+            const response = await fetch(`/api/admin/withdrawals?${params}`);
             const data = await response.json();
             if (data.success) {
-                renderWithdrawals(data.withdrawals);
+                renderWithdrawals(data.withdrawals, append);
+                withdrawalsNextCursor = data.next_cursor;
+                withdrawalsLoadMoreButton.style.display = withdrawalsNextCursor ? 'inline-block' : 'none';
             } else {
                 alert('Failed to fetch withdrawals: ' + data.message);
             }
@@ -53,65 +86,224 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    function renderWithdrawals(withdrawals) {
-        withdrawalsTableBody.innerHTML = '';
-        withdrawals.forEach(withdrawal => {
-            const row = withdrawalsTableBody.insertRow();
-            row.insertCell().textContent = withdrawal.id;
-            row.insertCell().textContent = withdrawal.user_id;
-            row.insertCell().textContent = withdrawal.username || 'N/A'; // Assuming username is joined from users table
-            row.insertCell().textContent = withdrawal.amount.toFixed(4);
-            row.insertCell().textContent = withdrawal.ton_wallet_address;
-            row.insertCell().textContent = withdrawal.status;
-            row.insertCell().textContent = new Date(withdrawal.created_at).toLocaleString();
-
-            const actionsCell = row.insertCell();
-            if (withdrawal.status === 'pending') {
-                const approveButton = document.createElement('button');
-                approveButton.textContent = 'Approve';
-                approveButton.classList.add('approve-button');
-                approveButton.addEventListener('click', () => updateWithdrawalStatus(withdrawal.id, 'completed'));
-                actionsCell.appendChild(approveButton);
-
-                const rejectButton = document.createElement('button');
-                rejectButton.textContent = 'Reject';
-                rejectButton.classList.add('reject-button');
-                rejectButton.addEventListener('click', () => updateWithdrawalStatus(withdrawal.id, 'rejected'));
-                actionsCell.appendChild(rejectButton);
+    // The payout queue is the oldest pending withdrawals, all preselected for one bulk approval
+    async function fetchPayoutQueue() {
+        try {
+            const response = await fetch('/api/admin/payouts');
+            const data = await response.json();
+            if (data.success) {
+                renderWithdrawals(data.withdrawals, false, true);
+                showingPayoutQueue = true;
+                withdrawalsNextCursor = null;
+                withdrawalsLoadMoreButton.style.display = 'none';
+                alert(`${data.withdrawals.length} pending withdrawal(s), ${data.total.toFixed(4)} TON in total.`);
             } else {
-                actionsCell.textContent = 'N/A';
+                alert('Failed to fetch payout queue: ' + data.message);
             }
+        } catch (error) {
+            console.error('Error fetching payout queue:', error);
+            alert('An error occurred while fetching the payout queue.');
+        }
+    }
+
+    function renderWithdrawals(withdrawals, append = false, selected = false) {
+        if (!append) {
+            withdrawalsTableBody.innerHTML = '';
+            shownWithdrawals.clear();
+            selectAllWithdrawals.checked = selected;
+        }
+        withdrawals.forEach(withdrawal => {
+            const row = withdrawalsTableBody.insertRow();
+            fillWithdrawalRow(row, withdrawal, selected);
         });
     }
 
-    async function updateWithdrawalStatus(withdrawalId, status) {
+    function fillWithdrawalRow(row, withdrawal, selected = false) {
+        row.innerHTML = '';
+        row.dataset.id = withdrawal.id;
+        shownWithdrawals.set(withdrawal.id, withdrawal);
+        const selectCell = row.insertCell();
+        if (withdrawal.status === 'pending') {
+            const checkbox = document.createElement('input');
+            checkbox.type = 'checkbox';
+            checkbox.classList.add('withdrawal-select');
+            checkbox.value = withdrawal.id;
+            checkbox.checked = selected;
+            selectCell.appendChild(checkbox);
+        }
+        row.insertCell().textContent = withdrawal.id;
+        row.insertCell().textContent = withdrawal.user_id;
+        row.insertCell().textContent = withdrawal.username || 'N/A'; // Assuming username is joined from users table
+        row.insertCell().textContent = withdrawal.amount.toFixed(4);
+        row.insertCell().textContent = withdrawal.ton_wallet_address;
+        row.insertCell().textContent = withdrawal.status;
+        row.insertCell().textContent = new Date(withdrawal.created_at).toLocaleString();
+
+        const actionsCell = row.insertCell();
+        if (withdrawal.status === 'pending') {
+            const approveButton = document.createElement('button');
+            approveButton.textContent = 'Approve';
+            approveButton.classList.add('approve-button');
+            approveButton.addEventListener('click', () => updateWithdrawalStatuses([withdrawal.id], 'completed'));
+            actionsCell.appendChild(approveButton);
+
+            const rejectButton = document.createElement('button');
+            rejectButton.textContent = 'Reject';
+            rejectButton.classList.add('reject-button');
+            rejectButton.addEventListener('click', () => updateWithdrawalStatuses([withdrawal.id], 'rejected'));
+            actionsCell.appendChild(rejectButton);
+        } else {
+            actionsCell.textContent = 'N/A';
+        }
+    }
+
+    // One request (and one database commit) for any number of withdrawals
+    async function updateWithdrawalStatuses(withdrawalIds, status) {
+        if (withdrawalIds.length === 0) {
+            alert('Select at least one pending withdrawal.');
+            return;
+        }
         try {
-            const response = await fetch(`/api/admin/withdrawals/${withdrawalId}/${status}`, {
+            const response = await fetch('/api/admin/withdrawals/status', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
+                body: JSON.stringify({ ids: withdrawalIds, status: status }),
             });
             const data = await response.json();
             if (data.success) {
-                alert(`Withdrawal ${withdrawalId} ${status} successfully.`);
-                fetchWithdrawals(); // Refresh withdrawals table
+                let message = `${data.updated.length} withdrawal(s) ${status} successfully.`;
+                if (data.skipped.length > 0) {
+                    message += ` Skipped (no longer pending): ${data.skipped.join(', ')}`;
+                }
+                applyStatusChange(data.updated, status); // The withdrawal_status event may come from another worker
+                alert(message);
             } else {
-                alert(`Failed to ${status} withdrawal ${withdrawalId}: ` + data.message);
+                alert(`Failed to ${status} withdrawals: ` + data.message);
             }
         } catch (error) {
-            console.error(`Error updating withdrawal status for ${withdrawalId}:`, error);
+            console.error(`Error updating withdrawal status for ${withdrawalIds}:`, error);
             alert('An error occurred while updating withdrawal status.');
         }
     }
 
+    function selectedWithdrawalIds() {
+        return Array.from(withdrawalsTableBody.querySelectorAll('.withdrawal-select:checked'))
+            .map(checkbox => Number(checkbox.value));
+    }
+
     // Event Listeners for search
     userSearchButton.addEventListener('click', () => fetchUsers(userSearchInput.value));
     withdrawalSearchButton.addEventListener('click', () => fetchWithdrawals(withdrawalSearchInput.value));
 
+    // Event Listeners for pagination
+    usersLoadMoreButton.addEventListener('click', () => fetchUsers(userSearchTerm, true));
+    withdrawalsLoadMoreButton.addEventListener('click', () => fetchWithdrawals(withdrawalSearchTerm, true));
+
+    // Event Listeners for bulk payouts
+    payoutQueueButton.addEventListener('click', fetchPayoutQueue);
+    approveSelectedButton.addEventListener('click', () => updateWithdrawalStatuses(selectedWithdrawalIds(), 'completed'));
+    rejectSelectedButton.addEventListener('click', () => updateWithdrawalStatuses(selectedWithdrawalIds(), 'rejected'));
+    selectAllWithdrawals.addEventListener('change', () => {
+        withdrawalsTableBody.querySelectorAll('.withdrawal-select').forEach(checkbox => {
+            checkbox.checked = selectAllWithdrawals.checked;
+        });
+    });
+
+    // Clicking a sortable column header sorts by it; clicking it again flips the order
+    document.querySelectorAll('#users-table th.sortable').forEach(header => {
+        header.style.cursor = 'pointer';
+        header.addEventListener('click', () => {
+            const column = header.dataset.sort;
+            userOrder = (userSort === column && userOrder === 'desc') ? 'asc' : 'desc';
+            userSort = column;
+            fetchUsers(userSearchTerm);
+        });
+    });
+
+    async function fetchStats() {
+        try {
+            const response = await fetch('/api/admin/stats?limit=10');
+            const data = await response.json();
+            if (!data.success) {
+                console.error('Failed to fetch stats:', data.message);
+                return;
+            }
+            document.getElementById('stats-users').textContent = data.stats.users;
+            document.getElementById('stats-ads-viewed').textContent = data.stats.ads_viewed;
+            document.getElementById('stats-earned').textContent = data.stats.earned.toFixed(4);
+            document.getElementById('stats-pending').textContent = data.stats.withdrawals_pending;
+            document.getElementById('stats-pending-amount').textContent = data.stats.withdrawals_pending_amount.toFixed(4);
+            document.getElementById('stats-paid-amount').textContent = data.stats.withdrawals_completed_amount.toFixed(4);
+            renderLeaders('stats-top-earners', data.top_earners, user => `${user.earned.toFixed(4)} TON`);
+            renderLeaders('stats-top-referrers', data.top_referrers, user => `${user.referees} referees`);
+        } catch (error) {
+            console.error('Error fetching stats:', error);
+        }
+    }
+
+    function renderLeaders(listId, users, describe) {
+        const list = document.getElementById(listId);
+        list.innerHTML = '';
+        users.forEach(user => {
+            const item = document.createElement('li');
+            item.textContent = `${user.username || user.first_name || 'N/A'} (ID: ${user.id}): ${describe(user)}`;
+            list.appendChild(item);
+        });
+    }
+
+    // New withdrawals and status changes (from any admin) are pushed by the server and
+    // applied to the table in place; EventSource reconnects and resumes on its own.
+    function subscribeToWithdrawals() {
+        if (!window.EventSource) {
+            return;
+        }
+        const withdrawalEvents = new EventSource('/api/admin/events');
+        withdrawalEvents.addEventListener('withdrawal', event => {
+            const withdrawal = JSON.parse(event.data);
+            // Only the unfiltered, newest-first listing is known to include it
+            if (withdrawalSearchTerm === '' && !showingPayoutQueue && !shownWithdrawals.has(withdrawal.id)) {
+                fillWithdrawalRow(withdrawalsTableBody.insertRow(0), withdrawal);
+            }
+            scheduleStatsRefresh();
+        });
+        withdrawalEvents.addEventListener('withdrawal_status', event => {
+            const change = JSON.parse(event.data);
+            applyStatusChange(change.ids, change.status);
+        });
+    }
+
+    function applyStatusChange(ids, status) {
+        ids.forEach(id => {
+            const withdrawal = shownWithdrawals.get(id);
+            const row = withdrawalsTableBody.querySelector(`tr[data-id="${id}"]`);
+            if (withdrawal && row && withdrawal.status !== status) {
+                withdrawal.status = status;
+                fillWithdrawalRow(row, withdrawal);
+            }
+        });
+        if (ids.length > 0) {
+            scheduleStatsRefresh(); // Pending and paid-out totals changed
+        }
+    }
+
+    // Coalesces the stats reloads of a burst of events (and of our own change and its echo)
+    let statsRefreshTimer = null;
+    function scheduleStatsRefresh() {
+        if (statsRefreshTimer === null) {
+            statsRefreshTimer = setTimeout(() => {
+                statsRefreshTimer = null;
+                fetchStats();
+            }, 500);
+        }
+    }
+
     // Initial load
+    fetchStats();
     fetchUsers();
     fetchWithdrawals();
+    subscribeToWithdrawals();
 
     // Admin Logout
     adminLogoutButton.addEventListener('click', () => {
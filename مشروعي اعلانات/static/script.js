@@ -1,4 +1,6 @@
 let currentUser = null; // Stores user data after Telegram login
+let adTicket = null; // Issued by /api/ad/start for the ad that is currently open
+let balanceEvents = null; // EventSource pushing balance changes to the dashboard
 
 // Function to handle Telegram authentication
 function onTelegramAuth(user) {
@@ -81,6 +83,7 @@ function loadDashboardData() {
                 currentUser = data.user;
                 localStorage.setItem('currentUser', JSON.stringify(currentUser)); // Update localStorage
                 updateDashboardUI();
+                subscribeToBalance();
             } else {
                 alert('Failed to load dashboard data: ' + data.message);
                 window.location.href = '/'; // Redirect to home if data cannot be loaded
@@ -93,6 +96,73 @@ function loadDashboardData() {
         });
 }
 
+// POSTs that change state carry an Idempotency-Key. A request lost on a flaky
+// connection is retried with the same key, so the server runs it at most once
+// and a retry of one that already ran gets its original response.
+function postIdempotent(url, body, retries = 2) {
+    const key = window.crypto && crypto.randomUUID
+        ? crypto.randomUUID()
+        : Date.now().toString(36) + '-' + Math.random().toString(36).slice(2);
+    const retry = remaining => new Promise(resolve => setTimeout(resolve, 1000)).then(() => attempt(remaining - 1));
+    const attempt = remaining => fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Idempotency-Key': key,
+        },
+        body: JSON.stringify(body),
+    }).then(response => {
+        // 409 with Retry-After: the first attempt is still running on the server
+        if (response.status === 409 && response.headers.get('Retry-After') && remaining > 0) {
+            return retry(remaining);
+        }
+        return response;
+    }, error => {
+        if (remaining <= 0) {
+            throw error;
+        }
+        return retry(remaining);
+    });
+    return attempt(retries);
+}
+
+// Balance and ad-count changes (ad views, referral commissions, withdrawals) are pushed
+// by the server, so the dashboard never polls /api/user_data. EventSource reconnects on its own.
+function subscribeToBalance() {
+    if (balanceEvents || !window.EventSource) {
+        return;
+    }
+    balanceEvents = new EventSource('/api/events');
+    balanceEvents.addEventListener('balance', event => {
+        const balance = JSON.parse(event.data);
+        currentUser.earnings = balance.earnings;
+        currentUser.adsViewed = balance.adsViewed;
+        localStorage.setItem('currentUser', JSON.stringify(currentUser));
+        updateDashboardUI();
+    });
+}
+
+// Top earners for the dashboard, read from the server's precomputed leaderboard
+function loadLeaderboard() {
+    fetch('/api/stats')
+        .then(response => response.json())
+        .then(data => {
+            if (!data.success) {
+                return;
+            }
+            const list = document.getElementById('dashboard-top-earners');
+            list.innerHTML = '';
+            data.topEarners.forEach(leader => {
+                const item = document.createElement('li');
+                item.textContent = `${leader.name || 'Anonymous'}: ${leader.earned.toFixed(4)} TON`;
+                list.appendChild(item);
+            });
+        })
+        .catch(error => {
+            console.error('Error loading leaderboard:', error);
+        });
+}
+
 // Function to update the dashboard UI with user data
 function updateDashboardUI() {
     if (currentUser) {
@@ -120,17 +190,33 @@ document.addEventListener('DOMContentLoaded', () => {
 
     if (document.getElementById('dashboard-view-ad-button')) {
         loadDashboardData(); // Load data when dashboard is accessed
+        loadLeaderboard();
 
         document.getElementById('dashboard-view-ad-button').addEventListener('click', () => {
             document.getElementById('dashboard-ad-display').style.display = 'block';
             const closeAdButton = document.getElementById('dashboard-close-ad-button');
             closeAdButton.disabled = true; // Disable close button initially
 
-            // Simulate ad viewing time
-            setTimeout(() => {
-                closeAdButton.disabled = false; // Enable close button after 5 seconds
-                alert('You can now close the ad.');
-            }, 5000); // 5 seconds
+            // The server only credits an ad through a ticket issued when it was opened,
+            // and only after the minimum watch time, so the timer starts once we have it.
+            fetch('/api/ad/start', { method: 'POST' })
+                .then(response => response.json())
+                .then(data => {
+                    if (!data.success) {
+                        alert('Failed to open ad: ' + data.message);
+                        return;
+                    }
+                    adTicket = data.ticket;
+                    // Simulate ad viewing time
+                    setTimeout(() => {
+                        closeAdButton.disabled = false; // Enable close button after the watch time
+                        alert('You can now close the ad.');
+                    }, data.minWatchSeconds * 1000);
+                })
+                .catch(error => {
+                    console.error('Error opening ad:', error);
+                    alert('An error occurred while opening the ad.');
+                });
 
             // In a real application, you would fetch an ad from the backend here.
             // For now, we'll just show the static ad content.
@@ -141,15 +227,10 @@ document.addEventListener('DOMContentLoaded', () => {
             document.getElementById('dashboard-ad-display').style.display = 'none';
             document.getElementById('dashboard-close-ad-button').disabled = false; // Ensure button is re-enabled for next ad
 
-            fetch('/api/view_ad', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({ userId: currentUser.id }),
-            })
+            postIdempotent('/api/view_ad', { userId: currentUser.id, ticket: adTicket })
                 .then(response => response.json())
                 .then(data => {
+                    adTicket = null; // Each ticket is credited once
                     if (data.success) {
                         currentUser.earnings = data.user.earnings;
                         currentUser.adsViewed = data.user.adsViewed;
@@ -198,13 +279,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 return;
             }
 
-            fetch('/api/withdraw', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({ tonWalletAddress: tonWalletAddress }), // userId is from session on backend
-            })
+            postIdempotent('/api/withdraw', { tonWalletAddress: tonWalletAddress }) // userId is from session on backend
                 .then(response => response.json())
                 .then(data => {
                     if (data.success) {
@@ -0,0 +1,247 @@
+import heapq
+import itertools
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Mapping, Tuple
+
+from storage import FanOut
+
+# --- Configuration ---
+LEADERBOARD_SIZE = 100 # Entries kept in memory per board; endpoints return a prefix
+LEADERBOARD_TTL = 30.0 # Seconds before a board is re-read, to pick up other workers' writes
+SCHEMA_VERSION = 2 # PRAGMA user_version step (after ledger.SCHEMA_VERSION) that adds the shard condition
+
+# Running aggregates, maintained by triggers on the tables they summarise, so
+# every write path (the ad-view flusher, withdrawals, payouts, bulk imports)
+# keeps them exact and a read never scans users or withdrawals. Withdrawals
+# are counted per status as withdrawals_<status> and withdrawals_<status>_nano.
+STATS_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS platform_stats (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    """,
+    # Lifetime totals per user; earned_nano only ever grows (withdrawals do not reduce it).
+    """
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id INTEGER PRIMARY KEY,
+        earned_nano INTEGER NOT NULL DEFAULT 0,
+        referral_nano INTEGER NOT NULL DEFAULT 0,
+        referees INTEGER NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_user_stats_earned ON user_stats (earned_nano, user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_user_stats_referees ON user_stats (referees, user_id)",
+    # Only counts referrers stored in this file (always, with a single file);
+    # whoever inserts a user with a referrer on another shard calls count_referees().
+    """
+    CREATE TRIGGER IF NOT EXISTS stats_user_insert AFTER INSERT ON users BEGIN
+        INSERT INTO platform_stats (name, value) VALUES ('users', 1), ('ads_viewed', COALESCE(new.ads_viewed, 0))
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        INSERT INTO user_stats (user_id, referees)
+        SELECT new.referrer_id, 1 FROM storage_shard
+        WHERE new.referrer_id IS NOT NULL AND new.referrer_id % shard_count = shard
+        ON CONFLICT(user_id) DO UPDATE SET referees = referees + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS stats_ads_viewed AFTER UPDATE OF ads_viewed ON users
+    WHEN new.ads_viewed IS NOT old.ads_viewed BEGIN
+        INSERT INTO platform_stats (name, value) VALUES ('ads_viewed', COALESCE(new.ads_viewed, 0) - COALESCE(old.ads_viewed, 0))
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS stats_ledger_credit AFTER INSERT ON earnings_ledger
+    WHEN new.amount_nano > 0 BEGIN
+        INSERT INTO platform_stats (name, value) VALUES ('earned_nano', new.amount_nano)
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        INSERT INTO user_stats (user_id, earned_nano, referral_nano)
+        VALUES (new.user_id, new.amount_nano, CASE WHEN new.kind = 'referral_commission' THEN new.amount_nano ELSE 0 END)
+        ON CONFLICT(user_id) DO UPDATE SET
+            earned_nano = earned_nano + excluded.earned_nano,
+            referral_nano = referral_nano + excluded.referral_nano;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS stats_withdrawal_insert AFTER INSERT ON withdrawals BEGIN
+        INSERT INTO platform_stats (name, value)
+        VALUES ('withdrawals_' || new.status, 1), ('withdrawals_' || new.status || '_nano', COALESCE(new.amount_nano, 0))
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS stats_withdrawal_status AFTER UPDATE OF status ON withdrawals
+    WHEN new.status IS NOT old.status BEGIN
+        INSERT INTO platform_stats (name, value)
+        VALUES ('withdrawals_' || old.status, -1), ('withdrawals_' || old.status || '_nano', -COALESCE(old.amount_nano, 0)),
+               ('withdrawals_' || new.status, 1), ('withdrawals_' || new.status || '_nano', COALESCE(new.amount_nano, 0))
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+    END
+    """,
+)
+
+# Board -> the user_stats column it ranks by (each one is indexed).
+BOARDS = {
+    'earners': "earned_nano",
+    'referrers': "referees",
+}
+
+
+# --- Schema ---
+def init_stats(cursor: sqlite3.Cursor) -> None:
+    # Runs after ledger.migrate(), inside the same transaction.
+    existing = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'platform_stats'").fetchone()
+    version = cursor.execute("PRAGMA user_version").fetchone()[0]
+    if version < SCHEMA_VERSION:
+        # Databases from before sharding have stats_user_insert without the shard condition.
+        cursor.execute("DROP TRIGGER IF EXISTS stats_user_insert")
+    for statement in STATS_SCHEMA:
+        cursor.execute(statement)
+    if not existing:
+        _backfill(cursor)
+    if version < SCHEMA_VERSION:
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def _backfill(cursor: sqlite3.Cursor) -> None:
+    # One-off scans for data written before the triggers existed. The ledger is
+    # compacted, so lifetime earnings are rebuilt as balance + everything withdrawn.
+    cursor.execute(
+        """
+        INSERT INTO platform_stats (name, value)
+        SELECT 'users', COUNT(*) FROM users
+        UNION ALL SELECT 'ads_viewed', COALESCE(SUM(ads_viewed), 0) FROM users
+        UNION ALL SELECT 'earned_nano', COALESCE(SUM(balance_nano), 0)
+            + (SELECT COALESCE(SUM(amount_nano), 0) FROM withdrawals) FROM user_balances
+        """
+    )
+    cursor.execute(
+        """
+        INSERT INTO platform_stats (name, value)
+        SELECT 'withdrawals_' || status, COUNT(*) FROM withdrawals GROUP BY status
+        UNION ALL
+        SELECT 'withdrawals_' || status || '_nano', COALESCE(SUM(amount_nano), 0) FROM withdrawals GROUP BY status
+        """
+    )
+    cursor.execute(
+        """
+        INSERT INTO user_stats (user_id, earned_nano, referral_nano, referees)
+        SELECT u.id,
+            b.balance_nano + COALESCE((SELECT SUM(amount_nano) FROM withdrawals w WHERE w.user_id = u.id), 0),
+            COALESCE((SELECT SUM(total_nano) FROM referral_earnings r WHERE r.referrer_id = u.id), 0),
+            (SELECT COUNT(*) FROM users r WHERE r.referrer_id = u.id)
+        FROM users u JOIN user_balances b ON b.id = u.id
+        """
+    )
+
+
+# --- Writes ---
+def count_referees(conn: sqlite3.Connection, referees: Mapping[int, int]) -> None:
+    # referrer_id -> new referees stored on another shard, for referrers stored
+    # on ``conn``'s. Does not commit.
+    conn.executemany(
+        """
+        INSERT INTO user_stats (user_id, referees) VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET referees = referees + excluded.referees
+        """,
+        referees.items()
+    )
+
+
+# --- Reads ---
+def platform_totals(fan_out: FanOut) -> Dict[str, int]:
+    # A handful of rows per shard, whatever the size of users and withdrawals.
+    totals = {name: 0 for name in ('users', 'ads_viewed', 'earned_nano', 'withdrawals_pending',
+                                  'withdrawals_pending_nano', 'withdrawals_completed', 'withdrawals_completed_nano')}
+    for rows in fan_out(lambda conn: conn.execute("SELECT name, value FROM platform_stats").fetchall()):
+        for name, value in rows:
+            totals[name] = totals.get(name, 0) + value
+    return totals
+
+
+class Leaderboard:
+    """Top ``size`` users of one board, kept in a min-heap in memory.
+
+    Refreshed from user_stats (an index scan of ``size`` rows per shard) every
+    ``ttl`` seconds; in between, users whose totals this process just wrote are
+    offered to the heap so its own credits show up immediately.
+    """
+
+    def __init__(self, fan_out: FanOut, board: str,
+                 size: int = LEADERBOARD_SIZE, ttl: float = LEADERBOARD_TTL) -> None:
+        self._fan_out = fan_out
+        self._column = BOARDS[board]
+        self._size = size
+        self._ttl = ttl
+        self._heap: List[Tuple[int, int]] = [] # (score, user_id); the smallest entry is heap[0]
+        self._entries: Dict[int, Dict[str, Any]] = {}
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def top(self, limit: int) -> List[Dict[str, Any]]:
+        if self._expires_at <= time.monotonic():
+            self.refresh()
+        with self._lock:
+            ranked = heapq.nlargest(min(limit, self._size), self._heap)
+            return [self._entries[user_id] for _, user_id in ranked]
+
+    def refresh(self) -> None:
+        results = self._fan_out(lambda conn: conn.execute(
+            f"""
+            SELECT s.*, u.first_name, u.username FROM user_stats s JOIN users u ON u.id = s.user_id
+            WHERE s.{self._column} > 0
+            ORDER BY s.{self._column} DESC, s.user_id DESC
+            LIMIT ?
+            """,
+            (self._size,)
+        ).fetchall())
+        # Each user's totals live on one shard, so the top of the union is the top overall.
+        rows = heapq.nlargest(self._size, itertools.chain(*results),
+                              key=lambda row: (row[self._column], row['user_id']))
+        with self._lock:
+            self._entries = {row['user_id']: dict(row) for row in rows}
+            self._heap = [(row[self._column], row['user_id']) for row in rows]
+            heapq.heapify(self._heap)
+            self._expires_at = time.monotonic() + self._ttl
+
+    def offer(self, rows: Iterable[sqlite3.Row]) -> None:
+        """Merges fresh user_stats rows (joined with first_name and username) into the board."""
+        with self._lock:
+            changed = False
+            for row in rows:
+                user_id, score = row['user_id'], row[self._column]
+                # Only users already on the board or scoring above its lowest entry matter.
+                if user_id in self._entries or (score > 0 and (
+                        len(self._heap) < self._size or (score, user_id) > self._heap[0])):
+                    self._entries[user_id] = dict(row)
+                    changed = True
+            if changed:
+                kept = heapq.nlargest(self._size, ((entry[self._column], user_id)
+                                                   for user_id, entry in self._entries.items()))
+                self._entries = {user_id: self._entries[user_id] for _, user_id in kept}
+                self._heap = kept
+                heapq.heapify(self._heap)
+
+
+class Leaderboards:
+    def __init__(self, fan_out: FanOut) -> None:
+        self.boards = {board: Leaderboard(fan_out, board) for board in BOARDS}
+
+    def top(self, board: str, limit: int) -> List[Dict[str, Any]]:
+        return self.boards[board].top(limit)
+
+    def users_changed(self, conn: sqlite3.Connection, user_ids: List[int]) -> None:
+        # Called after a flush with the users it credited on ``conn``'s shard (referrers included).
+        rows = conn.execute(
+            """
+            SELECT s.*, u.first_name, u.username FROM user_stats s JOIN users u ON u.id = s.user_id
+            WHERE s.user_id IN (SELECT value FROM json_each(?))
+            """,
+            (json.dumps(user_ids),)
+        ).fetchall()
+        for leaderboard in self.boards.values():
+            leaderboard.offer(rows)
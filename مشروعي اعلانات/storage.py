@@ -0,0 +1,159 @@
+import heapq
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple, TypeVar
+
+import db
+
+# --- Configuration ---
+# "sqlite" keeps everything in DATABASE_PATH. "sharded" spreads users over
+# DATABASE_SHARDS files named after it (smartcoinlabs.shard0.db, ...); move an
+# existing database into them with `dbtools.py export` and `dbtools.py import`.
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite")
+DATABASE_SHARDS = int(os.environ.get("DATABASE_SHARDS", "4"))
+FANOUT_THREADS = int(os.environ.get("STORAGE_FANOUT_THREADS", "0")) # 0: one per shard
+
+# Records which shard of how many a file is. The stats triggers read it, and
+# opening a file with a different shard count (which would misroute every user) fails.
+SHARD_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS storage_shard (
+        shard INTEGER NOT NULL,
+        shard_count INTEGER NOT NULL
+    )
+"""
+
+# Highest id a table has handed out; new ids are allocated above it (see id_insert()).
+# withdrawals uses AUTOINCREMENT, so sqlite_sequence also covers deleted and imported rows.
+ID_HIGH_WATER = {
+    'users': "SELECT MAX(id) FROM users",
+    'withdrawals': "SELECT seq FROM sqlite_sequence WHERE name = 'withdrawals'",
+}
+
+T = TypeVar("T")
+FanOut = Callable[[Callable[[sqlite3.Connection], T]], List[T]]
+
+
+def shard_paths(path: str, count: int) -> List[str]:
+    root, ext = os.path.splitext(path)
+    return [f"{root}.shard{shard}{ext or '.db'}" for shard in range(count)]
+
+
+def init_shard(cursor: sqlite3.Cursor, shard: int, shard_count: int) -> None:
+    cursor.execute(SHARD_SCHEMA)
+    row = cursor.execute("SELECT shard, shard_count FROM storage_shard").fetchone()
+    if row is None:
+        cursor.execute("INSERT INTO storage_shard (shard, shard_count) VALUES (?, ?)", (shard, shard_count))
+    elif tuple(row) != (shard, shard_count):
+        raise RuntimeError(f"Database file is shard {row[0]} of {row[1]}, not shard {shard} of {shard_count}")
+
+
+def id_insert(table: str, sequence: Optional[Tuple[int, int]]) -> Tuple[str, str, Tuple[int, ...]]:
+    """The id column, value and parameters to prepend to an INSERT into ``table``.
+
+    With no ``sequence`` SQLite assigns the id as usual. With (shard_count,
+    shard) the id is the next one above the table's high-water mark for which
+    id % shard_count == shard, which keeps every id routable to its shard. It
+    is evaluated inside the INSERT, under the write lock, so it cannot race.
+    """
+    if sequence is None:
+        return "", "", ()
+    count, shard = sequence
+    return "id, ", f"(COALESCE(({ID_HIGH_WATER[table]}), 0) / ? + 1) * ? + ?, ", (count, count, shard)
+
+
+def sort_value(value: Any) -> Tuple[bool, Any]:
+    # SQLite sorts NULL before everything else; Python cannot compare None.
+    return value is not None, value
+
+
+def merge_sorted(results: Sequence[List[T]], key: Callable[[T], Any], reverse: bool = False) -> List[T]:
+    """Merges per-shard results that are each already sorted by ``key``."""
+    if len(results) == 1:
+        return list(results[0])
+    return list(heapq.merge(*results, key=key, reverse=reverse))
+
+
+class SQLiteStorage:
+    """The default backend: every table lives in the one SQLite file at DATABASE_PATH.
+
+    Callers always go through shard_of()/for_user()/fan_out(), so the same
+    code runs against a sharded store, where there is more than one file.
+    """
+
+    def __init__(self, paths: Sequence[str]) -> None:
+        self.paths = tuple(paths)
+        self.shard_count = len(self.paths)
+
+    def shard_of(self, user_id: int) -> int:
+        return user_id % self.shard_count
+
+    def connect(self, shard: int = 0) -> sqlite3.Connection:
+        return db.get_db_connection(self.paths[shard])
+
+    def for_user(self, user_id: int) -> sqlite3.Connection:
+        return self.connect(self.shard_of(user_id))
+
+    def open_connection(self, shard: int = 0) -> db.PooledConnection:
+        # Unpooled, for long-running work; close it with really_close().
+        return db.open_connection(self.paths[shard])
+
+    def id_sequence(self, shard: int) -> Optional[Tuple[int, int]]:
+        return None
+
+    def fan_out(self, query: Callable[[sqlite3.Connection], T], shards: Optional[Iterable[int]] = None) -> List[T]:
+        """Runs ``query`` on every shard (or the given ones) and returns the results in shard order."""
+        return [query(self.connect(shard)) for shard in (range(self.shard_count) if shards is None else shards)]
+
+
+class ShardedSQLiteStorage(SQLiteStorage):
+    """Users spread over several SQLite files, each with the full schema.
+
+    A user's rows (profile, ledger, withdrawals, referral earnings as a
+    referrer) all live on shard ``user_id % shard_count``, so writes for users
+    on different shards take different file locks and run in parallel, across
+    threads and gunicorn workers alike. Queries over all users fan out to
+    every shard on a thread pool and merge the results.
+    """
+
+    def __init__(self, paths: Sequence[str], threads: int = FANOUT_THREADS) -> None:
+        super().__init__(paths)
+        self._threads = threads or self.shard_count
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_pid = 0
+        self._executor_lock = threading.Lock()
+
+    def id_sequence(self, shard: int) -> Optional[Tuple[int, int]]:
+        return self.shard_count, shard
+
+    def fan_out(self, query: Callable[[sqlite3.Connection], T], shards: Optional[Iterable[int]] = None) -> List[T]:
+        shards = list(range(self.shard_count) if shards is None else shards)
+        if len(shards) <= 1:
+            return super().fan_out(query, shards)
+        executor = self._get_executor()
+        futures = [executor.submit(self._run, query, shard) for shard in shards]
+        return [future.result() for future in futures]
+
+    def _run(self, query: Callable[[sqlite3.Connection], T], shard: int) -> T:
+        # Each pool thread keeps its own pooled connection per shard.
+        try:
+            return query(self.connect(shard))
+        finally:
+            db.release_connection()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Created per process: a forked gunicorn worker must not inherit the parent's (dead) threads.
+        with self._executor_lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self._threads, thread_name_prefix="shard-fanout")
+                self._executor_pid = os.getpid()
+            return self._executor
+
+
+def create_storage() -> SQLiteStorage:
+    if STORAGE_BACKEND == "sharded":
+        return ShardedSQLiteStorage(shard_paths(db.DATABASE, DATABASE_SHARDS))
+    if STORAGE_BACKEND != "sqlite":
+        raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}; expected 'sqlite' or 'sharded'")
+    return SQLiteStorage([db.DATABASE])
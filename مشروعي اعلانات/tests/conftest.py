@@ -0,0 +1,84 @@
+import os
+import sys
+from typing import Iterator
+
+import pytest
+
+# The app is a set of flat modules; make them importable from the tests.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import ledger
+import referrals
+import storage
+
+# The tables as created before the earnings ledger: balances in the REAL
+# users.earnings column, withdrawals without amount_nano.
+LEGACY_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        telegram_id INTEGER UNIQUE NOT NULL,
+        first_name TEXT,
+        last_name TEXT,
+        username TEXT,
+        photo_url TEXT,
+        auth_date INTEGER,
+        hash TEXT,
+        earnings REAL DEFAULT 0.0,
+        ads_viewed INTEGER DEFAULT 0,
+        referral_code TEXT UNIQUE,
+        referrer_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS withdrawals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        ton_wallet_address TEXT NOT NULL,
+        status TEXT DEFAULT 'pending',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    """,
+)
+
+
+@pytest.fixture
+def legacy_store(tmp_path) -> Iterator[storage.SQLiteStorage]:
+    """A single-file store holding a database from before the ledger migration."""
+    store = storage.SQLiteStorage([str(tmp_path / "smartcoinlabs.db")])
+    conn = store.connect()
+    for statement in LEGACY_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    yield store
+    db.close_all_connections() # Including the ones opened by test threads
+
+
+@pytest.fixture
+def store(legacy_store: storage.SQLiteStorage) -> storage.SQLiteStorage:
+    """``legacy_store`` migrated to the ledger schema the balance code runs on."""
+    conn = legacy_store.connect()
+    ledger.migrate(conn.cursor())
+    for statement in referrals.REFERRAL_SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    return legacy_store
+
+
+def add_user(store: storage.SQLiteStorage, user_id: int, ads_viewed: int = 0, balance_nano: int = 0) -> None:
+    conn = store.for_user(user_id)
+    conn.execute(
+        "INSERT INTO users (id, telegram_id, first_name, ads_viewed, referral_code) VALUES (?, ?, ?, ?, ?)",
+        (user_id, 1000 + user_id, f"User{user_id}", ads_viewed, f"REF{1000 + user_id}")
+    )
+    if balance_nano:
+        ledger.credit_many(conn, [(user_id, balance_nano, 'ad_view')])
+    conn.commit()
+
+
+def balance_nano(store: storage.SQLiteStorage, user_id: int) -> int:
+    return ledger.get_balance_nano(store.for_user(user_id), user_id)
@@ -0,0 +1,86 @@
+from typing import Iterator, List
+
+import pytest
+
+import referrals
+from ad_views import AD_VIEW_REWARD_NANO, MILESTONE_ADS, MILESTONE_BONUS_NANO, AdViewAccumulator
+from conftest import add_user, balance_nano
+
+
+@pytest.fixture
+def bonuses() -> List[int]:
+    return [] # Users reported to on_bonus, once per flush that paid them
+
+
+@pytest.fixture
+def make_accumulator(store, bonuses) -> Iterator:
+    # One accumulator stands for one worker; flushes are triggered by the test.
+    accumulators = []
+
+    def make() -> AdViewAccumulator:
+        accumulator = AdViewAccumulator(store, referrals.ReferralEngine(store.for_user),
+                                        flush_interval=3600, on_bonus=bonuses.extend)
+        accumulators.append(accumulator)
+        return accumulator
+
+    yield make
+    for accumulator in accumulators:
+        accumulator.stop()
+
+
+def milestone_rows(store, user_id: int) -> List[int]:
+    return [row[0] for row in store.for_user(user_id).execute(
+        "SELECT amount_nano FROM earnings_ledger WHERE user_id = ? AND kind = 'milestone_bonus'", (user_id,)
+    )]
+
+
+def test_flush_that_crosses_a_milestone_pays_the_bonus_once(store, make_accumulator, bonuses):
+    add_user(store, 1)
+    accumulator = make_accumulator()
+    for _ in range(MILESTONE_ADS - 2):
+        accumulator.record(1)
+    accumulator.flush()
+    assert bonuses == [] and milestone_rows(store, 1) == []
+
+    for _ in range(3): # Crosses MILESTONE_ADS inside one batch
+        view = accumulator.record(1)
+    assert view['ads_viewed'] == MILESTONE_ADS + 1
+    assert accumulator.flush() == 1
+    assert accumulator.flush() == 0 # Nothing pending: no second payment
+
+    assert bonuses == [1]
+    assert milestone_rows(store, 1) == [MILESTONE_BONUS_NANO]
+    assert balance_nano(store, 1) == (MILESTONE_ADS + 1) * AD_VIEW_REWARD_NANO + MILESTONE_BONUS_NANO
+    assert accumulator.get_user(1)['balance_nano'] == balance_nano(store, 1)
+
+    for _ in range(MILESTONE_ADS - 2): # Up to one short of the next milestone
+        accumulator.record(1)
+    accumulator.flush()
+    assert bonuses == [1] and len(milestone_rows(store, 1)) == 1
+
+
+def test_views_split_across_workers_pay_the_bonus_once(store, make_accumulator, bonuses):
+    add_user(store, 1, ads_viewed=MILESTONE_ADS - 10)
+    first, second = make_accumulator(), make_accumulator()
+    for _ in range(10): # Each worker alone stays below the milestone
+        first.record(1)
+        second.record(1)
+
+    first.flush()
+    second.flush()
+
+    assert bonuses == [1]
+    assert milestone_rows(store, 1) == [MILESTONE_BONUS_NANO]
+    assert store.for_user(1).execute("SELECT ads_viewed FROM users WHERE id = 1").fetchone()[0] == MILESTONE_ADS + 10
+
+
+def test_batch_that_crosses_two_milestones_pays_both(store, make_accumulator, bonuses):
+    add_user(store, 1, ads_viewed=MILESTONE_ADS - 1)
+    accumulator = make_accumulator()
+    for _ in range(MILESTONE_ADS + 1):
+        accumulator.record(1)
+    accumulator.flush()
+
+    assert bonuses == [1]
+    assert milestone_rows(store, 1) == [2 * MILESTONE_BONUS_NANO]
+    assert balance_nano(store, 1) == (MILESTONE_ADS + 1) * AD_VIEW_REWARD_NANO + 2 * MILESTONE_BONUS_NANO
@@ -0,0 +1,59 @@
+import time
+from typing import Callable, Iterator
+
+import pytest
+
+import events
+
+
+@pytest.fixture
+def make_hub(legacy_store) -> Iterator[Callable[[], events.EventHub]]:
+    # One hub stands for one worker; they meet in the events tables.
+    conn = legacy_store.connect()
+    for statement in (events.EVENTS_SCHEMA, events.EVENTS_INDEX, events.LISTENERS_SCHEMA):
+        conn.execute(statement)
+    conn.commit()
+    hubs = []
+
+    def make() -> events.EventHub:
+        hub = events.EventHub(legacy_store.connect, poll_interval=0.02)
+        hubs.append(hub)
+        return hub
+
+    yield make
+    for hub in hubs:
+        hub.stop()
+
+
+def wait_for(condition: Callable[[], bool], timeout: float = 2.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_events_nobody_listens_for_are_not_written(make_hub, legacy_store):
+    publisher = make_hub()
+    assert not publisher.has_subscribers("user:1")
+    publisher.publish("user:1", "balance", {"earnings": 1})
+    time.sleep(0.1)
+    assert legacy_store.connect().execute("SELECT COUNT(*) FROM events").fetchone()[0] == 0
+
+
+def test_listener_on_another_worker_gets_the_event(make_hub):
+    publisher, listener = make_hub(), make_hub()
+    assert not publisher.has_subscribers("user:1")
+    subscription = listener.subscribe(["user:1"])
+
+    assert wait_for(lambda: publisher.has_subscribers("user:1"))
+    assert not publisher.has_subscribers("user:2")
+    publisher.publish("user:1", "balance", {"earnings": 1})
+    assert subscription.ready.wait(2)
+    assert subscription.queue[0].endswith('event: balance\ndata: {"earnings":1}\n\n')
+
+    # The listener row outlives the stream, so a reconnecting client can resume.
+    listener.unsubscribe(subscription)
+    time.sleep(0.1)
+    assert publisher.has_subscribers("user:1")
@@ -0,0 +1,35 @@
+import pytest
+
+import idempotency
+
+
+@pytest.fixture
+def keys(legacy_store) -> idempotency.IdempotencyKeys:
+    conn = legacy_store.connect()
+    conn.execute(idempotency.IDEMPOTENCY_SCHEMA)
+    conn.commit()
+    return idempotency.IdempotencyKeys(legacy_store.for_user, legacy_store.fan_out)
+
+
+def stored_keys(store) -> int:
+    return store.connect().execute("SELECT COUNT(*) FROM idempotency_keys").fetchone()[0]
+
+
+def test_completed_key_replays_from_another_worker(legacy_store, keys):
+    assert keys.begin(1, "withdraw:a") is None
+    keys.complete(1, "withdraw:a", 200, b'{"success":true}')
+    assert stored_keys(legacy_store) == 1
+
+    other_worker = idempotency.IdempotencyKeys(legacy_store.for_user, legacy_store.fan_out)
+    stored = other_worker.begin(1, "withdraw:a")
+    assert (stored.status, stored.body) == (200, b'{"success":true}')
+
+
+def test_keys_kept_in_memory_never_reach_the_table(legacy_store, keys):
+    assert keys.begin(1, "view_ad:a", durable=False) is None
+    with pytest.raises(idempotency.RequestInProgress):
+        keys.begin(1, "view_ad:a", durable=False)
+    keys.complete(1, "view_ad:a", 200, b'{}', durable=False)
+
+    assert keys.begin(1, "view_ad:a", durable=False).body == b'{}'
+    assert stored_keys(legacy_store) == 0
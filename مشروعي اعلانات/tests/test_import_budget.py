@@ -0,0 +1,15 @@
+import statistics
+
+from benchmarks import import_budget
+
+
+def test_cold_import_stays_within_budget():
+    # Fresh interpreters (see benchmarks/import_budget.py); IMPORT_BUDGET_MS and IMPORT_BUDGET_RUNS override.
+    totals, slowest, loaded = import_budget.measure(import_budget.DEFAULT_RUNS)
+    median = statistics.median(totals)
+    ranked = sorted(slowest, key=lambda module: statistics.median(slowest[module]), reverse=True)
+    assert median <= import_budget.DEFAULT_BUDGET_MS, (
+        f"import wsgi took {median:.1f} ms (median of {len(totals)}), over the "
+        f"{import_budget.DEFAULT_BUDGET_MS:.0f} ms budget; slowest: {', '.join(ranked[1:6])}"
+    )
+    assert loaded == [], f"modules that must be imported lazily were loaded: {', '.join(loaded)}"
@@ -0,0 +1,52 @@
+import ledger
+from conftest import add_user, balance_nano
+
+# REAL balances as the legacy users.earnings column held them, float noise included.
+LEGACY_EARNINGS = {1: 0.0, 2: 0.0001, 3: 0.1 + 0.2, 4: 1.23456789, 5: 0.0001 * 3, 6: None}
+
+
+def test_migration_keeps_every_legacy_balance(legacy_store):
+    conn = legacy_store.connect()
+    conn.executemany(
+        "INSERT INTO users (id, telegram_id, earnings, ads_viewed) VALUES (?, ?, ?, 50)",
+        [(user_id, 1000 + user_id, earnings) for user_id, earnings in LEGACY_EARNINGS.items()]
+    )
+    conn.execute("INSERT INTO withdrawals (user_id, amount, ton_wallet_address) VALUES (4, 0.5, 'UQwallet')")
+    conn.commit()
+
+    ledger.migrate(conn.cursor())
+    conn.commit()
+
+    balances = dict(conn.execute("SELECT id, balance_nano FROM user_balances").fetchall())
+    assert balances == {user_id: round((earnings or 0) * ledger.NANO_PER_TON)
+                        for user_id, earnings in LEGACY_EARNINGS.items()}
+    for user_id, earnings in LEGACY_EARNINGS.items():
+        assert ledger.to_ton(balances[user_id]) == round(earnings or 0, 9)
+    assert conn.execute("SELECT amount_nano FROM withdrawals").fetchone()[0] == ledger.to_nano(0.5)
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == ledger.SCHEMA_VERSION
+
+    # Running again (every worker start does) must not add the legacy balance twice.
+    conn.execute("UPDATE users SET earnings = 99")
+    ledger.migrate(conn.cursor())
+    conn.commit()
+    assert dict(conn.execute("SELECT id, balance_nano FROM user_balances").fetchall()) == balances
+
+
+def test_compaction_preserves_balances(store):
+    add_user(store, 1, balance_nano=ledger.to_nano(0.25))
+    add_user(store, 2)
+    conn = store.connect()
+    ledger.credit_many(conn, [(1, ledger.to_nano(0.0001), 'ad_view'), (2, 7, 'ad_view'), (1, -100, 'withdrawal')])
+    conn.commit()
+    before = {user_id: balance_nano(store, user_id) for user_id in (1, 2)}
+
+    assert ledger.compact(conn) == 4
+    assert conn.execute("SELECT COUNT(*) FROM earnings_ledger").fetchone()[0] == 0
+    assert {user_id: balance_nano(store, user_id) for user_id in (1, 2)} == before
+
+    # Rows written after a compaction are added on top of the snapshot.
+    ledger.credit_many(conn, [(2, 5, 'ad_view')])
+    conn.commit()
+    assert balance_nano(store, 2) == before[2] + 5
+    assert ledger.compact(conn) == 1
+    assert balance_nano(store, 2) == before[2] + 5
@@ -0,0 +1,213 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Tuple
+
+import pytest
+
+import outbox
+from outbox import OUTBOX_INDEX, OUTBOX_SCHEMA, TelegramOutbox
+
+TOKEN = "123:test"
+
+
+class FakeClock:
+    # Stands in for the time module inside outbox, so retry delays pass instantly.
+    def __init__(self, start: float = 1_000_000.0) -> None:
+        self.now = start
+        self.sleeps: List[float] = []
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+class _ScriptedHandler(BaseHTTPRequestHandler):
+    # Answers each sendMessage with the next scripted (status, body), then with 200.
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self) -> None:
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+        with self.server.lock:
+            self.server.requests.append((self.path, payload))
+            status, body = self.server.script.pop(0) if self.server.script else (200, {"ok": True, "result": True})
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def telegram_stub() -> Iterator[ThreadingHTTPServer]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ScriptedHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.script: List[Tuple[int, Dict[str, Any]]] = []
+    server.requests: List[Tuple[str, Dict[str, Any]]] = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def clock(monkeypatch: pytest.MonkeyPatch) -> FakeClock:
+    fake = FakeClock()
+    monkeypatch.setattr(outbox, "time", fake)
+    monkeypatch.setattr(outbox.random, "uniform", lambda low, high: 1.0) # No jitter on 5xx backoff
+    return fake
+
+
+@pytest.fixture
+def sender(tmp_path, telegram_stub: ThreadingHTTPServer) -> Iterator[Tuple[TelegramOutbox, Any]]:
+    path = str(tmp_path / "outbox.db")
+
+    def connect(shard: int = 0) -> sqlite3.Connection:
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    conn = connect()
+    conn.execute(OUTBOX_SCHEMA)
+    conn.execute(OUTBOX_INDEX)
+    conn.commit()
+    conn.close()
+    api_url = f"http://127.0.0.1:{telegram_stub.server_address[1]}"
+    sender = TelegramOutbox(connect, TOKEN, api_url=api_url)
+    yield sender, connect
+    sender.stop()
+
+
+def enqueue(outbox_sender: TelegramOutbox, connect, chat_id: Any, text: str) -> None:
+    conn = connect()
+    outbox_sender.enqueue(conn, chat_id, text)
+    conn.commit()
+    conn.close()
+
+
+def outbox_rows(connect) -> List[sqlite3.Row]:
+    conn = connect()
+    rows = conn.execute("SELECT id, chat_id, status, attempts, next_attempt_at, last_error FROM telegram_outbox").fetchall()
+    conn.close()
+    return rows
+
+
+def test_retries_after_429_and_5xx_until_delivered(sender, telegram_stub, clock):
+    outbox_sender, connect = sender
+    telegram_stub.script = [
+        (429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 7",
+               "parameters": {"retry_after": 7}}),
+        (502, {"ok": False, "error_code": 502, "description": "Bad Gateway"}),
+    ]
+    enqueue(outbox_sender, connect, 42, "hello")
+    started = clock.now
+
+    # 429: retried after exactly retry_after seconds
+    assert outbox_sender.drain_once() == 1
+    [row] = outbox_rows(connect)
+    assert (row['status'], row['attempts']) == ('pending', 1)
+    assert row['next_attempt_at'] == started + 7
+    assert row['last_error'].startswith("HTTP 429")
+    clock.advance(6.5)
+    assert outbox_sender.drain_once() == 0
+
+    # 5xx: exponential backoff, 2 ** attempts seconds (jitter pinned to 1.0)
+    clock.advance(0.5)
+    assert outbox_sender.drain_once() == 1
+    [row] = outbox_rows(connect)
+    assert (row['status'], row['attempts']) == ('pending', 2)
+    assert row['next_attempt_at'] == clock.now + 2
+    assert row['last_error'].startswith("HTTP 502")
+    clock.advance(1.5)
+    assert outbox_sender.drain_once() == 0
+
+    # 200: delivered once and removed from the outbox
+    clock.advance(0.5)
+    assert outbox_sender.drain_once() == 1
+    assert outbox_rows(connect) == []
+    assert len(telegram_stub.requests) == 3
+    assert clock.now - started == 9
+    assert clock.sleeps == []
+    path, payload = telegram_stub.requests[-1]
+    assert path == f"/bot{TOKEN}/sendMessage"
+    assert payload == {"chat_id": "42", "text": "hello", "parse_mode": "HTML"}
+
+
+def test_429_pauses_sends_to_other_chats(sender, telegram_stub, clock):
+    outbox_sender, connect = sender
+    telegram_stub.script = [
+        (429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+               "parameters": {"retry_after": 3}}),
+    ]
+    enqueue(outbox_sender, connect, 1, "first")
+    enqueue(outbox_sender, connect, 2, "second")
+
+    # The rate limit is per bot: the second chat waits out retry_after before its send
+    assert outbox_sender.drain_once() == 2
+    assert clock.sleeps == [3]
+    assert len(telegram_stub.requests) == 2
+    [row] = outbox_rows(connect)
+    assert (row['chat_id'], row['attempts']) == ('1', 1)
+
+    assert outbox_sender.drain_once() == 1
+    assert outbox_rows(connect) == []
+    assert len(telegram_stub.requests) == 3
+
+
+def test_other_4xx_fails_without_retrying(sender, telegram_stub, clock):
+    outbox_sender, connect = sender
+    telegram_stub.script = [
+        (403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}),
+    ]
+    enqueue(outbox_sender, connect, 7, "bye")
+
+    assert outbox_sender.drain_once() == 1
+    [row] = outbox_rows(connect)
+    assert (row['status'], row['attempts']) == ('failed', 1)
+    assert "blocked" in row['last_error']
+    clock.advance(outbox.MAX_BACKOFF_SEC)
+    assert outbox_sender.drain_once() == 0
+    assert len(telegram_stub.requests) == 1
+
+
+def test_start_sends_rows_left_pending_by_another_worker(sender, telegram_stub):
+    outbox_sender, connect = sender
+    enqueue(outbox_sender, connect, 5, "left behind") # Committed, but nobody called wake()
+
+    outbox_sender.start()
+    deadline = time.monotonic() + 5
+    while outbox_rows(connect) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert outbox_rows(connect) == []
+    assert len(telegram_stub.requests) == 1
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork()")
+def test_forked_worker_starts_its_own_sender(sender):
+    outbox_sender, connect = sender
+    outbox_sender.start() # As in a preloaded gunicorn master
+    pid = os.fork()
+    if pid == 0:
+        # Only the forking thread survives in the child; the inherited sender is not running.
+        outbox_sender.start()
+        os._exit(0 if outbox_sender._thread.is_alive() and outbox_sender._thread_pid == os.getpid() else 1)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
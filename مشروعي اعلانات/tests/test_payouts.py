@@ -0,0 +1,53 @@
+import threading
+import time
+
+import pytest
+
+import ledger
+import payouts
+from conftest import add_user, balance_nano
+from repository import Repository
+
+WALLET = "UQ" + "A" * 46
+
+
+def test_concurrent_withdrawals_debit_the_balance_once(store):
+    add_user(store, 1, ads_viewed=payouts.MIN_ADS_FOR_WITHDRAWAL, balance_nano=ledger.to_nano(1.5))
+    repository = Repository(store)
+    start = threading.Barrier(2)
+    outcomes = []
+
+    def hold_transaction(conn, withdrawal, user) -> None:
+        time.sleep(0.2) # Keeps the first debit uncommitted while the other request runs
+
+    def withdraw() -> None:
+        start.wait()
+        try:
+            withdrawal, _ = repository.request_withdrawal(1, WALLET, hold_transaction)
+            outcomes.append(withdrawal['amount_nano'])
+        except payouts.WithdrawalError as e:
+            outcomes.append(str(e))
+
+    threads = [threading.Thread(target=withdraw) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(outcomes, key=str) == [ledger.to_nano(1.5), "No earnings to withdraw"]
+    conn = store.connect()
+    assert conn.execute("SELECT COUNT(*) FROM withdrawals").fetchone()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM earnings_ledger WHERE kind = 'withdrawal'").fetchone()[0] == 1
+    assert balance_nano(store, 1) == 0
+
+
+def test_withdrawal_needs_enough_ads_and_a_balance(store):
+    add_user(store, 1, ads_viewed=payouts.MIN_ADS_FOR_WITHDRAWAL - 1, balance_nano=ledger.to_nano(1.0))
+    add_user(store, 2, ads_viewed=payouts.MIN_ADS_FOR_WITHDRAWAL)
+    repository = Repository(store)
+
+    for user_id, message in ((1, "You must view at least"), (2, "No earnings to withdraw"), (3, "User not found")):
+        with pytest.raises(payouts.WithdrawalError, match=message):
+            repository.request_withdrawal(user_id, WALLET, lambda conn, withdrawal, user: None)
+    assert balance_nano(store, 1) == ledger.to_nano(1.0)
+    assert store.connect().execute("SELECT COUNT(*) FROM withdrawals").fetchone()[0] == 0
@@ -0,0 +1,76 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, NamedTuple, Optional
+
+from flask import url_for
+
+import ledger
+
+
+def serialize_user(user: Mapping[str, Any]) -> Dict[str, Any]:
+    # The user object returned by /api/login, /api/user_data, /api/view_ad and /api/withdraw,
+    # without referralLink (see CachedUserView.payload()).
+    return {
+        "id": user['id'],
+        "telegram_id": user['telegram_id'],
+        "first_name": user['first_name'],
+        "username": user['username'],
+        "earnings": ledger.to_ton(user['balance_nano']),
+        "adsViewed": user['ads_viewed'],
+    }
+
+
+class CachedUserView(NamedTuple):
+    fields: Dict[str, Any] # serialize_user(); only database fields, the same for every request
+    referral_code: str
+    etag: str
+    expires_at: float
+
+    def payload(self) -> Dict[str, Any]:
+        # The link is built per request: it carries the host that request came in on.
+        # Browsers keep ETags per origin, so the ETag need not cover it.
+        return dict(self.fields, referralLink=url_for('index', ref=self.referral_code, _external=True))
+
+
+class UserViewCache:
+    """Per-process LRU of serialized user views, keyed by user id.
+
+    Writes in this process replace or drop the entry directly. Changes made
+    by another worker are not seen here until the entry expires, so a view
+    is at most ``ttl`` seconds (USER_CACHE_TTL) behind the database.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: float = 30.0) -> None:
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries: "OrderedDict[int, CachedUserView]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> Optional[CachedUserView]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if entry.expires_at <= time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return entry
+
+    def put(self, user: Mapping[str, Any]) -> CachedUserView:
+        fields = serialize_user(user)
+        etag = hashlib.sha1(json.dumps([fields, user['referral_code']], sort_keys=True).encode('utf-8')).hexdigest()
+        entry = CachedUserView(fields, user['referral_code'], etag, time.monotonic() + self._ttl)
+        with self._lock:
+            self._entries[fields['id']] = entry
+            self._entries.move_to_end(fields['id'])
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, user_id: int) -> None:
+        with self._lock:
+            self._entries.pop(user_id, None)